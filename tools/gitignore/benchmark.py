@@ -0,0 +1,101 @@
+"""Measure the throughput of walking a tree and filtering its paths with
+PathFilter, as done by lint and by the manifest when building from the
+working tree.
+
+Run from the tools directory as:
+
+    python -m gitignore.benchmark [--repeat N] [root]
+"""
+
+import argparse
+import os
+import time
+
+from .gitignore import PathFilter
+
+here = os.path.dirname(__file__)
+
+wpt_root = os.path.abspath(os.path.join(here, os.pardir, os.pardir))
+
+
+def walk(root):
+    count = 0
+    for dir_path, dir_names, filenames in os.walk(root):
+        rel_root = os.path.relpath(dir_path, root)
+        for filename in filenames:
+            os.path.join(rel_root, filename)
+            count += 1
+        if ".git" in dir_names:
+            dir_names.remove(".git")
+    return count
+
+
+def walk_filtered(root):
+    path_filter = PathFilter(root, extras=[".git/"])
+    count = 0
+    for dir_path, dir_names, filenames in os.walk(root):
+        rel_root = os.path.relpath(dir_path, root)
+        if rel_root == ".":
+            rel_root = ""
+        for filename in filenames:
+            if path_filter(os.path.join(rel_root, filename)):
+                count += 1
+        dir_names[:] = [item for item in dir_names
+                        if path_filter(os.path.join(rel_root, item) + "/")]
+    return count
+
+
+def filter_only(root):
+    paths = []
+    for dir_path, dir_names, filenames in os.walk(root):
+        rel_root = os.path.relpath(dir_path, root)
+        rel_root = "" if rel_root == "." else rel_root + "/"
+        paths.extend(rel_root + filename for filename in filenames)
+        paths.extend(rel_root + dir_name + "/" for dir_name in dir_names)
+
+    path_filter = PathFilter(root, extras=[".git/"])
+    start = time.time()
+    for path in paths:
+        path_filter(path)
+    return len(paths), time.time() - start
+
+
+def best_of(repeat, func, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        count = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best[1]:
+            best = (count, elapsed)
+    return best
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", nargs="?", default=wpt_root,
+                        help="Root of the tree to walk (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of runs to take the best time from")
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+
+    count, elapsed = best_of(args.repeat, walk, args.root)
+    print("walk:            %6i files in %.3fs, %8.0f files/s" % (count, elapsed, count / elapsed))
+
+    count, elapsed = best_of(args.repeat, walk_filtered, args.root)
+    print("walk and filter: %6i files in %.3fs, %8.0f files/s" % (count, elapsed, count / elapsed))
+
+    best = None
+    for _ in range(args.repeat):
+        count, elapsed = filter_only(args.root)
+        if best is None or elapsed < best:
+            best = elapsed
+    print("filter only:     %6i paths in %.3fs, %8.0f paths/s" % (count, best, count / best))
+
+
+if __name__ == "__main__":
+    main()
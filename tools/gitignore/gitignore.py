@@ -16,7 +16,12 @@ def fnmatch_translate(pat, path_name=False):
             pat = pat[1:]
     else:
         any_char = "."
-        parts.append("^(?:.*/)?")
+        if pat[0] == "*":
+            # The leading * matches any directory prefix already, and
+            # a single .* is much cheaper to match
+            parts.append("^")
+        else:
+            parts.append("^(?:.*/)?")
     while i < len(pat):
         c = pat[i]
         if c == "\\":
@@ -87,7 +92,96 @@ def parse_line(line):
     return invert, dir_only, fnmatch_translate(line, "/" in line)
 
 
+def parse_rules(lines, dir_path=""):
+    """Parse lines of a .gitignore file.
+
+    :param lines: Iterable of lines in the file
+    :param dir_path: /-separated path of the directory containing the file
+                     relative to the root, so that the rules match paths
+                     relative to the root
+    :returns: Tuple of (rules for files, rules for directories), each a
+              list of (regexp, invert) in the order they appear
+    """
+    rules_file = []
+    rules_dir = []
+    for line in lines:
+        parsed = parse_line(line)
+        if not parsed:
+            continue
+        invert, dir_only, regexp = parsed
+        if dir_path:
+            # Every pattern starts with ^
+            regexp = re.compile("^" + re.escape(dir_path + "/") + regexp.pattern[1:])
+        if dir_only:
+            rules_dir.append((regexp, invert))
+        else:
+            rules_file.append((regexp, invert))
+    return rules_file, rules_dir
+
+
+# Python 2's re module supports at most 100 groups in a pattern
+max_rules_per_regexp = 99
+
+
+def compile_rules(rules):
+    """Combine a list of (regexp, invert) rules into as few regexps as
+    possible.
+
+    Since the last rule that matches a path decides whether it is included,
+    the rules are combined in reverse order so that the first alternative to
+    match is the one that counts.
+
+    :returns: List of (combined regexp, list of invert flags indexed by group
+              number - 1)
+    """
+    rv = []
+    rules = list(reversed(rules))
+    for i in range(0, len(rules), max_rules_per_regexp):
+        chunk = rules[i:i + max_rules_per_regexp]
+        pattern = "|".join("(%s)" % regexp.pattern for regexp, _ in chunk)
+        rv.append((re.compile(pattern), [invert for _, invert in chunk]))
+    return rv
+
+
+def match_rules(compiled, path):
+    """Find whether the last of a set of rules compiled with compile_rules
+    that matches path includes it.
+
+    :returns: True if the path is included, False if it is excluded, or
+              None if no rule matches
+    """
+    for regexp, inverts in compiled:
+        m = regexp.match(path)
+        if m is not None:
+            return inverts[m.lastindex - 1]
+    return None
+
+
+class DirRules(object):
+    """The rules that apply to the paths in a directory, from the .gitignore
+    files in it and in each of its parents"""
+
+    def __init__(self, rules_file, rules_dir):
+        self.rules_file = rules_file
+        self.rules_dir = rules_dir
+        self.compiled_file = compile_rules(rules_file)
+        self.compiled_dir = compile_rules(rules_dir)
+
+
 class PathFilter(object):
+    """Callable that checks whether a path relative to root is included, i.e.
+    not ignored by any .gitignore file.
+
+    Paths of directories must end with a "/". As in git, anything inside an
+    ignored directory is ignored, and rules from a .gitignore file in a
+    subdirectory apply to paths under that directory and take precedence
+    over those from higher up the tree.
+
+    :param root: Path to the root of the tree, or None to only use the rules
+                 in extras
+    :param extras: List of additional rules for the root of the tree
+    """
+
     def __init__(self, root, extras=None):
         if root:
             ignore_path = os.path.join(root, ".gitignore")
@@ -97,33 +191,36 @@ class PathFilter(object):
             self.trivial = True
             return
         self.trivial = False
+        self.root = root
 
-        self.rules_file = []
-        self.rules_dir = []
-
-        if extras is None:
-            extras = []
-
+        lines = []
         if ignore_path and os.path.exists(ignore_path):
-            self._read_ignore(ignore_path)
-
-        for item in extras:
-            self._read_line(item)
-
-    def _read_ignore(self, ignore_path):
-        with open(ignore_path) as f:
-            for line in f:
-                self._read_line(line)
-
-    def _read_line(self, line):
-        parsed = parse_line(line)
-        if not parsed:
-            return
-        invert, dir_only, regexp = parsed
-        if dir_only:
-            self.rules_dir.append((regexp, invert))
+            with open(ignore_path) as f:
+                lines.extend(f)
+        if extras is not None:
+            lines.extend(extras)
+        self.rules_file, self.rules_dir = parse_rules(lines)
+
+        # For each directory seen so far, a DirRules for the paths in it, or
+        # None if the directory is ignored
+        self.dirs = {"": DirRules(self.rules_file, self.rules_dir)}
+
+    def _dir(self, dir_path):
+        if dir_path in self.dirs:
+            return self.dirs[dir_path]
+
+        parent = dir_path.rsplit("/", 1)[0] if "/" in dir_path else ""
+        rv = self._dir(parent)
+        if rv is not None and match_rules(rv.compiled_dir, dir_path) is not False:
+            ignore_path = os.path.join(self.root, dir_path, ".gitignore") if self.root else None
+            if ignore_path and os.path.isfile(ignore_path):
+                with open(ignore_path) as f:
+                    rules_file, rules_dir = parse_rules(f, dir_path)
+                rv = DirRules(rv.rules_file + rules_file, rv.rules_dir + rules_dir)
         else:
-            self.rules_file.append((regexp, invert))
+            rv = None
+        self.dirs[dir_path] = rv
+        return rv
 
     def __call__(self, path):
         if os.path.sep != "/":
@@ -132,17 +229,17 @@ class PathFilter(object):
         if self.trivial:
             return True
 
-        path_is_dir = path[-1] == "/"
-        if path_is_dir:
-            path = path[:-1]
-            rules = self.rules_dir
-        else:
-            rules = self.rules_file
-
-        include = True
-        for regexp, invert in rules:
-            if not include and invert and regexp.match(path):
-                include = True
-            elif include and not invert and regexp.match(path):
-                include = False
-        return include
+        if path[-1] == "/":
+            return self._dir(path[:-1]) is not None
+
+        parent = path.rsplit("/", 1)[0] if "/" in path else ""
+        dir_rules = self.dirs.get(parent, False)
+        if dir_rules is False:
+            dir_rules = self._dir(parent)
+        if dir_rules is None:
+            return False
+        for regexp, inverts in dir_rules.compiled_file:
+            m = regexp.match(path)
+            if m is not None:
+                return inverts[m.lastindex - 1]
+        return True
@@ -73,3 +73,42 @@ def test_path_filter(path, expected):
     ]
     f = PathFilter(None, extras)
     assert f(path) == expected
+
+
+def test_path_filter_many_rules():
+    # More rules than fit in a single combined regexp
+    extras = ["file%i" % i for i in range(250)] + ["!file3", "file3"]
+    extras.insert(200, "!file10")
+    f = PathFilter(None, extras)
+    assert f("a/file0") is False
+    assert f("file249") is False
+    assert f("file250") is True
+    # The last matching rule wins
+    assert f("file10") is True
+    assert f("file3") is False
+
+
+def test_path_filter_ignored_dir():
+    f = PathFilter(None, ["a/b/", "!a/b/c"])
+    assert f("a/b/") is False
+    assert f("a/b/c") is False
+    assert f("a/b/d/e") is False
+    assert f("a/bc/d") is True
+
+
+def test_path_filter_nested(tmpdir):
+    tmpdir.join(".gitignore").write("*.a\nb/\n")
+    tmpdir.mkdir("x").join(".gitignore").write("!keep.a\n/root-only\nc/\n")
+    f = PathFilter(str(tmpdir))
+
+    assert f("foo.a") is False
+    assert f("x/foo.a") is False
+    assert f("x/keep.a") is True
+    assert f("keep.a") is False
+    assert f("x/root-only") is False
+    assert f("x/y/root-only") is True
+    assert f("root-only") is True
+    assert f("x/c/") is False
+    assert f("x/c/foo") is False
+    assert f("c/foo") is True
+    assert f("x/b/foo") is False
@@ -131,7 +131,7 @@ class RefTestNode(URLManifestItem):
     item_type = "reftest_node"
 
     def __init__(self, source_file, url, references, url_base="/", timeout=None,
-                 viewport_size=None, dpi=None, manifest=None):
+                 viewport_size=None, dpi=None, fuzzy=None, manifest=None):
         URLManifestItem.__init__(self, source_file, url, url_base=url_base, manifest=manifest)
         for _, ref_type in references:
             if ref_type not in ["==", "!="]:
@@ -140,9 +140,10 @@ class RefTestNode(URLManifestItem):
         self.timeout = timeout
         self.viewport_size = viewport_size
         self.dpi = dpi
+        self.fuzzy = fuzzy
 
     def meta_key(self):
-        return (self.timeout, self.viewport_size, self.dpi)
+        return (self.timeout, self.viewport_size, self.dpi, self.fuzzy)
 
     def to_json(self):
         rv = [self.url, self.references, {}]
@@ -153,6 +154,8 @@ class RefTestNode(URLManifestItem):
             extras["viewport_size"] = self.viewport_size
         if self.dpi is not None:
             extras["dpi"] = self.dpi
+        if self.fuzzy is not None:
+            extras["fuzzy"] = self.fuzzy
         return rv
 
     @classmethod
@@ -166,6 +169,7 @@ class RefTestNode(URLManifestItem):
                    timeout=extras.get("timeout"),
                    viewport_size=extras.get("viewport_size"),
                    dpi=extras.get("dpi"),
+                   fuzzy=extras.get("fuzzy"),
                    manifest=manifest)
 
     def to_RefTest(self):
@@ -1,15 +1,22 @@
 import json
 import os
 import re
+from bisect import bisect_left
 from collections import defaultdict
+try:
+    from collections.abc import KeysView, MutableMapping
+except ImportError:
+    from collections import KeysView, MutableMapping
+from multiprocessing import Pool
 from six import iteritems, itervalues, viewkeys
+from six.moves import map as imap
 
 from .item import ManualTest, WebdriverSpecTest, Stub, RefTestNode, RefTest, TestharnessTest, SupportFile, ConformanceCheckerTest, VisualTest
 from .log import get_logger
 from .utils import from_os_path, to_os_path, rel_path_to_url
 
 
-CURRENT_VERSION = 4
+CURRENT_VERSION = 5
 
 
 class ManifestError(Exception):
@@ -21,11 +28,117 @@ class ManifestVersionMismatch(ManifestError):
 
 
 def sourcefile_items(args):
-    tests_root, url_base, rel_path, status = args
-    source_file = SourceFile(tests_root,
-                             rel_path,
-                             url_base)
-    return rel_path, source_file.manifest_items()
+    """Hash a source file and, if its hash differs from the one recorded in
+    the manifest, compute its manifest items.
+
+    This is a module-level function so that it can be passed to
+    multiprocessing.Pool.imap.
+
+    :param args: Tuple of (SourceFile, hash recorded in the manifest or None)
+    :returns: Tuple of (rel_path, file_hash, (item_type, manifest_items)), where
+              the last element is None if the file is unchanged.
+    """
+    source_file, old_hash = args
+    file_hash = source_file.hash
+    if file_hash == old_hash:
+        return source_file.rel_path, file_hash, None
+    return source_file.rel_path, file_hash, source_file.manifest_items()
+
+
+item_classes = {"testharness": TestharnessTest,
+                "reftest": RefTest,
+                "reftest_node": RefTestNode,
+                "manual": ManualTest,
+                "stub": Stub,
+                "wdspec": WebdriverSpecTest,
+                "conformancechecker": ConformanceCheckerTest,
+                "visual": VisualTest,
+                "support": SupportFile}
+
+
+class TypeData(MutableMapping):
+    """Mapping of path -> set of manifest items of a single type, constructed
+    from the serialized form of the manifest.
+
+    Items for a path are only constructed the first time that path is
+    accessed; until then the serialized data is kept as-is, and is written
+    back unchanged by to_json.
+
+    :param manifest: The Manifest containing the items
+    :param tests_root: Path to the root of the source tree
+    :param item_type: The type of the items
+    :param json_data: Mapping of /-separated path -> list of serialized items.
+                      This may be any mapping, e.g. one backed by a database.
+    :param source_files: Dict of path -> SourceFile shared between all the
+                         item types in the manifest
+    """
+
+    def __init__(self, manifest, tests_root, item_type, json_data, source_files):
+        self.manifest = manifest
+        self.tests_root = tests_root
+        self.type_cls = item_classes[item_type]
+        self.json_data = json_data
+        self.source_files = source_files
+        self.data = {}
+        # Paths removed from json_data, which may not be writable
+        self.deleted = set()
+
+    def _load(self, path):
+        json_path = from_os_path(path)
+        if path in self.deleted or json_path not in self.json_data:
+            raise KeyError(path)
+        rv = set()
+        for test in self.json_data[json_path]:
+            rv.add(self.type_cls.from_json(self.manifest,
+                                           self.tests_root,
+                                           path,
+                                           test,
+                                           source_files=self.source_files))
+        self.data[path] = rv
+        return rv
+
+    def __getitem__(self, path):
+        if path in self.data:
+            return self.data[path]
+        return self._load(path)
+
+    def __setitem__(self, path, tests):
+        self.data[path] = tests
+        self.deleted.discard(path)
+
+    def __delitem__(self, path):
+        if path not in self:
+            raise KeyError(path)
+        self.data.pop(path, None)
+        self.deleted.add(path)
+
+    def __contains__(self, path):
+        return path in self.data or (path not in self.deleted and
+                                     from_os_path(path) in self.json_data)
+
+    def __iter__(self):
+        for path in self.data:
+            yield path
+        for json_path in self.json_data:
+            path = to_os_path(json_path)
+            if path not in self.data and path not in self.deleted:
+                yield path
+
+    def __len__(self):
+        return len(set(self))
+
+    def viewkeys(self):
+        return KeysView(self)
+
+    def to_json(self):
+        rv = {}
+        for json_path, tests in iteritems(self.json_data):
+            path = to_os_path(json_path)
+            if path not in self.data and path not in self.deleted:
+                rv[json_path] = tests
+        for path, tests in iteritems(self.data):
+            rv[from_os_path(path)] = [t for t in sorted(test.to_json() for test in tests)]
+        return rv
 
 
 class Manifest(object):
@@ -34,6 +147,12 @@ class Manifest(object):
         self._path_hash = {}
         self._data = defaultdict(dict)
         self._reftest_nodes_by_url = None
+        self._sorted_paths = None
+        # url -> set of paths of reftest nodes with that url, and
+        # url -> set of paths of reftest nodes referencing that url.
+        # Built on the first update that changes a reftest.
+        self._reftest_paths_by_url = None
+        self._reftest_inbound = None
         self.url_base = url_base
 
     def __iter__(self):
@@ -51,20 +170,41 @@ class Manifest(object):
             for test in type_tests.get(path, set()):
                 yield test
 
+    def iterpaths(self, prefix=""):
+        """Iterate over the paths of every file in the manifest whose path
+        starts with prefix, in sorted order"""
+        # Sorted list of all paths, rebuilt on first use after the set of
+        # paths changes, so that lookups are a bisection
+        if self._sorted_paths is None:
+            self._sorted_paths = sorted(self._path_hash)
+        paths = self._sorted_paths
+        i = bisect_left(paths, prefix)
+        while i < len(paths) and paths[i].startswith(prefix):
+            yield paths[i]
+            i += 1
+
+    def iterprefix(self, prefix):
+        """Iterate over the manifest items of every file whose path starts
+        with prefix"""
+        for rel_path in self.iterpaths(prefix):
+            for test in self.iterpath(rel_path):
+                yield test
+
     def iterdir(self, dir_name):
         if not dir_name.endswith(os.path.sep):
             dir_name = dir_name + os.path.sep
-        for type_tests in self._data.values():
-            for path, tests in type_tests.iteritems():
-                if path.startswith(dir_name):
-                    for test in tests:
-                        yield test
+        return self.iterprefix(dir_name)
+
+    def file_hash(self, rel_path):
+        """Return the hash recorded for the file at rel_path, or None if the
+        path isn't in the manifest"""
+        return self._path_hash.get(rel_path, (None, None))[0]
 
     @property
     def reftest_nodes_by_url(self):
         if self._reftest_nodes_by_url is None:
             by_url = {}
-            for path, nodes in iteritems(self._data.get("reftests", {})):
+            for path, nodes in iteritems(self._data.get("reftest_node", {})):
                 for node in nodes:
                     by_url[node.url] = node
             self._reftest_nodes_by_url = by_url
@@ -73,101 +213,245 @@ class Manifest(object):
     def get_reference(self, url):
         return self.reftest_nodes_by_url.get(url)
 
-    def update(self, tree):
-        new_data = defaultdict(dict)
+    def _iter_sourcefile_items(self, tree, jobs):
+        args = ((source_file, self._path_hash.get(source_file.rel_path, (None, None))[0])
+                for source_file in tree)
+
+        if jobs == 1:
+            for rv in imap(sourcefile_items, args):
+                yield rv
+            return
+
+        pool = Pool(jobs or None)
+        try:
+            for rv in pool.imap(sourcefile_items, args, chunksize=64):
+                yield rv
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def update(self, tree, jobs=1):
+        """Update the manifest from a source tree.
+
+        :param tree: Iterable of SourceFile objects for every file in the tree
+        :param jobs: Number of processes used to hash and parse files. Values
+                     other than 1 fan the work out to a multiprocessing pool,
+                     with 0 meaning one process per CPU; the SourceFile objects
+                     must then be picklable.
+        :returns: Boolean indicating whether the manifest changed
+        """
         new_hashes = {}
 
-        reftest_nodes = []
+        reftest_types = ("reftest", "reftest_node")
+        reftests_added = {}
+        reftests_removed = set()
         old_files = defaultdict(set, {k: set(viewkeys(v)) for k, v in iteritems(self._data)})
 
         changed = False
-        reftest_changes = False
 
-        for source_file in tree:
-            rel_path = source_file.rel_path
-            file_hash = source_file.hash
+        for rel_path, file_hash, updated_items in self._iter_sourcefile_items(tree, jobs):
+            if rel_path in self._path_hash:
+                old_hash, old_type = self._path_hash[rel_path]
+                old_files[old_type].discard(rel_path)
+                if updated_items is None:
+                    # The entry is left as it is, so that unchanged items
+                    # loaded from JSON are never constructed
+                    new_hashes[rel_path] = (file_hash, old_type)
+                    continue
+                if old_type in reftest_types:
+                    reftests_removed.add(rel_path)
+                elif rel_path in self._data[old_type]:
+                    del self._data[old_type][rel_path]
+
+            new_type, manifest_items = updated_items
+            if new_type in reftest_types:
+                reftests_added[rel_path] = manifest_items
+            elif new_type:
+                self._data[new_type][rel_path] = set(manifest_items)
 
-            is_new = rel_path not in self._path_hash
-            hash_changed = False
+            new_hashes[rel_path] = (file_hash, new_type)
+            changed = True
 
-            if not is_new:
-                old_hash, old_type = self._path_hash[rel_path]
-                old_files[old_type].remove(rel_path)
-                if old_hash != file_hash:
-                    new_type, manifest_items = source_file.manifest_items()
-                    hash_changed = True
-                else:
-                    new_type, manifest_items = old_type, self._data[old_type][rel_path]
+        for item_type, rel_paths in iteritems(old_files):
+            if not rel_paths:
+                continue
+            changed = True
+            if item_type in reftest_types:
+                reftests_removed |= rel_paths
             else:
-                new_type, manifest_items = source_file.manifest_items()
+                for rel_path in rel_paths:
+                    del self._data[item_type][rel_path]
+
+        if reftests_added or reftests_removed:
+            reprocessed = self._update_reftests(reftests_added, reftests_removed, new_hashes)
+            get_logger().debug("Reclassified %i reftest nodes" % reprocessed)
+            self._reftest_nodes_by_url = None
+
+        # Only types with items have entries, apart from the reftest types
+        for item_type in list(self._data.keys()):
+            if (item_type not in reftest_types and
+                next(iter(self._data[item_type]), None) is None):
+                del self._data[item_type]
+        for item_type in reftest_types:
+            self._data.setdefault(item_type, {})
 
-            if new_type in ("reftest", "reftest_node"):
-                reftest_nodes.extend(manifest_items)
-                if is_new or hash_changed:
-                    reftest_changes = True
-            elif new_type:
-                new_data[new_type][rel_path] = set(manifest_items)
+        self._path_hash = new_hashes
+        self._sorted_paths = None
 
-            new_hashes[rel_path] = (file_hash, new_type)
+        return changed
+
+    def update_paths(self, tree, removed=()):
+        """Update the manifest for only some of the files in the source tree,
+        leaving the entries for all other files as they are.
+
+        :param tree: Iterable of SourceFile objects for files that may have
+                     been added or changed
+        :param removed: Iterable of paths of files that have been deleted
+        :returns: Boolean indicating whether the manifest changed
+        """
+        reftest_types = ("reftest", "reftest_node")
+        reftests_added = {}
+        reftests_removed = set()
+        removed_from_types = set()
 
-            if is_new or hash_changed:
+        changed = False
+
+        def remove(rel_path):
+            _, old_type = self._path_hash.pop(rel_path)
+            if old_type in reftest_types:
+                reftests_removed.add(rel_path)
+            elif rel_path in self._data[old_type]:
+                del self._data[old_type][rel_path]
+                removed_from_types.add(old_type)
+
+        for rel_path in removed:
+            if rel_path in self._path_hash:
+                remove(rel_path)
                 changed = True
 
-        if reftest_changes or old_files["reftest"] or old_files["reftest_node"]:
-            reftests, reftest_nodes, changed_hashes = self._compute_reftests(reftest_nodes)
-            new_data["reftest"] = reftests
-            new_data["reftest_node"] = reftest_nodes
-            new_hashes.update(changed_hashes)
-        else:
-            new_data["reftest"] = self._data["reftest"]
-            new_data["reftest_node"] = self._data["reftest_node"]
+        for rel_path, file_hash, updated_items in self._iter_sourcefile_items(tree, 1):
+            if updated_items is None:
+                continue
 
-        if any(itervalues(old_files)):
+            if rel_path in self._path_hash:
+                remove(rel_path)
+
+            new_type, manifest_items = updated_items
+            if new_type in reftest_types:
+                reftests_added[rel_path] = manifest_items
+            elif new_type:
+                self._data[new_type][rel_path] = set(manifest_items)
+
+            self._path_hash[rel_path] = (file_hash, new_type)
             changed = True
 
-        self._data = new_data
-        self._path_hash = new_hashes
+        if reftests_added or reftests_removed:
+            reprocessed = self._update_reftests(reftests_added, reftests_removed, self._path_hash)
+            get_logger().debug("Reclassified %i reftest nodes" % reprocessed)
+            self._reftest_nodes_by_url = None
+
+        # Match update(), which only has entries for types with items
+        for item_type in removed_from_types:
+            if next(iter(self._data[item_type]), None) is None:
+                del self._data[item_type]
+
+        if changed:
+            self._sorted_paths = None
 
         return changed
 
-    def _compute_reftests(self, reftest_nodes):
-        self._reftest_nodes_by_url = {}
-        has_inbound = set()
-        for item in reftest_nodes:
-            for ref_url, ref_type in item.references:
-                has_inbound.add(ref_url)
-
-        reftests = defaultdict(set)
-        references = defaultdict(set)
-        changed_hashes = {}
-
-        for item in reftest_nodes:
-            if item.url in has_inbound:
-                # This is a reference
-                if isinstance(item, RefTest):
+    def _build_reftest_index(self):
+        paths_by_url = defaultdict(set)
+        inbound = defaultdict(set)
+        for item_type in ("reftest", "reftest_node"):
+            for rel_path, items in iteritems(self._data[item_type]):
+                for item in items:
+                    paths_by_url[item.url].add(rel_path)
+                    for ref_url, _ in item.references:
+                        inbound[ref_url].add(rel_path)
+        self._reftest_paths_by_url = paths_by_url
+        self._reftest_inbound = inbound
+
+    def _update_reftests(self, added, removed, hashes):
+        """Update the split between reftests and reftest nodes (i.e.
+        references that are themselves reftests) for changed files.
+
+        A node is a reference if any node links to its url, so only the
+        changed nodes, and nodes whose url was linked to from the old or new
+        version of a changed node, need to be reclassified.
+
+        :param added: Dict of path -> manifest items for new or changed reftests
+        :param removed: Set of paths of changed or deleted reftests
+        :param hashes: Dict of path -> (hash, item type), updated for any
+                       reclassified paths
+        :returns: The number of nodes that were reclassified
+        """
+        if self._reftest_inbound is None:
+            self._build_reftest_index()
+        paths_by_url = self._reftest_paths_by_url
+        inbound = self._reftest_inbound
+        type_data = [self._data["reftest"], self._data["reftest_node"]]
+
+        def pop_items(rel_path):
+            rv = set()
+            for items_by_path in type_data:
+                if rel_path in items_by_path:
+                    rv |= items_by_path[rel_path]
+                    del items_by_path[rel_path]
+            return rv
+
+        affected_urls = set()
+
+        for rel_path in removed:
+            for item in pop_items(rel_path):
+                paths_by_url[item.url].discard(rel_path)
+                for ref_url, _ in item.references:
+                    inbound[ref_url].discard(rel_path)
+                    affected_urls.add(ref_url)
+
+        to_classify = {}
+        for rel_path, items in iteritems(added):
+            to_classify[rel_path] = set(items)
+            for item in items:
+                paths_by_url[item.url].add(rel_path)
+                for ref_url, _ in item.references:
+                    inbound[ref_url].add(rel_path)
+                    affected_urls.add(ref_url)
+
+        for url in affected_urls:
+            for rel_path in paths_by_url.get(url, ()):
+                if rel_path not in to_classify:
+                    to_classify[rel_path] = pop_items(rel_path)
+
+        reftests, references = type_data
+        count = 0
+        for rel_path, items in iteritems(to_classify):
+            for item in items:
+                count += 1
+                if inbound.get(item.url):
                     item = item.to_RefTestNode()
-                    changed_hashes[item.source_file.rel_path] = (item.source_file.hash,
-                                                                 item.item_type)
-                references[item.source_file.rel_path].add(item)
-                self._reftest_nodes_by_url[item.url] = item
-            else:
-                if isinstance(item, RefTestNode):
+                    items_by_path = references
+                else:
                     item = item.to_RefTest()
-                    changed_hashes[item.source_file.rel_path] = (item.source_file.hash,
-                                                                 item.item_type)
-                reftests[item.source_file.rel_path].add(item)
+                    items_by_path = reftests
+                if rel_path not in items_by_path:
+                    items_by_path[rel_path] = set()
+                items_by_path[rel_path].add(item)
+                hashes[rel_path] = (hashes[rel_path][0], item.item_type)
 
-        return reftests, references, changed_hashes
+        return count
 
     def to_json(self):
-        out_items = {
-            test_type: {
-                from_os_path(path):
-                [t for t in sorted(test.to_json() for test in tests)]
-                for path, tests in iteritems(type_paths)
-            }
-            for test_type, type_paths in iteritems(self._data)
-        }
+        out_items = {}
+        for test_type, type_paths in iteritems(self._data):
+            if isinstance(type_paths, TypeData):
+                out_items[test_type] = type_paths.to_json()
+            else:
+                out_items[test_type] = {
+                    from_os_path(path):
+                    [t for t in sorted(test.to_json() for test in tests)]
+                    for path, tests in iteritems(type_paths)
+                }
         rv = {"url_base": self.url_base,
               "paths": {from_os_path(k): v for k, v in iteritems(self._path_hash)},
               "items": out_items,
@@ -186,33 +470,13 @@ class Manifest(object):
 
         self._path_hash = {to_os_path(k): v for k, v in iteritems(obj["paths"])}
 
-        item_classes = {"testharness": TestharnessTest,
-                        "reftest": RefTest,
-                        "reftest_node": RefTestNode,
-                        "manual": ManualTest,
-                        "stub": Stub,
-                        "wdspec": WebdriverSpecTest,
-                        "conformancechecker": ConformanceCheckerTest,
-                        "visual": VisualTest,
-                        "support": SupportFile}
-
         source_files = {}
 
         for test_type, type_paths in iteritems(obj["items"]):
             if test_type not in item_classes:
                 raise ManifestError
-            test_cls = item_classes[test_type]
-            tests = defaultdict(set)
-            for path, manifest_tests in iteritems(type_paths):
-                path = to_os_path(path)
-                for test in manifest_tests:
-                    manifest_item = test_cls.from_json(self,
-                                                       tests_root,
-                                                       path,
-                                                       test,
-                                                       source_files=source_files)
-                    tests[path].add(manifest_item)
-            self._data[test_type] = tests
+            self._data[test_type] = TypeData(self, tests_root, test_type, type_paths,
+                                             source_files)
 
         return self
 
@@ -226,6 +490,9 @@ def load(tests_root, manifest):
             logger.debug("Opening manifest at %s" % manifest)
         else:
             logger.debug("Creating new manifest at %s" % manifest)
+        from . import manifestdb
+        if manifestdb.is_db(manifest):
+            return manifestdb.load(tests_root, manifest)
         try:
             with open(manifest) as f:
                 rv = Manifest.from_json(tests_root, json.load(f))
@@ -237,9 +504,19 @@ def load(tests_root, manifest):
 
 
 def write(manifest, manifest_path):
+    if os.path.splitext(manifest_path)[1] == ".db":
+        from . import manifestdb
+        return manifestdb.write(manifest, manifest_path)
+
     dir_name = os.path.dirname(manifest_path)
     if not os.path.exists(dir_name):
         os.makedirs(dir_name)
-    with open(manifest_path, "wb") as f:
+    # Write to a temporary file first so that anything reading the manifest
+    # while it is being updated never sees a partially written file
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "wb") as f:
         json.dump(manifest.to_json(), f, sort_keys=True, indent=1, separators=(',', ': '))
         f.write("\n")
+    if os.name == "nt" and os.path.exists(manifest_path):
+        os.unlink(manifest_path)
+    os.rename(tmp_path, manifest_path)
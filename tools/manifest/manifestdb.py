@@ -0,0 +1,183 @@
+"""Storage of manifests in a SQLite database.
+
+A JSON manifest has to be parsed in full before a single test can be looked
+up. This stores the same data in a database indexed on (item type, path), so
+that loading a manifest only reads the items that are actually accessed."""
+
+import argparse
+import json
+import os
+import sqlite3
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from six import iteritems
+
+from . import manifest
+from .log import get_logger
+
+here = os.path.dirname(__file__)
+
+wpt_root = os.path.abspath(os.path.join(here, os.pardir, os.pardir))
+
+MAGIC = b"SQLite format 3\0"
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE paths (path TEXT PRIMARY KEY, hash TEXT NOT NULL, type TEXT);
+CREATE TABLE items (type TEXT NOT NULL, path TEXT NOT NULL, data TEXT NOT NULL,
+                    PRIMARY KEY (type, path));
+"""
+
+
+def is_db(path):
+    """Check if the file at path is a SQLite database"""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+class ItemsJSON(Mapping):
+    """Mapping of path -> serialized manifest items of a single type, read
+    from the database as each path is accessed"""
+
+    def __init__(self, conn, item_type):
+        self.conn = conn
+        self.item_type = item_type
+
+    def __getitem__(self, path):
+        row = self.conn.execute("SELECT data FROM items WHERE type = ? AND path = ?",
+                                (self.item_type, path)).fetchone()
+        if row is None:
+            raise KeyError(path)
+        return json.loads(row[0])
+
+    def __contains__(self, path):
+        row = self.conn.execute("SELECT 1 FROM items WHERE type = ? AND path = ?",
+                                (self.item_type, path)).fetchone()
+        return row is not None
+
+    def __iter__(self):
+        for row in self.conn.execute("SELECT path FROM items WHERE type = ?",
+                                     (self.item_type,)):
+            yield row[0]
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM items WHERE type = ?",
+                                 (self.item_type,)).fetchone()[0]
+
+    def iteritems(self):
+        for path, data in self.conn.execute("SELECT path, data FROM items WHERE type = ?",
+                                            (self.item_type,)):
+            yield path, json.loads(data)
+
+    items = iteritems
+
+
+def load(tests_root, path):
+    """Load a Manifest from the database at path. The database is kept open
+    for as long as the manifest has items that haven't been read."""
+    conn = sqlite3.connect(path)
+    meta = dict(conn.execute("SELECT key, value FROM meta"))
+    version = int(meta["version"])
+    if version != manifest.CURRENT_VERSION:
+        conn.close()
+        raise manifest.ManifestVersionMismatch
+    obj = {
+        "version": version,
+        "url_base": meta["url_base"],
+        "paths": {rel_path: (file_hash, item_type) for rel_path, file_hash, item_type in
+                  conn.execute("SELECT path, hash, type FROM paths")},
+        "items": {item_type: ItemsJSON(conn, item_type)
+                  for item_type in json.loads(meta["item_types"])}
+    }
+    return manifest.Manifest.from_json(tests_root, obj)
+
+
+def write(manifest_obj, path):
+    """Write a Manifest to a database at path, replacing any existing file"""
+    data = manifest_obj.to_json()
+
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+
+    # Write to a temporary file first since a lazily loaded manifest may still
+    # be reading from the existing database.
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        with conn:
+            conn.executescript(SCHEMA)
+            conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                             [("version", str(data["version"])),
+                              ("url_base", data["url_base"]),
+                              ("item_types", json.dumps(sorted(data["items"].keys())))])
+            conn.executemany("INSERT INTO paths VALUES (?, ?, ?)",
+                             ((rel_path, file_hash, item_type)
+                              for rel_path, (file_hash, item_type) in iteritems(data["paths"])))
+            conn.executemany("INSERT INTO items VALUES (?, ?, ?)",
+                             ((item_type, rel_path, json.dumps(tests, separators=(',', ':')))
+                              for item_type, type_paths in iteritems(data["items"])
+                              for rel_path, tests in iteritems(type_paths)))
+    finally:
+        conn.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    os.rename(tmp_path, path)
+
+
+def convert(src, dest, tests_root=wpt_root, to_db=None):
+    """Convert a manifest between the JSON and database formats.
+
+    :param src: Path to the existing manifest
+    :param dest: Path to write the converted manifest to
+    :param tests_root: Path to the root of the source tree
+    :param to_db: True to write a database, False to write JSON, or None to
+                  write the opposite format to src.
+    """
+    src_is_db = is_db(src)
+    if to_db is None:
+        to_db = not src_is_db
+
+    logger = get_logger()
+    logger.info("Converting %s to %s" % (src, dest))
+
+    src_manifest = manifest.load(tests_root, src)
+    if src_manifest is None:
+        raise manifest.ManifestError("Failed to load manifest %s" % src)
+
+    if to_db:
+        write(src_manifest, dest)
+    else:
+        manifest.write(src_manifest, dest)
+
+
+def abs_path(path):
+    return os.path.abspath(os.path.expanduser(path))
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("src", type=abs_path, help="Path to the manifest to convert.")
+    parser.add_argument("dest", type=abs_path, help="Path to write the converted manifest to.")
+    parser.add_argument(
+        "--tests-root", type=abs_path, default=wpt_root, help="Path to root of tests.")
+    parser.add_argument(
+        "--format", action="store", choices=["json", "sqlite"], default=None,
+        help="Format to convert to (default: the opposite of the source format).")
+    return parser
+
+
+def run(**kwargs):
+    to_db = None
+    if kwargs["format"] is not None:
+        to_db = kwargs["format"] == "sqlite"
+    convert(kwargs["src"], kwargs["dest"], tests_root=kwargs["tests_root"], to_db=to_db)
@@ -0,0 +1,275 @@
+"""Fast extraction of test metadata from HTML files.
+
+Building the manifest only needs a handful of <meta>, <link> and <script>
+elements from each HTML file, but parsing the file with html5lib in full is
+by far the most expensive part of an update. This scans the raw bytes
+following the tokenizer rules just far enough to find tags, comments and
+raw text correctly. Anything the scanner can't be sure it handles the same
+way as a full parse (foreign content, entities in attribute values,
+unusual encodings, ...) makes it give up so that the caller falls back to
+html5lib."""
+
+import codecs
+import re
+
+from six import iteritems
+
+start_tag_re = re.compile(
+    br"<(/?)([a-zA-Z][^\t\n\f\r />]*)"
+    br"((?:[\t\n\f\r /]*"
+    br"[^\t\n\f\r />][^\t\n\f\r /=>]*(?![^\t\n\f\r /=>])"
+    br"(?:[\t\n\f\r ]*=[\t\n\f\r ]*"
+    br"(?:\"[^\"]*\"|'[^']*'|(?:[^\t\n\f\r >\"'][^\t\n\f\r >]*)?(?![^\t\n\f\r >]))"
+    br"|(?![\t\n\f\r ]*=)))*)"
+    br"[\t\n\f\r /]*>")
+
+attr_re = re.compile(
+    br"([^\t\n\f\r />][^\t\n\f\r /=>]*)"
+    br"(?:[\t\n\f\r ]*=[\t\n\f\r ]*"
+    br"(?:\"([^\"]*)\"|'([^']*)'|((?:[^\t\n\f\r >\"'][^\t\n\f\r >]*)?)))?")
+
+# Start tags that could still change the result once the scan has stopped
+relevant_tag_re = re.compile(br"<(?:meta|link|script|frameset)(?![^\t\n\f\r />])", re.I)
+
+charset_re = re.compile(br"charset[\t\n\f\r ]*=[\t\n\f\r ]*[\"']?([^\t\n\f\r \"';>]*)", re.I)
+
+# Bytes whose meaning must not change when the file is decoded for the
+# result of the scan to be valid
+ascii_probe = b"<>/=\"'&!?-+ abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+raw_text_end_res = {name: re.compile(br"</%s(?=[\t\n\f\r />])" % name, re.I)
+                    for name in [b"script", b"style", b"xmp", b"iframe", b"noembed",
+                                 b"noframes", b"title", b"textarea"]}
+
+# Start tags that put the tree builder in a mode where later elements may be
+# ignored, created in another namespace, or parsed differently
+unsafe_tags = frozenset([b"svg", b"math", b"select", b"noscript"])
+
+meta_kinds = {u"timeout": "timeout",
+              u"viewport-size": "viewport",
+              u"device-pixel-ratio": "dpi",
+              u"fuzzy": "fuzzy",
+              u"variant": "variant",
+              u"flags": "css_flag"}
+
+link_kinds = {u"match": "reftest_match",
+              u"mismatch": "reftest_mismatch",
+              u"help": "spec_link"}
+
+# Kinds where the order of the elements found affects the manifest
+ordered_kinds = ("timeout", "viewport", "dpi", "fuzzy", "variant", "reftest_match",
+                 "reftest_mismatch")
+
+kinds = ("timeout", "viewport", "dpi", "fuzzy", "testharness", "variant",
+         "reftest_match", "reftest_mismatch", "css_flag", "spec_link")
+
+
+class ScannedElement(object):
+    """Element found by the scanner, exposing the same tag and attrib
+    as the corresponding html5lib ElementTree Element"""
+    __slots__ = ("tag", "attrib")
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+
+    def __repr__(self):
+        return "<ScannedElement %s %r>" % (self.tag, self.attrib)
+
+
+class Ambiguous(Exception):
+    """The scanner can't produce the same result as a full parse"""
+    pass
+
+
+def compatible_encoding(data):
+    """Check that any encoding declared in data leaves ASCII unchanged"""
+    for m in charset_re.finditer(data):
+        try:
+            name = m.group(1).decode("ascii")
+            codecs.lookup(name)
+        except (UnicodeError, LookupError):
+            # Unknown encodings are ignored by the parser
+            continue
+        try:
+            if ascii_probe.decode(name) != ascii_probe.decode("ascii"):
+                return False
+        except (UnicodeDecodeError, LookupError, TypeError):
+            return False
+    return True
+
+
+def parse_attrs(data):
+    """Parse the attributes part of a start tag into a dict, keeping the
+    first value of any repeated attribute like the tokenizer does"""
+    attrib = {}
+    for m in attr_re.finditer(data):
+        name = m.group(1)
+        if b"\0" in name or b"\r" in name:
+            raise Ambiguous
+        try:
+            name = name.lower().decode("ascii")
+        except UnicodeDecodeError:
+            # Not one of the attributes we care about
+            continue
+        if name in attrib:
+            continue
+        value = m.group(2)
+        if value is None:
+            value = m.group(3)
+        if value is None:
+            value = m.group(4)
+        if value is None:
+            value = b""
+        if b"&" in value or b"\0" in value or b"\r" in value:
+            raise Ambiguous
+        try:
+            attrib[name] = value.decode("ascii")
+        except UnicodeDecodeError:
+            raise Ambiguous
+    return attrib
+
+
+def check_rest(data, pos):
+    """Raise Ambiguous unless nothing after pos could be a relevant element,
+    in which case the scan can stop early with the elements found so far"""
+    if relevant_tag_re.search(data, pos):
+        raise Ambiguous
+
+
+def _scan(data, found, positions):
+    end = len(data)
+    pos = 0
+    table_pos = None
+
+    while True:
+        pos = data.find(b"<", pos)
+        if pos == -1:
+            break
+        next_char = data[pos + 1:pos + 2]
+
+        if next_char == b"!":
+            if data.startswith(b"<!--", pos):
+                if data.startswith(b"<!-->", pos):
+                    pos += 5
+                    continue
+                if data.startswith(b"<!--->", pos):
+                    pos += 6
+                    continue
+                candidates = [i for i in (data.find(b"-->", pos + 4),
+                                          data.find(b"--!>", pos + 4)) if i != -1]
+                if not candidates:
+                    break
+                pos = min(candidates) + 3
+                if data[pos:pos + 1] == b">":
+                    pos += 1
+                continue
+            # Doctype, CDATA section in HTML content, or bogus comment
+            pos = data.find(b">", pos + 2)
+            if pos == -1:
+                break
+            continue
+
+        if next_char == b"?":
+            pos = data.find(b">", pos + 2)
+            if pos == -1:
+                break
+            continue
+
+        m = start_tag_re.match(data, pos)
+        if m is None:
+            if next_char == b"/":
+                after = data[pos + 2:pos + 3]
+                if after == b">":
+                    pos += 3
+                    continue
+                if after.isalpha():
+                    # EOF in end tag
+                    check_rest(data, pos)
+                    break
+                if after:
+                    # Bogus comment
+                    pos = data.find(b">", pos + 2)
+                    if pos == -1:
+                        break
+                    continue
+            elif next_char.isalpha():
+                # EOF in tag
+                check_rest(data, pos)
+                break
+            pos += 1
+            continue
+
+        is_end, name, attrs = m.groups()
+        tag_pos = pos
+        pos = m.end()
+        if is_end:
+            continue
+
+        name = name.lower()
+        if name == b"meta" or name == b"link" or name == b"script":
+            attrib = parse_attrs(attrs)
+            kind = None
+            if name == b"meta":
+                kind = meta_kinds.get(attrib.get(u"name"))
+            elif name == b"link":
+                kind = link_kinds.get(attrib.get(u"rel"))
+            elif attrib.get(u"src") == u"/resources/testharness.js":
+                kind = "testharness"
+            if kind is not None:
+                found[kind].append(ScannedElement(name.decode("ascii"), attrib))
+                positions[kind].append(tag_pos)
+
+        if name in raw_text_end_res:
+            end_match = raw_text_end_res[name].search(data, pos)
+            content_end = end_match.start() if end_match else end
+            if name == b"script" and data.find(b"<!--", pos, content_end) != -1:
+                # Script data escape states
+                check_rest(data, pos)
+                break
+            pos = content_end
+        elif name == b"plaintext":
+            break
+        elif name == b"frameset":
+            # May remove the body along with any elements already found
+            raise Ambiguous
+        elif name in unsafe_tags:
+            check_rest(data, pos)
+            break
+        elif name == b"table" and table_pos is None:
+            # Elements in tables may be foster parented out of document order
+            table_pos = tag_pos
+
+    if table_pos is not None:
+        for kind in ordered_kinds:
+            if len(positions[kind]) > 1 and positions[kind][-1] > table_pos:
+                raise Ambiguous
+
+
+def scan(data):
+    """Find the elements in HTML content that carry test metadata.
+
+    :param data: The bytes of an HTML file
+    :returns: A dict mapping each of the metadata kinds "timeout", "viewport",
+              "dpi", "fuzzy", "testharness", "variant", "reftest", "css_flag" and
+              "spec_link" to a list of elements with tag and attrib
+              properties, in the same order as ElementTree's findall on the
+              full parse, or None if the content has to be fully parsed to
+              get the correct result.
+    """
+    if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return None
+    if b"\x1b" in data or not compatible_encoding(data):
+        return None
+
+    found = {kind: [] for kind in kinds}
+    positions = {kind: [] for kind in kinds}
+    try:
+        _scan(data, found, positions)
+    except Ambiguous:
+        return None
+
+    rv = {kind: elements for kind, elements in iteritems(found)
+          if not kind.startswith("reftest_")}
+    rv["reftest"] = found["reftest_match"] + found["reftest_mismatch"]
+    return rv
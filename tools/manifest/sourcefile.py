@@ -11,7 +11,7 @@ except ImportError:
 
 import html5lib
 
-from . import XMLParser
+from . import XMLParser, metascan
 from .item import Stub, ManualTest, WebdriverSpecTest, RefTestNode, RefTest, TestharnessTest, SupportFile, ConformanceCheckerTest, VisualTest
 from .utils import rel_path_to_url, ContextManagerBytesIO, cached_property
 
@@ -66,13 +66,14 @@ class SourceFile(object):
                          ("css", "common"),
                          ("css", "work-in-progress")}
 
-    def __init__(self, tests_root, rel_path, url_base, contents=None):
+    def __init__(self, tests_root, rel_path, url_base, contents=None, hash=None):
         """Object representing a file in a source tree.
 
         :param tests_root: Path to the root of the source tree
         :param rel_path: File path relative to tests_root
         :param url_base: Base URL used when converting file paths to urls
         :param contents: Byte array of the contents of the file or ``None``.
+        :param hash: Previously computed hash of the file contents or ``None``.
         """
 
         self.tests_root = tests_root
@@ -86,6 +87,10 @@ class SourceFile(object):
             self.rel_path = rel_path
         self.url_base = url_base
         self.contents = contents
+        if hash is not None:
+            # Bypass the cached property so that the file is never read just
+            # to compute its hash.
+            self.__dict__["hash"] = hash
 
         self.dir_path, self.filename = os.path.split(self.rel_path)
         self.name, self.ext = os.path.splitext(self.filename)
@@ -146,8 +151,13 @@ class SourceFile(object):
 
     @cached_property
     def hash(self):
+        """The SHA-1 of the file contents, computed in the same way as a git
+        blob id so that hashes can be taken from git without reading the file."""
         with self.open() as f:
-            return hashlib.sha1(f.read()).hexdigest()
+            content = f.read()
+        rv = hashlib.sha1(b"blob %d\0" % len(content))
+        rv.update(content)
+        return rv.hexdigest()
 
     def in_non_test_dir(self):
         if self.dir_path == "":
@@ -278,6 +288,29 @@ class SourceFile(object):
 
         return root
 
+    @cached_property
+    def metadata_scan(self):
+        """Dict of metadata kind -> list of elements found by scanning an HTML
+        file without fully parsing it, or None if the file isn't HTML or needs
+        a full parse to get the metadata right"""
+        if self.markup_type != "html":
+            return None
+
+        with self.open() as f:
+            return metascan.scan(f.read())
+
+    def metadata_nodes(self, kind):
+        """List of elements for a kind of metadata, equivalent to the
+        corresponding <kind>_nodes property, or None if the file doesn't
+        contain markup. The full parse is avoided whenever possible."""
+        if self.metadata_scan is not None:
+            return self.metadata_scan[kind]
+
+        if self.root is None:
+            return None
+
+        return getattr(self, kind + "_nodes")
+
     @cached_property
     def timeout_nodes(self):
         """List of ElementTree Elements corresponding to nodes in a test that
@@ -304,11 +337,9 @@ class SourceFile(object):
             if any(m == (b"timeout", b"long") for m in self.script_metadata):
                 return "long"
 
-        if self.root is None:
-            return None
-
-        if self.timeout_nodes:
-            timeout_str = self.timeout_nodes[0].attrib.get("content", None)
+        timeout_nodes = self.metadata_nodes("timeout")
+        if timeout_nodes:
+            timeout_str = timeout_nodes[0].attrib.get("content", None)
             if timeout_str and timeout_str.lower() == "long":
                 return "long"
 
@@ -323,13 +354,11 @@ class SourceFile(object):
     @cached_property
     def viewport_size(self):
         """The viewport size of a test or reference file"""
-        if self.root is None:
-            return None
-
-        if not self.viewport_nodes:
+        viewport_nodes = self.metadata_nodes("viewport")
+        if not viewport_nodes:
             return None
 
-        return self.viewport_nodes[0].attrib.get("content", None)
+        return viewport_nodes[0].attrib.get("content", None)
 
     @cached_property
     def dpi_nodes(self):
@@ -340,13 +369,27 @@ class SourceFile(object):
     @cached_property
     def dpi(self):
         """The device pixel ratio of a test or reference file"""
-        if self.root is None:
+        dpi_nodes = self.metadata_nodes("dpi")
+        if not dpi_nodes:
             return None
 
-        if not self.dpi_nodes:
+        return dpi_nodes[0].attrib.get("content", None)
+
+    @cached_property
+    def fuzzy_nodes(self):
+        """List of ElementTree Elements corresponding to nodes in a test that
+        specify reftest fuzziness"""
+        return self.root.findall(".//{http://www.w3.org/1999/xhtml}meta[@name='fuzzy']")
+
+    @cached_property
+    def fuzzy(self):
+        """The fuzziness allowed when comparing a reftest with its
+        references, or None for an exact comparison"""
+        fuzzy_nodes = self.metadata_nodes("fuzzy")
+        if not fuzzy_nodes:
             return None
 
-        return self.dpi_nodes[0].attrib.get("content", None)
+        return fuzzy_nodes[0].attrib.get("content", None)
 
     @cached_property
     def testharness_nodes(self):
@@ -358,9 +401,10 @@ class SourceFile(object):
     def content_is_testharness(self):
         """Boolean indicating whether the file content represents a
         testharness.js test"""
-        if self.root is None:
+        testharness_nodes = self.metadata_nodes("testharness")
+        if testharness_nodes is None:
             return None
-        return bool(self.testharness_nodes)
+        return bool(testharness_nodes)
 
     @cached_property
     def variant_nodes(self):
@@ -371,7 +415,7 @@ class SourceFile(object):
     @cached_property
     def test_variants(self):
         rv = []
-        for element in self.variant_nodes:
+        for element in self.metadata_nodes("variant") or []:
             if "content" in element.attrib:
                 variant = element.attrib["content"]
                 assert variant == "" or variant[0] in ["#", "?"]
@@ -399,7 +443,7 @@ class SourceFile(object):
         the file"""
         rv = []
         rel_map = {"match": "==", "mismatch": "!="}
-        for item in self.reftest_nodes:
+        for item in self.metadata_nodes("reftest") or []:
             if "href" in item.attrib:
                 ref_url = urljoin(self.url, item.attrib["href"].strip(space_chars))
                 ref_type = rel_map[item.attrib["rel"]]
@@ -424,7 +468,7 @@ class SourceFile(object):
     def css_flags(self):
         """Set of flags specified in the file"""
         rv = set()
-        for item in self.css_flag_nodes:
+        for item in self.metadata_nodes("css_flag") or []:
             if "content" in item.attrib:
                 for flag in item.attrib["content"].split():
                     rv.add(flag)
@@ -434,7 +478,7 @@ class SourceFile(object):
     def content_is_css_manual(self):
         """Boolean indicating whether the file content represents a
         CSS WG-style manual test"""
-        if self.root is None:
+        if self.metadata_nodes("css_flag") is None:
             return None
         # return True if the intersection between the two sets is non-empty
         return bool(self.css_flags & {"animated", "font", "history", "interact", "paged", "speech", "userstyle"})
@@ -451,7 +495,7 @@ class SourceFile(object):
     def spec_links(self):
         """Set of spec links specified in the file"""
         rv = set()
-        for item in self.spec_link_nodes:
+        for item in self.metadata_nodes("spec_link") or []:
             if "href" in item.attrib:
                 rv.add(item.attrib["href"].strip(space_chars))
         return rv
@@ -460,7 +504,7 @@ class SourceFile(object):
     def content_is_css_visual(self):
         """Boolean indicating whether the file content represents a
         CSS WG-style manual test"""
-        if self.root is None:
+        if self.metadata_nodes("spec_link") is None:
             return None
         return bool(self.ext in {'.xht', '.html', '.xhtml', '.htm', '.xml', '.svg'} and
                     self.spec_links)
@@ -530,7 +574,8 @@ class SourceFile(object):
         elif self.content_is_ref_node:
             rv = (RefTestNode.item_type,
                   [RefTestNode(self, self.url, self.references, timeout=self.timeout,
-                               viewport_size=self.viewport_size, dpi=self.dpi)])
+                               viewport_size=self.viewport_size, dpi=self.dpi,
+                               fuzzy=self.fuzzy)])
 
         elif self.content_is_css_visual and not self.name_is_reference:
             rv = VisualTest.item_type, [VisualTest(self, self.url)]
@@ -1,5 +1,7 @@
+import logging
 import platform
 import os
+import random
 
 import mock
 
@@ -111,7 +113,7 @@ def test_manifest_to_json_forwardslash():
         'paths': {
             'a/b': ('0000000000000000000000000000000000000000', 'testharness')
         },
-        'version': 4,
+        'version': 5,
         'url_base': '/',
         'items': {
             'reftest': {},
@@ -135,7 +137,7 @@ def test_manifest_to_json_backslash():
             'paths': {
                 'a/b': ('0000000000000000000000000000000000000000', 'testharness')
             },
-            'version': 4,
+            'version': 5,
             'url_base': '/',
             'items': {
                 'reftest': {},
@@ -158,7 +160,7 @@ def test_manifest_from_json_backslash():
         'paths': {
             'a\\b': ('0000000000000000000000000000000000000000', 'testharness')
         },
-        'version': 4,
+        'version': 5,
         'url_base': '/',
         'items': {
             'reftest': {},
@@ -232,6 +234,92 @@ def test_reftest_computation_chain_update_remove():
     assert list(m) == [("reftest", test2.path, {test2})]
 
 
+def test_reftest_computation_incremental(caplog):
+    m = manifest.Manifest()
+
+    sources = [SourceFileWithTest("test%i" % i, "0"*40, item.RefTest, [("/test%i-ref" % i, "==")])
+               for i in range(10)]
+    sources.append(SourceFileWithTest("test9-ref", "0"*40, item.RefTest, [("/test9-ref-ref", "==")]))
+    assert m.update(sources) is True
+
+    sources[0] = SourceFileWithTest("test0", "1"*40, item.RefTest, [("/test0-ref", "!=")])
+    with caplog.at_level(logging.DEBUG, logger="manifest"):
+        assert m.update(sources) is True
+    assert "Reclassified 1 reftest nodes" in caplog.text
+
+    caplog.clear()
+    # Removing test9 turns test9-ref from a reference into a test
+    del sources[9]
+    with caplog.at_level(logging.DEBUG, logger="manifest"):
+        assert m.update(sources) is True
+    assert "Reclassified 1 reftest nodes" in caplog.text
+    assert [item_type for item_type, path, _ in m if path == "test9-ref"] == ["reftest"]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_reftest_computation_incremental_random(seed):
+    rng = random.Random(seed)
+    urls = ["/test%i" % i for i in range(15)]
+
+    def random_source(path, version):
+        refs = [(rng.choice(urls), rng.choice(["==", "!="]))
+                for _ in range(rng.randint(1, 2))]
+        return SourceFileWithTest(path, "%040x" % version, item.RefTest, refs)
+
+    version = 0
+    sources = {}
+    m = manifest.Manifest()
+    for _ in range(20):
+        for path in rng.sample([url[1:] for url in urls], 4):
+            version += 1
+            if path in sources and rng.random() < 0.3:
+                del sources[path]
+            else:
+                sources[path] = random_source(path, version)
+        m.update(sources.values())
+
+        expected = manifest.Manifest()
+        expected.update(sources.values())
+        assert list(m) == list(expected)
+        assert m.to_json() == expected.to_json()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_update_paths_random(seed):
+    rng = random.Random(seed)
+    urls = ["/test%i" % i for i in range(15)]
+
+    def random_source(path, version):
+        if rng.random() < 0.3:
+            return SourceFileWithTest(path, "%040x" % version, item.TestharnessTest)
+        refs = [(rng.choice(urls), rng.choice(["==", "!="]))
+                for _ in range(rng.randint(1, 2))]
+        return SourceFileWithTest(path, "%040x" % version, item.RefTest, refs)
+
+    version = 0
+    sources = {}
+    m = manifest.Manifest()
+    for _ in range(20):
+        changed = []
+        removed = []
+        for path in rng.sample([url[1:] for url in urls], 4):
+            version += 1
+            if path in sources and rng.random() < 0.3:
+                del sources[path]
+                removed.append(path)
+            else:
+                sources[path] = random_source(path, version)
+                changed.append(sources[path])
+        assert m.update_paths(changed, removed=removed) is True
+
+        expected = manifest.Manifest()
+        expected.update(sources.values())
+        assert list(m) == list(expected)
+        assert m.to_json() == expected.to_json()
+
+    assert m.update_paths(list(sources.values())[:3]) is False
+
+
 def test_iterpath():
     m = manifest.Manifest()
 
@@ -246,3 +334,99 @@ def test_iterpath():
                                                                  "/test2-1.html",
                                                                  "/test2-2.html"])
     assert set(m.iterpath("missing")) == set()
+
+
+def test_iterdir():
+    m = manifest.Manifest()
+
+    sources = [SourceFileWithTest(os.path.join("a", "test1"), "0"*40, item.TestharnessTest),
+               SourceFileWithTest(os.path.join("a", "b", "test2"), "0"*40, item.RefTest,
+                                  [("/a/b/test2-ref", "==")]),
+               SourceFileWithTest(os.path.join("ab", "test3"), "0"*40, item.TestharnessTest),
+               SourceFileWithTest("test4", "0"*40, item.TestharnessTest)]
+    assert m.update(sources) is True
+
+    assert set(test.url for test in m.iterdir("a")) == {"/a/test1", "/a/b/test2"}
+    assert set(test.url for test in m.iterdir(os.path.join("a", "b"))) == {"/a/b/test2"}
+    assert set(test.url for test in m.iterprefix("a")) == {"/a/test1", "/a/b/test2", "/ab/test3"}
+    assert set(m.iterdir("missing")) == set()
+
+    # The index must follow paths added by a later update
+    sources.append(SourceFileWithTest(os.path.join("a", "test5"), "0"*40, item.TestharnessTest))
+    assert m.update(sources) is True
+    assert set(test.url for test in m.iterdir("a")) == {"/a/test1", "/a/b/test2", "/a/test5"}
+
+    loaded = manifest.Manifest.from_json("/", m.to_json())
+    assert set(test.url for test in loaded.iterdir("a")) == {"/a/test1", "/a/b/test2", "/a/test5"}
+
+
+def test_update_parallel():
+    def source_files():
+        contents = {
+            "a/test.html": b"<script src=/resources/testharness.js></script>",
+            "a/reftest.html": b"<link rel=match href=reftest-ref.html>",
+            "a/reftest-ref.html": b"<link rel=mismatch href=other-ref.html>",
+            "a/other-ref.html": b"",
+            "b/support.js": b"",
+        }
+        return [sourcefile.SourceFile("/", path, "/", contents=data)
+                for path, data in sorted(contents.items())]
+
+    m_serial = manifest.Manifest()
+    assert m_serial.update(source_files()) is True
+
+    m_parallel = manifest.Manifest()
+    assert m_parallel.update(source_files(), jobs=2) is True
+
+    assert m_parallel.to_json() == m_serial.to_json()
+    assert [item.url for item in m_parallel.iterpath("a/reftest-ref.html")] == ["/a/reftest-ref.html"]
+
+    assert m_parallel.update(source_files(), jobs=2) is False
+    assert m_parallel.to_json() == m_serial.to_json()
+
+
+def test_from_json_lazy():
+    m = manifest.Manifest()
+    sources = [SourceFileWithTest("test1", "0"*40, item.TestharnessTest),
+               SourceFileWithTest("test2", "1"*40, item.TestharnessTest),
+               SourceFileWithTest("test3", "2"*40, item.RefTest, [("/test1", "==")])]
+    m.update(sources)
+    json_data = m.to_json()
+
+    loaded = manifest.Manifest.from_json("/", json_data)
+    assert all(not type_data.data for type_data in loaded._data.values())
+
+    assert [test.url for test in loaded.iterpath("test2")] == ["/test2"]
+    assert set(loaded._data["testharness"].data.keys()) == {"test2"}
+
+    assert loaded.to_json() == json_data
+    assert list(loaded) == list(m)
+
+
+def test_update_lazy():
+    m = manifest.Manifest()
+    sources = [SourceFileWithTest("test1", "0"*40, item.TestharnessTest),
+               SourceFileWithTest("test2", "1"*40, item.TestharnessTest),
+               SourceFileWithTest("test3", "2"*40, item.ManualTest)]
+    m.update(sources)
+    json_data = m.to_json()
+
+    loaded = manifest.Manifest.from_json("/", json_data)
+    assert loaded.update(sources) is False
+    assert all(not type_data.data for type_data in loaded._data.values()
+               if isinstance(type_data, manifest.TypeData))
+    assert loaded.to_json() == json_data
+
+    changed = [SourceFileWithTest("test1", "3"*40, item.TestharnessTest), sources[1]]
+    assert loaded.update(changed) is True
+    assert set(loaded._data["testharness"].data.keys()) == {"test1"}
+    assert "manual" not in loaded._data
+    assert [test.url for _, _, tests in loaded for test in tests] == ["/test1", "/test2"]
+
+
+def test_manifest_from_json_old_version():
+    json_obj = manifest.Manifest().to_json()
+    json_obj["version"] = 4
+
+    with pytest.raises(manifest.ManifestVersionMismatch):
+        manifest.Manifest.from_json("/", json_obj)
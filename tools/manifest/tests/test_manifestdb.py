@@ -0,0 +1,77 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from .. import item, manifest, manifestdb, sourcefile
+
+
+def create_manifest():
+    contents = {
+        "a/test.html": b"<meta name=timeout content=long><script src=/resources/testharness.js></script>",
+        "a/reftest.html": b"<link rel=match href=reftest-ref.html>",
+        "a/reftest-ref.html": b"",
+        "b/support.js": b"",
+    }
+    m = manifest.Manifest()
+    m.update(sourcefile.SourceFile("/", path, "/", contents=data)
+             for path, data in sorted(contents.items()))
+    return m
+
+
+def test_roundtrip(tmpdir):
+    m = create_manifest()
+    db_path = str(tmpdir.join("MANIFEST.db"))
+
+    manifest.write(m, db_path)
+    assert manifestdb.is_db(db_path)
+
+    loaded = manifest.load("/", db_path)
+    # The database holds JSON, so tuples become lists
+    assert json.dumps(loaded.to_json(), sort_keys=True) == json.dumps(m.to_json(), sort_keys=True)
+    assert list(loaded) == list(m)
+
+
+def test_lazy_load(tmpdir):
+    db_path = str(tmpdir.join("MANIFEST.db"))
+    manifestdb.write(create_manifest(), db_path)
+
+    loaded = manifestdb.load("/", db_path)
+    assert all(not type_data.data for type_data in loaded._data.values())
+
+    tests = list(loaded.iterpath(os.path.join("a", "test.html")))
+    assert [(test.url, test.timeout) for test in tests] == [("/a/test.html", "long")]
+    assert list(loaded._data["testharness"].data.keys()) == [os.path.join("a", "test.html")]
+    assert not loaded._data["reftest"].data
+
+    assert list(loaded.iterpath("missing")) == []
+
+
+def test_convert(tmpdir):
+    m = create_manifest()
+    json_path = str(tmpdir.join("MANIFEST.json"))
+    db_path = str(tmpdir.join("MANIFEST.db"))
+    roundtrip_path = str(tmpdir.join("roundtrip.json"))
+    manifest.write(m, json_path)
+
+    manifestdb.convert(json_path, db_path, tests_root="/")
+    assert manifestdb.is_db(db_path)
+    manifestdb.convert(db_path, roundtrip_path, tests_root="/")
+    assert not manifestdb.is_db(roundtrip_path)
+
+    with open(json_path) as expected, open(roundtrip_path) as actual:
+        assert actual.read() == expected.read()
+
+
+def test_load_old_version(tmpdir):
+    db_path = str(tmpdir.join("MANIFEST.db"))
+    manifestdb.write(create_manifest(), db_path)
+
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("UPDATE meta SET value = ? WHERE key = ?", ("4", "version"))
+    conn.close()
+
+    with pytest.raises(manifest.ManifestVersionMismatch):
+        manifest.load("/", db_path)
@@ -472,6 +472,16 @@ def test_reftest_node(ext):
     assert items(s) == [("reftest_node", "/" + filename)]
 
 
+def test_reftest_fuzzy():
+    content = b"<link rel=match href=ref.html><meta name=fuzzy content='maxDifference=1-2;totalPixels=0-300'>"
+    s = create("foo/test.html", content)
+
+    assert s.fuzzy == "maxDifference=1-2;totalPixels=0-300"
+    item_type, [item] = s.manifest_items()
+    assert item.fuzzy == s.fuzzy
+    assert item.to_json()[2] == {"fuzzy": s.fuzzy}
+
+
 @pytest.mark.parametrize("ext", ["xht", "html", "xhtml", "htm", "xml", "svg"])
 def test_css_visual(ext):
     content = b"""
@@ -562,3 +572,75 @@ def test_spec_links_whitespace(url):
     content = b"<link rel=help href='%s'>" % url
     s = create("foo/test.html", content)
     assert s.spec_links == {"http://example.com/"}
+
+
+@pytest.mark.parametrize("content,expected", [
+    (b"", "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391"),
+    (b"hello\n", "ce013625030ba8dba906f756967f9e9ca394464a"),
+])
+def test_hash_is_git_blob_id(content, expected):
+    s = create("foo/bar.html", content)
+    assert s.hash == expected
+
+
+def test_hash_precomputed():
+    s = SourceFile("/", "foo/bar.html", "/", hash="0" * 40)
+    assert s.hash == "0" * 40
+
+
+metadata_kinds = ["timeout", "viewport", "dpi", "fuzzy", "testharness", "variant", "reftest",
+                  "css_flag", "spec_link"]
+
+
+@pytest.mark.parametrize("content", [
+    b"<meta name=timeout content=long><link rel=match href=a.html><link rel=help href=b>",
+    b"<META NAME=timeout CONTENT=long name=variant><LINK REL=mismatch href='b.html'>",
+    b"<meta/name=variant/content=?a><meta name='variant' content=\"#b\">",
+    b"<link rel=mismatch href=a.html><link rel=match href=b.html>",
+    b"<script src=/resources/testharness.js></script><script src=/resources/testharnessreport.js></script>",
+    b"<!-- <meta name=timeout content=long> --><meta name=flags content='ahem paged'>",
+    b"<!--><meta name=timeout content=long><!--->--!><meta name='viewport-size' content=300x300>",
+    b"<script>var s = '<meta name=timeout content=long>';</script ><meta name=device-pixel-ratio content=2>",
+    b"<meta name=fuzzy content='0-2;0-300'><link rel=match href=a.html><meta name=fuzzy content=1;1>",
+    b"<title><link rel=match href=a.html></title><textarea><meta name=timeout></TEXTAREA>",
+    b"<div title='<meta name=timeout content=long>' data-x=\"<link rel=match href=a>\"></div>",
+    b"<div a=\"<meta name=timeout content=long>",
+    b"</div x='<meta name=timeout content=long>'><? <link rel=match href=a.html> ?>",
+    b"<table><tr><td><meta name=variant content=?a></td></tr></table><meta name=variant content=?b>",
+    b"<svg><style></svg><meta name=timeout content=long>",
+    b"<select><link rel=match href=a.html></select><link rel=mismatch href=b.html>",
+    b"<body><meta name=timeout content=long><noscript></noscript><frameset>",
+    b"<script><!--<script></script>--></script><meta name=timeout content=long>",
+    b"<plaintext><meta name=timeout content=long>",
+    b"<meta name=variant content='?a&amp;b'>",
+    b"<meta charset=utf-7><meta name=variant content='+ADw-'>",
+])
+def test_metadata_scan(content):
+    s = create("foo/test.html", content)
+    scanned = s.metadata_scan
+
+    full = create("foo/test.html", content)
+    for kind in metadata_kinds:
+        expected = [node.attrib for node in getattr(full, kind + "_nodes")]
+        if scanned is not None:
+            assert [node.attrib for node in scanned[kind]] == expected
+        assert [node.attrib for node in s.metadata_nodes(kind)] == expected
+
+
+@pytest.mark.parametrize("content", [
+    b"<table><meta name=variant content=?a><td><meta name=variant content=?b>",
+    b"<svg><script src=/resources/testharness.js></script></svg>",
+    b"<body><meta name=timeout content=long><frameset>",
+    b"<meta name=variant content='?a&amp;b'>",
+    b"<meta name=variant content='?\xc3\xa9'>",
+    b"\xff\xfe<\x00m\x00e\x00t\x00a\x00>\x00",
+])
+def test_metadata_scan_fallback(content):
+    s = create("foo/test.html", content)
+    assert s.metadata_scan is None
+
+
+def test_metadata_scan_not_html():
+    s = create("foo/test.xhtml", b"<html xmlns='http://www.w3.org/1999/xhtml'><link rel='match' href='a.xhtml'/></html>")
+    assert s.metadata_scan is None
+    assert s.references == [("/foo/a.xhtml", "==")]
@@ -0,0 +1,123 @@
+import os
+import time
+
+from .. import manifest, sourcefile, vcs
+
+
+def create_files(root, paths):
+    old = time.time() - 60
+    for path in paths:
+        full_path = os.path.join(str(root), path)
+        if not os.path.exists(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, "w") as f:
+            f.write(path)
+        os.utime(full_path, (old, old))
+
+
+def test_stat_cache(tmpdir):
+    create_files(tmpdir, ["a/test.html", "a/support.js"])
+    cache_root = os.path.join(str(tmpdir), vcs.StatCache.dir_name)
+
+    m = manifest.Manifest()
+    stat_cache = vcs.StatCache(cache_root)
+    tree = vcs.FileSystem(str(tmpdir), "/", stat_cache=stat_cache)
+    assert all("hash" not in source_file.__dict__ for source_file in tree)
+
+    assert m.update(vcs.FileSystem(str(tmpdir), "/", stat_cache=stat_cache)) is True
+    stat_cache.dump(m)
+    assert os.path.exists(stat_cache.path)
+
+    stat_cache = vcs.StatCache(cache_root)
+    source_files = {source_file.rel_path: source_file
+                    for source_file in vcs.FileSystem(str(tmpdir), "/", stat_cache=stat_cache)}
+    assert len(source_files) == 2
+    for rel_path, source_file in source_files.items():
+        assert source_file.__dict__["hash"] == m.file_hash(rel_path)
+
+    assert m.update(source_files.values()) is False
+
+    # Changing the file changes its stat data, so the cached hash isn't used
+    with open(os.path.join(str(tmpdir), "a", "support.js"), "w") as f:
+        f.write("changed")
+    stat_cache = vcs.StatCache(cache_root)
+    source_files = {source_file.rel_path: source_file
+                    for source_file in vcs.FileSystem(str(tmpdir), "/", stat_cache=stat_cache)}
+    assert "hash" not in source_files[os.path.join("a", "support.js")].__dict__
+    assert m.update(source_files.values()) is True
+
+
+def test_stat_cache_rebuild(tmpdir):
+    create_files(tmpdir, ["test.html"])
+    cache_root = str(tmpdir.join(vcs.StatCache.dir_name))
+
+    m = manifest.Manifest()
+    stat_cache = vcs.StatCache(cache_root)
+    m.update(vcs.FileSystem(str(tmpdir), "/", stat_cache=stat_cache))
+    stat_cache.dump(m)
+
+    assert vcs.StatCache(cache_root).data
+    assert vcs.StatCache(cache_root, rebuild=True).data == {}
+
+
+def create_git_repo(tmpdir):
+    create_files(tmpdir, ["a/test.html", "a/changed.html", "a/deleted.html"])
+    git = vcs.Git.get_func(str(tmpdir))
+    git("init", "-q")
+    git("add", ".")
+    git("-c", "user.name=test", "-c", "user.email=test@example.org",
+        "commit", "-q", "-m", "initial")
+
+    with open(os.path.join(str(tmpdir), "a", "changed.html"), "w") as f:
+        f.write("<link rel=match href=changed-ref.html>")
+    os.remove(os.path.join(str(tmpdir), "a", "deleted.html"))
+    create_files(tmpdir, ["b/untracked.html"])
+    return git
+
+
+def test_git_blob_ids(tmpdir):
+    git = create_git_repo(tmpdir)
+
+    tree = vcs.Git(str(tmpdir), "/")
+    source_files = {source_file.rel_path: source_file for source_file in tree}
+    assert set(source_files.keys()) == {os.path.join("a", "test.html"),
+                                        os.path.join("a", "changed.html"),
+                                        os.path.join("a", "deleted.html")}
+
+    for rel_path, source_file in source_files.items():
+        # The hash comes from git rather than from reading the file
+        assert "hash" in source_file.__dict__
+        assert source_file.hash == git("rev-parse", "HEAD:%s" % rel_path).strip()
+
+    assert source_files[os.path.join("a", "test.html")].contents is None
+
+    # Locally changed files are read from HEAD rather than the working copy
+    changed = source_files[os.path.join("a", "changed.html")]
+    assert changed.contents == b"a/changed.html"
+    assert changed.references == []
+    deleted = source_files[os.path.join("a", "deleted.html")]
+    assert deleted.contents == b"a/deleted.html"
+
+
+def test_git_local_changes(tmpdir):
+    git = create_git_repo(tmpdir)
+
+    tree = vcs.Git(str(tmpdir), "/", local_changes=True)
+    source_files = {source_file.rel_path: source_file for source_file in tree}
+    assert set(source_files.keys()) == {os.path.join("a", "test.html"),
+                                        os.path.join("a", "changed.html"),
+                                        os.path.join("b", "untracked.html")}
+
+    for rel_path, source_file in source_files.items():
+        assert "hash" in source_file.__dict__
+        assert source_file.contents is None
+        working_file = sourcefile.SourceFile(str(tmpdir), rel_path, "/")
+        assert source_file.hash == working_file.hash
+
+    test_file = source_files[os.path.join("a", "test.html")]
+    assert test_file.hash == git("rev-parse", "HEAD:a/test.html").strip()
+
+    # Locally modified files are read from the working copy
+    changed = source_files[os.path.join("a", "changed.html")]
+    assert changed.hash != git("rev-parse", "HEAD:a/changed.html").strip()
+    assert changed.references == [("/a/changed-ref.html", "==")]
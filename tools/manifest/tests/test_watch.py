@@ -0,0 +1,75 @@
+import json
+import os
+import time
+
+import pytest
+
+from .. import manifest, vcs, watch
+
+
+def write_file(root, rel_path, contents):
+    path = os.path.join(str(root), rel_path)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(contents)
+
+
+def create_watcher(tree, kind):
+    if kind == "polling":
+        return watch.PollingWatcher(tree, interval=0.05)
+    try:
+        return watch.InotifyWatcher(tree)
+    except OSError:
+        pytest.skip("inotify not available")
+
+
+@pytest.mark.parametrize("kind", ["inotify", "polling"])
+def test_watch(tmpdir, kind):
+    testharness = "<script src=/resources/testharness.js></script>"
+    write_file(tmpdir, "a/test.html", testharness)
+    write_file(tmpdir, "a/support.js", "")
+    write_file(tmpdir, "b/test-ref.html", "")
+
+    tests_root = str(tmpdir)
+    manifest_path = os.path.join(tests_root, "MANIFEST.json")
+    # The manifest is written inside the tree, but isn't part of it
+    write_file(tmpdir, ".gitignore", "MANIFEST.json\nMANIFEST.json.tmp\n")
+    tree = vcs.FileSystem(tests_root, "/")
+
+    m = manifest.Manifest()
+    m.update(tree)
+    manifest.write(m, manifest_path)
+
+    watcher = create_watcher(tree, kind)
+    manifest_watcher = watch.ManifestWatcher(tests_root, m, manifest_path, watcher,
+                                             debounce=0.2)
+    try:
+        # Nothing has changed, and writing the manifest is ignored
+        assert manifest_watcher.run_once(timeout=0.2) is False
+
+        write_file(tmpdir, "a/support.js", "changed")
+        write_file(tmpdir, "c/d/test.html", "<link rel=match href=/b/test-ref.html>")
+        os.unlink(os.path.join(tests_root, "a", "test.html"))
+        os.rename(os.path.join(tests_root, "b"), os.path.join(tests_root, "e"))
+        if kind == "polling":
+            # Make sure the stat data differs for the changed file
+            time.sleep(0.05)
+
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            manifest_watcher.run_once(timeout=0.5)
+            expected = manifest.Manifest()
+            expected.update(vcs.FileSystem(tests_root, "/"))
+            if m.to_json() == expected.to_json():
+                break
+        assert m.to_json() == expected.to_json()
+        assert set(m.iterpaths()) == {".gitignore",
+                                      os.path.join("a", "support.js"),
+                                      os.path.join("c", "d", "test.html"),
+                                      os.path.join("e", "test-ref.html")}
+
+        with open(manifest_path) as f:
+            assert json.load(f) == json.loads(json.dumps(expected.to_json()))
+    finally:
+        watcher.close()
@@ -5,7 +5,7 @@ import os
 import sys
 
 import manifest
-from . import vcs
+from . import vcs, watch
 from .log import get_logger
 
 here = os.path.dirname(__file__)
@@ -13,14 +13,27 @@ here = os.path.dirname(__file__)
 wpt_root = os.path.abspath(os.path.join(here, os.pardir, os.pardir))
 
 
-def update(tests_root, manifest, working_copy=False):
+def update(tests_root, manifest, working_copy=False, jobs=1, cache_root=None,
+           rebuild=False, local_changes=False):
     tree = None
     if not working_copy:
-        tree = vcs.Git.for_path(tests_root, manifest.url_base)
+        tree = vcs.Git.for_path(tests_root, manifest.url_base,
+                                local_changes=local_changes)
+
+    # Git trees take file hashes from the index, so only the filesystem
+    # needs to stat files to avoid rehashing them
+    stat_cache = None
     if tree is None:
-        tree = vcs.FileSystem(tests_root, manifest.url_base)
+        if cache_root is not None:
+            stat_cache = vcs.StatCache(cache_root, rebuild=rebuild)
+        tree = vcs.FileSystem(tests_root, manifest.url_base, stat_cache=stat_cache)
+
+    changed = manifest.update(tree, jobs=jobs)
+
+    if stat_cache is not None:
+        stat_cache.dump(manifest)
 
-    return manifest.update(tree)
+    return changed
 
 
 def update_from_cli(**kwargs):
@@ -43,12 +56,27 @@ def update_from_cli(**kwargs):
     if m is None:
         m = manifest.Manifest(kwargs["url_base"])
 
+    watch_changes = kwargs.get("watch", False)
     changed = update(tests_root,
                      m,
-                     working_copy=kwargs["work"])
-    if changed:
+                     # Changes are watched for in the working tree, so that
+                     # is what the manifest has to start from
+                     working_copy=kwargs["work"] or watch_changes,
+                     jobs=kwargs.get("jobs", 1),
+                     cache_root=kwargs.get("cache_root"),
+                     rebuild=kwargs.get("rebuild", False),
+                     local_changes=kwargs.get("local_changes", False))
+    if changed or (watch_changes and not os.path.exists(path)):
         manifest.write(m, path)
 
+    if watch_changes:
+        tree = vcs.FileSystem(tests_root, m.url_base)
+        watcher = watch.create_watcher(tree,
+                                       poll_interval=kwargs.get("poll_interval", 1.0),
+                                       force_polling=kwargs.get("poll", False))
+        watch.ManifestWatcher(tests_root, m, path, watcher,
+                              debounce=kwargs.get("debounce", 0.5)).run()
+
 
 def abs_path(path):
     return os.path.abspath(os.path.expanduser(path))
@@ -57,7 +85,7 @@ def abs_path(path):
 def create_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "-p", "--path", type=abs_path, help="Path to manifest file.")
+        "-p", "--path", type=abs_path, help="Path to manifest file. Paths ending in .db use the SQLite format.")
     parser.add_argument(
         "--tests-root", type=abs_path, default=wpt_root, help="Path to root of tests.")
     parser.add_argument(
@@ -66,9 +94,39 @@ def create_parser():
     parser.add_argument(
         "--work", action="store_true", default=False,
         help="Build from the working tree rather than the latest commit")
+    parser.add_argument(
+        "--local-changes", action="store_true", default=False,
+        help="Build from the latest commit, plus any uncommitted changes and "
+        "untracked files that aren't ignored by git.")
     parser.add_argument(
         "--url-base", action="store", default="/",
         help="Base url to use as the mount point for tests in this manifest.")
+    parser.add_argument(
+        "-j", "--jobs", action="store", type=int, default=1,
+        help="Number of processes to use when hashing and parsing files, "
+        "or 0 to use one per CPU.")
+    parser.add_argument(
+        "--cache-root", action="store", type=abs_path,
+        help="Directory in which to cache file stat data so that unchanged files "
+        "aren't rehashed (default: %s in the directory containing the manifest)." %
+        vcs.StatCache.dir_name)
+    parser.add_argument(
+        "--no-cache", action="store_true", default=False,
+        help="Don't use or update the stat cache.")
+    parser.add_argument(
+        "--watch", action="store_true", default=False,
+        help="Keep running after the update, and update the manifest again "
+        "whenever files in the working tree change.")
+    parser.add_argument(
+        "--debounce", action="store", type=float, default=0.5,
+        help="With --watch, seconds to wait for changes to stop before "
+        "rewriting the manifest.")
+    parser.add_argument(
+        "--poll", action="store_true", default=False,
+        help="With --watch, poll the tree for changes instead of using inotify.")
+    parser.add_argument(
+        "--poll-interval", action="store", type=float, default=1.0,
+        help="With --watch, seconds between scans of the tree when polling.")
     return parser
 
 
@@ -86,6 +144,11 @@ def find_top_repo():
 def run(**kwargs):
     if kwargs["path"] is None:
         kwargs["path"] = os.path.join(kwargs["tests_root"], "MANIFEST.json")
+    if kwargs.get("no_cache"):
+        kwargs["cache_root"] = None
+    elif kwargs.get("cache_root") is None:
+        kwargs["cache_root"] = os.path.join(os.path.dirname(kwargs["path"]),
+                                            vcs.StatCache.dir_name)
 
     update_from_cli(**kwargs)
 
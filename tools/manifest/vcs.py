@@ -1,14 +1,24 @@
+import json
 import os
 import subprocess
+import time
+
+from six import iteritems
 
 from .sourcefile import SourceFile
 
 
 class Git(object):
-    def __init__(self, repo_root, url_base):
+    """Tree of the files in the HEAD commit of a git repository.
+
+    :param local_changes: Read files with uncommitted changes, and untracked
+                          files, from the working copy rather than from HEAD"""
+
+    def __init__(self, repo_root, url_base, local_changes=False):
         self.root = os.path.abspath(repo_root)
         self.git = Git.get_func(repo_root)
         self.url_base = url_base
+        self.local_changes = local_changes
 
     @staticmethod
     def get_func(repo_path):
@@ -18,74 +28,231 @@ class Git(object):
         return git
 
     @classmethod
-    def for_path(cls, path, url_base):
+    def for_path(cls, path, url_base, local_changes=False):
         git = Git.get_func(path)
         try:
-            return cls(git("rev-parse", "--show-toplevel").rstrip(), url_base)
+            return cls(git("rev-parse", "--show-toplevel").rstrip(), url_base,
+                       local_changes=local_changes)
         except subprocess.CalledProcessError:
             return None
 
     def _local_changes(self):
+        """Dict of rel_path -> status for paths that differ between HEAD and
+        the working copy, including untracked files if they are to be read"""
         changes = {}
-        cmd = ["status", "-z", "--ignore-submodules=all"]
+        untracked = "all" if self.local_changes else "no"
+        cmd = ["status", "-z", "--ignore-submodules=all", "--untracked-files=%s" % untracked]
         data = self.git(*cmd)
 
         if data == "":
             return changes
 
-        rename_data = None
+        rename_status = None
         for entry in data.split("\0")[:-1]:
-            if rename_data is not None:
-                status, rel_path = entry.split(" ")
-                if status[0] == "R":
-                    rename_data = (rel_path, status)
-                else:
-                    changes[rel_path] = (status, None)
-            else:
-                rel_path = entry
-                changes[rel_path] = rename_data
-                rename_data = None
+            if rename_status is not None:
+                # This is the source path of a rename or copy
+                changes[entry] = rename_status
+                rename_status = None
+                continue
+            status, rel_path = entry[:2], entry[3:]
+            changes[rel_path] = status
+            if "R" in status or "C" in status:
+                rename_status = status
         return changes
 
-    def _show_file(self, path):
-        path = os.path.relpath(os.path.abspath(path), self.root)
-        return self.git("show", "HEAD:%s" % path)
+    def _hash_objects(self, rel_paths):
+        """Dict of rel_path -> git blob id for files in the working copy"""
+        if not rel_paths:
+            return {}
+        cmd = ["git", "hash-object", "--no-filters", "--stdin-paths"]
+        proc = subprocess.Popen(cmd, cwd=self.root, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        output = proc.communicate("".join("%s\n" % rel_path for rel_path in rel_paths))[0]
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        return dict(zip(rel_paths, output.split()))
+
+    def _show_file(self, rel_path):
+        return self.git("show", "HEAD:%s" % rel_path)
 
     def __iter__(self):
-        cmd = ["ls-tree", "-r", "-z", "--name-only", "HEAD"]
+        cmd = ["ls-tree", "-r", "-z", "HEAD"]
         local_changes = self._local_changes()
-        for rel_path in self.git(*cmd).split("\0")[:-1]:
-            if not os.path.isdir(os.path.join(self.root, rel_path)):
-                if rel_path in local_changes:
-                    contents = self._show_file(rel_path)
-                else:
-                    contents = None
-                yield SourceFile(self.root,
-                                 rel_path,
-                                 self.url_base,
-                                 contents=contents)
+        for entry in self.git(*cmd).split("\0")[:-1]:
+            meta, rel_path = entry.split("\t", 1)
+            mode, obj_type, obj_id = meta.split(" ")
+            if obj_type != "blob":
+                # Submodule
+                continue
+            contents = None
+            if rel_path in local_changes:
+                if self.local_changes:
+                    # Read from the working copy below
+                    continue
+                contents = self._show_file(rel_path)
+
+            # SourceFile.hash is compatible with git's blob ids, so the
+            # object id can be used directly without reading the file.
+            file_hash = obj_id
+            if mode == "120000":
+                # Symlinks are followed when the file is read, whereas the
+                # blob id is the hash of the link target
+                if os.path.isdir(os.path.join(self.root, rel_path)):
+                    continue
+                file_hash = None
+
+            yield SourceFile(self.root,
+                             rel_path,
+                             self.url_base,
+                             contents=contents,
+                             hash=file_hash)
+
+        if not self.local_changes:
+            return
+
+        # Modified and untracked files are read from the working copy, so
+        # uncommitted changes to tests are included; deleted files are skipped
+        dirty_paths = [rel_path for rel_path in sorted(local_changes)
+                       if os.path.isfile(os.path.join(self.root, rel_path))]
+        hashes = self._hash_objects(dirty_paths)
+        for rel_path in dirty_paths:
+            yield SourceFile(self.root,
+                             rel_path,
+                             self.url_base,
+                             hash=hashes[rel_path])
 
 
 class FileSystem(object):
-    def __init__(self, root, url_base):
+    def __init__(self, root, url_base, stat_cache=None):
         self.root = root
         self.url_base = url_base
+        self.stat_cache = stat_cache
         from gitignore import gitignore
         self.path_filter = gitignore.PathFilter(self.root)
 
+    # Directories at the top of the tree that never contain tests
+    root_skip_dirs = ["tools", "resources", ".git", ".wptcache"]
+
     def __iter__(self):
-        is_root = True
-        for dir_path, dir_names, filenames in os.walk(self.root):
+        return self.iter_dir("")
+
+    def include(self, rel_path):
+        """Check if the file at rel_path is part of the tree"""
+        if rel_path.split(os.path.sep, 1)[0] in self.root_skip_dirs:
+            return False
+        return self.path_filter(rel_path)
+
+    def iter_dir(self, rel_dir):
+        """Iterate over SourceFile objects for the files under the directory
+        rel_dir, or the whole tree if rel_dir is empty"""
+        if rel_dir and rel_dir.split(os.path.sep, 1)[0] in self.root_skip_dirs:
+            return
+
+        is_root = not rel_dir
+        for dir_path, dir_names, filenames in os.walk(os.path.join(self.root, rel_dir)):
             rel_root = os.path.relpath(dir_path, self.root)
 
             if is_root:
                 dir_names[:] = [item for item in dir_names if item not in
-                                ["tools", "resources", ".git"]]
+                                self.root_skip_dirs]
+                rel_root = ""
                 is_root = False
 
+            # Nothing in an ignored directory can be included
+            dir_names[:] = [item for item in dir_names if
+                            self.path_filter(os.path.join(rel_root, item) + os.path.sep)]
+
             for filename in filenames:
                 rel_path = os.path.join(rel_root, filename)
                 if self.path_filter(rel_path):
+                    file_hash = None
+                    if self.stat_cache is not None:
+                        try:
+                            file_stat = os.stat(os.path.join(dir_path, filename))
+                        except OSError:
+                            pass
+                        else:
+                            file_hash = self.stat_cache.get(rel_path, file_stat)
                     yield SourceFile(self.root,
                                      rel_path,
-                                     self.url_base)
+                                     self.url_base,
+                                     hash=file_hash)
+
+
+def stat_key(file_stat):
+    """Return a JSON-serializable (mtime_ns, size, inode) tuple for an
+    os.stat result."""
+    mtime_ns = getattr(file_stat, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(file_stat.st_mtime * 10**9)
+    return (mtime_ns, file_stat.st_size, file_stat.st_ino)
+
+
+class StatCache(object):
+    """Cache of file hashes keyed on the stat data of each file.
+
+    This allows an update to skip reading any file whose (mtime_ns, size,
+    inode) tuple is unchanged since the hash was last recorded. The cache
+    is stored as JSON in a directory next to the manifest, and is only a
+    performance optimisation; deleting it is always safe.
+
+    :param cache_root: Directory in which to store the cache file
+    :param rebuild: Ignore any existing cache data"""
+
+    dir_name = ".wptcache"
+    file_name = "stat.json"
+    version = 2
+
+    # A file written in the same timestamp granule as the cache can be
+    # changed again without its stat data changing, so entries this recent
+    # are not stored (the same "racy clean" problem git has with its index).
+    racy_ns = 2 * 10**9
+
+    def __init__(self, cache_root, rebuild=False):
+        self.path = os.path.join(cache_root, self.file_name)
+        self.data = {} if rebuild else self._load()
+        self.seen = {}
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            return {}
+        return data.get("paths", {})
+
+    def get(self, rel_path, file_stat):
+        """Return the cached hash for rel_path if its stat data matches file_stat,
+        otherwise None. The stat data is remembered so the hash computed for
+        this path can be recorded by dump()."""
+        if os.name == "nt":
+            # match the normalization done by SourceFile
+            rel_path = rel_path.replace("/", "\\")
+        key = stat_key(file_stat)
+        self.seen[rel_path] = key
+        cached = self.data.get(rel_path)
+        if cached is not None and tuple(cached[0]) == key:
+            return cached[1]
+        return None
+
+    def dump(self, manifest):
+        """Record the hashes that manifest holds for every path passed to get()
+        during this update and write the cache to disk."""
+        cutoff = int(time.time() * 10**9) - self.racy_ns
+        paths = {}
+        for rel_path, key in iteritems(self.seen):
+            file_hash = manifest.file_hash(rel_path)
+            if file_hash is not None and key[0] < cutoff:
+                paths[rel_path] = [list(key), file_hash]
+        if paths == self.data:
+            return
+        self.data = paths
+
+        dir_name = os.path.dirname(self.path)
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        with open(self.path, "w") as f:
+            # json.dumps uses the C encoder, unlike json.dump
+            f.write(json.dumps({"version": self.version, "paths": paths}))
@@ -0,0 +1,322 @@
+"""Keep a manifest up to date as files in the source tree change.
+
+Rather than walking and hashing the whole tree each time the manifest is
+needed, this keeps the manifest in memory, waits for files to change and
+applies just those changes, rewriting the manifest file once the tree has
+been quiet for a short time. On Linux changes are reported by inotify;
+elsewhere, or if inotify isn't usable, the tree is polled."""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from six import PY3, iteritems
+
+from . import manifest, vcs
+from .log import get_logger
+from .sourcefile import SourceFile
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+event_header = struct.Struct("iIII")
+
+
+class PollingWatcher(object):
+    """Find changed files by periodically comparing the stat data of every
+    file in the tree.
+
+    :param tree: vcs.FileSystem for the tree to watch
+    :param interval: Time in seconds between scans of the tree
+    """
+
+    def __init__(self, tree, interval=1.0):
+        self.tree = tree
+        self.interval = interval
+        self.stats = self._scan()
+        self.next_scan = time.time() + interval
+
+    def _scan(self):
+        rv = {}
+        for source_file in self.tree:
+            try:
+                rv[source_file.rel_path] = vcs.stat_key(os.stat(source_file.path))
+            except OSError:
+                pass
+        return rv
+
+    def changes(self, timeout=None):
+        """Wait for files to change.
+
+        :param timeout: Maximum time in seconds to wait, or None to wait
+                        until there is a change
+        :returns: Set of paths relative to the root of the tree of files or
+                  directories that changed, which is empty if the timeout
+                  expired without any changes
+        """
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            now = time.time()
+            if end is not None and self.next_scan > end:
+                time.sleep(max(end - now, 0))
+                return set()
+            time.sleep(max(self.next_scan - now, 0))
+            stats = self._scan()
+            self.next_scan = time.time() + self.interval
+            rv = {rel_path for rel_path, key in iteritems(stats)
+                  if self.stats.get(rel_path) != key}
+            rv |= set(self.stats) - set(stats)
+            self.stats = stats
+            if rv:
+                return rv
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Find changed files using inotify, with a watch on every directory in
+    the tree.
+
+    :param tree: vcs.FileSystem for the tree to watch
+    :raises OSError: If inotify is unavailable or the directories can't
+                     all be watched
+    """
+
+    mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    def __init__(self, tree):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not supported by the C library")
+        self.libc = libc
+        self.tree = tree
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        try:
+            self._add_tree("")
+        except OSError:
+            self.close()
+            raise
+
+    def _add_dir(self, rel_dir):
+        path = os.path.join(self.tree.root, rel_dir)
+        c_path = path
+        if not isinstance(c_path, bytes):
+            c_path = c_path.encode(sys.getfilesystemencoding())
+        wd = self.libc.inotify_add_watch(self.fd, c_path, self.mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # Removed before the watch could be added
+                return False
+            raise OSError(err, "Failed to watch %s: %s" % (path, os.strerror(err)))
+        self.dirs[wd] = rel_dir
+        return True
+
+    def _add_tree(self, rel_dir):
+        if not self._add_dir(rel_dir):
+            return
+        for dir_path, dir_names, _ in os.walk(os.path.join(self.tree.root, rel_dir)):
+            rel_root = os.path.relpath(dir_path, self.tree.root)
+            if rel_root == ".":
+                dir_names[:] = [item for item in dir_names
+                                if item not in self.tree.root_skip_dirs]
+                rel_root = ""
+            for dir_name in dir_names:
+                self._add_dir(os.path.join(rel_root, dir_name))
+
+    def _read_events(self):
+        rv = set()
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so the whole tree has to be checked
+                rv.add("")
+                continue
+
+            rel_dir = self.dirs.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.dirs[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                rv.add(rel_dir)
+                continue
+
+            if PY3:
+                name = name.decode(sys.getfilesystemencoding(), "surrogateescape")
+            rel_path = os.path.join(rel_dir, name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(rel_path)
+            rv.add(rel_path)
+        return rv
+
+    def changes(self, timeout=None):
+        """Wait for files to change.
+
+        :param timeout: Maximum time in seconds to wait, or None to wait
+                        until there is a change
+        :returns: Set of paths relative to the root of the tree of files or
+                  directories that changed, which is empty if the timeout
+                  expired without any changes
+        """
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if end is None else max(end - time.time(), 0)
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return set()
+            rv = self._read_events()
+            if rv:
+                return rv
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def create_watcher(tree, poll_interval=1.0, force_polling=False):
+    """Create the most efficient available watcher for tree"""
+    if not force_polling:
+        try:
+            return InotifyWatcher(tree)
+        except OSError as e:
+            get_logger().info("Can't use inotify (%s), polling for changes instead" % e)
+    return PollingWatcher(tree, interval=poll_interval)
+
+
+class ManifestWatcher(object):
+    """Apply changes reported by a watcher to a manifest held in memory,
+    writing the manifest out after each batch of changes.
+
+    :param tests_root: Path to the root of the source tree
+    :param manifest_obj: The Manifest to update, which must be up to date
+                         with the tree to begin with
+    :param path: Path to write the manifest to
+    :param watcher: Object with changes() and close() methods as implemented by
+                    InotifyWatcher and PollingWatcher
+    :param debounce: Time in seconds without further changes to wait before
+                     updating the manifest
+    :param max_delay: Maximum time in seconds to delay an update by while
+                      files keep changing
+    """
+
+    def __init__(self, tests_root, manifest_obj, path, watcher, debounce=0.5, max_delay=5.0):
+        self.tests_root = tests_root
+        self.manifest = manifest_obj
+        self.path = path
+        self.watcher = watcher
+        self.tree = watcher.tree
+        self.debounce = debounce
+        self.max_delay = max_delay
+        # The manifest itself may be written inside the tree
+        self.ignored = set()
+        rel_manifest_path = os.path.relpath(path, tests_root)
+        if not rel_manifest_path.startswith(os.pardir):
+            self.ignored = {rel_manifest_path, rel_manifest_path + ".tmp"}
+
+    def wait(self, timeout=None):
+        """Wait for files to change, and then for the tree to be quiet.
+
+        :returns: Set of changed paths, which is empty if nothing changed
+                  before timeout"""
+        changed = self.watcher.changes(timeout) - self.ignored
+        if not changed:
+            return changed
+        end = time.time() + self.max_delay
+        while True:
+            more = self.watcher.changes(min(self.debounce, max(end - time.time(), 0)))
+            more -= self.ignored
+            if not more:
+                return changed
+            changed |= more
+
+    def apply(self, changed):
+        """Update the manifest for a set of changed paths, which may be files
+        or directories and may no longer exist.
+
+        :returns: Boolean indicating whether the manifest changed"""
+        source_files = {}
+        removed = set()
+
+        for rel_path in changed:
+            path = os.path.join(self.tests_root, rel_path)
+            if os.path.isdir(path):
+                for source_file in self.tree.iter_dir(rel_path):
+                    source_files[source_file.rel_path] = source_file
+            elif os.path.exists(path) and self.tree.include(rel_path):
+                source_file = SourceFile(self.tests_root, rel_path, self.manifest.url_base)
+                source_files[source_file.rel_path] = source_file
+            elif self.manifest.file_hash(rel_path) is not None:
+                removed.add(rel_path)
+
+            # Files under a directory that was removed or replaced
+            if rel_path:
+                prefix = rel_path + os.path.sep
+            else:
+                prefix = ""
+            for item_path in list(self.manifest.iterpaths(prefix)):
+                if item_path not in source_files and item_path not in self.ignored:
+                    if not os.path.exists(os.path.join(self.tests_root, item_path)):
+                        removed.add(item_path)
+
+        return self.manifest.update_paths(sorted(source_files.values(),
+                                                 key=lambda source_file: source_file.rel_path),
+                                          removed=removed)
+
+    def run_once(self, timeout=None):
+        """Wait for changes, and apply them and rewrite the manifest if there
+        were any.
+
+        :returns: Boolean indicating whether the manifest was rewritten"""
+        changed = self.wait(timeout)
+        if not changed:
+            return False
+        start = time.time()
+        if not self.apply(changed):
+            return False
+        manifest.write(self.manifest, self.path)
+        get_logger().info("Updated manifest for %i changed paths in %.2fs" %
+                          (len(changed), time.time() - start))
+        return True
+
+    def run(self):
+        get_logger().info("Watching %s for changes" % self.tests_root)
+        try:
+            while True:
+                self.run_once()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.watcher.close()
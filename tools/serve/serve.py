@@ -23,6 +23,7 @@ import sslutils
 from manifest.sourcefile import read_script_metadata, js_meta_re
 from wptserve import server as wptserve, handlers
 from wptserve import stash
+from wptserve.filecache import FileCache
 from wptserve.logger import set_logger
 from wptserve.handlers import filesystem_path, wrap_pipeline
 from mod_pywebsocket import standalone as pywebsocket
@@ -204,7 +205,20 @@ subdomains = [u"www",
               u"élève"]
 
 class RoutesBuilder(object):
-    def __init__(self):
+    """Build the list of routes for the server.
+
+    :param file_cache_size: Maximum number of bytes of file content to keep
+                            in memory for static files, or 0 (the default)
+                            to always read files from disk
+    :param validators: Default for whether static files in mount points
+                       get ETag and Last-Modified headers and conditional
+                       requests are answered with 304 Not Modified
+    """
+    def __init__(self, file_cache_size=0, validators=False):
+        self.file_cache = (FileCache(max_size=file_cache_size)
+                           if file_cache_size else None)
+        self.validators = validators
+
         self.forbidden_override = [("GET", "/tools/runner/*", handlers.file_handler),
                                    ("POST", "/tools/runner/update_manifest.py",
                                     handlers.python_script_handler)]
@@ -233,8 +247,10 @@ class RoutesBuilder(object):
         handler = handlers.StaticHandler(path, format_args, content_type)
         self.static.append((b"GET", str(route), handler))
 
-    def add_mount_point(self, url_base, path):
+    def add_mount_point(self, url_base, path, validators=None):
         url_base = "/%s/" % url_base.strip("/") if url_base != "/" else "/"
+        if validators is None:
+            validators = self.validators
 
         self.mountpoint_routes[url_base] = []
 
@@ -249,19 +265,28 @@ class RoutesBuilder(object):
         ]
 
         for (method, suffix, handler_cls) in routes:
+            if handler_cls is handlers.FileHandler:
+                handler = handler_cls(base_path=path, url_base=url_base, cache=self.file_cache,
+                                      validators=validators)
+            else:
+                handler = handler_cls(base_path=path, url_base=url_base)
             self.mountpoint_routes[url_base].append(
                 (method,
                  b"%s%s" % (str(url_base) if url_base != "/" else "", str(suffix)),
-                 handler_cls(base_path=path, url_base=url_base)))
+                 handler))
 
-    def add_file_mount_point(self, file_url, base_path):
+    def add_file_mount_point(self, file_url, base_path, validators=None):
         assert file_url.startswith("/")
         url_base = file_url[0:file_url.rfind("/") + 1]
-        self.mountpoint_routes[file_url] = [("GET", file_url, handlers.FileHandler(base_path=base_path, url_base=url_base))]
+        if validators is None:
+            validators = self.validators
+        self.mountpoint_routes[file_url] = [("GET", file_url, handlers.FileHandler(base_path=base_path, url_base=url_base,
+                                                                                   cache=self.file_cache,
+                                                                                   validators=validators))]
 
 
-def build_routes(aliases):
-    builder = RoutesBuilder()
+def build_routes(aliases, file_cache_size=0, validators=False):
+    builder = RoutesBuilder(file_cache_size=file_cache_size, validators=validators)
     for alias in aliases:
         url = alias["url-path"]
         directory = alias["local-dir"]
@@ -269,9 +294,9 @@ def build_routes(aliases):
             logger.error("\"url-path\" value must start with '/'.")
             continue
         if url.endswith("/"):
-            builder.add_mount_point(url, directory)
+            builder.add_mount_point(url, directory, validators=alias.get("validators"))
         else:
-            builder.add_file_mount_point(url, directory)
+            builder.add_file_mount_point(url, directory, validators=alias.get("validators"))
     return builder.get_routes()
 
 
@@ -375,19 +400,32 @@ def get_port():
 
 
 class ServerProc(object):
-    def __init__(self):
-        self.proc = None
+    """Server running in one or more child processes.
+
+    :param workers: Number of processes to start. When this is more than
+                    one, init_func must create servers that can share a
+                    port, i.e. that use SO_REUSEPORT.
+    """
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.procs = []
         self.daemon = None
         self.stop = Event()
 
+    @property
+    def proc(self):
+        return self.procs[0] if self.procs else None
+
     def start(self, init_func, host, port, paths, routes, bind_hostname, external_config,
               ssl_config, **kwargs):
-        self.proc = Process(target=self.create_daemon,
-                            args=(init_func, host, port, paths, routes, bind_hostname,
-                                  external_config, ssl_config),
-                            kwargs=kwargs)
-        self.proc.daemon = True
-        self.proc.start()
+        for _ in range(self.workers):
+            proc = Process(target=self.create_daemon,
+                           args=(init_func, host, port, paths, routes, bind_hostname,
+                                 external_config, ssl_config),
+                           kwargs=kwargs)
+            proc.daemon = True
+            proc.start()
+            self.procs.append(proc)
 
     def create_daemon(self, init_func, host, port, paths, routes, bind_hostname,
                       external_config, ssl_config, **kwargs):
@@ -414,15 +452,20 @@ class ServerProc(object):
 
     def wait(self):
         self.stop.set()
-        self.proc.join()
+        for proc in self.procs:
+            proc.join()
 
     def kill(self):
         self.stop.set()
-        self.proc.terminate()
-        self.proc.join()
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            proc.join()
 
     def is_alive(self):
-        return self.proc.is_alive()
+        """Check that all the processes are running, since the port is
+        only partly served if one of them has exited"""
+        return bool(self.procs) and all(proc.is_alive() for proc in self.procs)
 
 
 def check_subdomains(host, paths, bind_hostname, ssl_config, aliases):
@@ -463,12 +506,31 @@ def get_subdomains(host):
             for subdomain in subdomains}
 
 
+def reuse_port_supported():
+    # Other platforms accept SO_REUSEPORT, but don't spread connections
+    # across the sockets sharing a port
+    return sys.platform.startswith("linux") and hasattr(socket, "SO_REUSEPORT")
+
+
+def get_server_workers(kwargs):
+    workers = kwargs.get("server_workers") or 1
+    if workers > 1 and not reuse_port_supported():
+        logger.warning("Multiple server processes per port need SO_REUSEPORT, "
+                       "which isn't supported on this platform; using one")
+        workers = 1
+    return workers
+
+
 def start_servers(host, ports, paths, routes, bind_hostname, external_config, ssl_config,
                   **kwargs):
     servers = defaultdict(list)
+    http_workers = get_server_workers(kwargs)
     for scheme, ports in ports.iteritems():
         assert len(ports) == {"http":2}.get(scheme, 1)
 
+        # pywebsocket can't share a port between processes
+        workers = http_workers if scheme in ("http", "https") else 1
+
         for port in ports:
             if port is None:
                 continue
@@ -477,14 +539,20 @@ def start_servers(host, ports, paths, routes, bind_hostname, external_config, ss
                          "ws":start_ws_server,
                          "wss":start_wss_server}[scheme]
 
-            server_proc = ServerProc()
+            server_proc = ServerProc(workers=workers)
             server_proc.start(init_func, host, port, paths, routes, bind_hostname,
-                              external_config, ssl_config, **kwargs)
+                              external_config, ssl_config, reuse_port=workers > 1, **kwargs)
             servers[scheme].append((port, server_proc))
 
     return servers
 
 
+def get_server_cls(kwargs):
+    if kwargs.get("event_loop"):
+        return wptserve.EventLoopServer
+    return None
+
+
 def start_http_server(host, port, paths, routes, bind_hostname, external_config, ssl_config,
                       **kwargs):
     return wptserve.WebTestHttpd(host=host,
@@ -497,7 +565,10 @@ def start_http_server(host, port, paths, routes, bind_hostname, external_config,
                                  use_ssl=False,
                                  key_file=None,
                                  certificate=None,
-                                 latency=kwargs.get("latency"))
+                                 latency=kwargs.get("latency"),
+                                 server_cls=get_server_cls(kwargs),
+                                 max_workers=kwargs.get("server_threads"),
+                                 reuse_port=kwargs.get("reuse_port", False))
 
 
 def start_https_server(host, port, paths, routes, bind_hostname, external_config, ssl_config,
@@ -513,7 +584,10 @@ def start_https_server(host, port, paths, routes, bind_hostname, external_config
                                  key_file=ssl_config["key_path"],
                                  certificate=ssl_config["cert_path"],
                                  encrypt_after_connect=ssl_config["encrypt_after_connect"],
-                                 latency=kwargs.get("latency"))
+                                 latency=kwargs.get("latency"),
+                                 server_cls=get_server_cls(kwargs),
+                                 max_workers=kwargs.get("server_threads"),
+                                 reuse_port=kwargs.get("reuse_port", False))
 
 
 class WebSocketDaemon(object):
@@ -670,7 +744,8 @@ def start(config, ssl_environment, routes, **kwargs):
 def iter_procs(servers):
     for servers in servers.values():
         for port, server in servers:
-            yield server.proc
+            for proc in server.procs:
+                yield proc
 
 
 def value_set(config, key):
@@ -765,6 +840,23 @@ def get_parser():
                         help="Path to document root. Overrides config.")
     parser.add_argument("--ws_doc_root", action="store", dest="ws_doc_root",
                         help="Path to WebSockets document root. Overrides config.")
+    parser.add_argument("--file-cache-size", action="store", type=int, default=0,
+                        help="Size in MB of an in-memory cache of static files. The cache "
+                        "is off by default; when it is on, a file changed on disk may be "
+                        "served unchanged for up to a second.")
+    parser.add_argument("--validators", action="store_true", default=False,
+                        help="Send ETag and Last-Modified headers for static files and "
+                        "answer conditional requests with 304 Not Modified")
+    parser.add_argument("--event-loop", action="store_true", default=False,
+                        help="Wait for requests on an event loop and handle them on a fixed "
+                        "pool of threads, rather than using a thread per connection")
+    parser.add_argument("--server-threads", action="store", type=int,
+                        help="Number of threads each HTTP(S) server handles connections on, "
+                        "rather than using a thread per connection. With --event-loop this "
+                        "sets the size of its pool, which is 32 by default")
+    parser.add_argument("--server-workers", action="store", type=int, default=1,
+                        help="Number of processes serving each HTTP(S) port, sharing it "
+                        "with SO_REUSEPORT (Linux only)")
     return parser
 
 
@@ -781,7 +873,10 @@ def run(**kwargs):
 
     with stash.StashServer(stash_address, authkey=str(uuid.uuid4())):
         with get_ssl_environment(config) as ssl_env:
-            config_, servers = start(config, ssl_env, build_routes(config["aliases"]), **kwargs)
+            routes = build_routes(config["aliases"],
+                                  file_cache_size=kwargs.get("file_cache_size", 0) * 1024 * 1024,
+                                  validators=kwargs.get("validators", False))
+            config_, servers = start(config, ssl_env, routes, **kwargs)
 
             try:
                 while any(item.is_alive() for item in iter_procs(servers)):
@@ -1,6 +1,5 @@
 import json
 import os
-import multiprocessing
 import signal
 import socket
 import sys
@@ -8,6 +7,7 @@ import time
 
 from mozlog import get_default_logger, handlers, proxy
 
+from screenshotcache import CacheManager
 from wptlogging import LogLevelRewriter
 
 here = os.path.split(__file__)[0]
@@ -90,7 +90,8 @@ class TestEnvironment(object):
         self.debug_info = debug_info
         self.options = options if options is not None else {}
 
-        self.cache_manager = multiprocessing.Manager()
+        self.cache_manager = CacheManager()
+        self.cache_manager.start()
         self.stash = serve.stash.StashServer()
         self.env_extras = env_extras
 
@@ -7,6 +7,8 @@ import socket
 import urlparse
 from abc import ABCMeta, abstractmethod
 
+from .. import imagediff
+from ..screenshotcache import SharedScreenshotCache
 from ..testrunner import Stop
 
 here = os.path.split(__file__)[0]
@@ -26,7 +28,8 @@ def executor_kwargs(test_type, server_config, cache_manager, **kwargs):
                        "debug_info": kwargs["debug_info"]}
 
     if test_type == "reftest":
-        executor_kwargs["screenshot_cache"] = cache_manager.dict()
+        executor_kwargs["screenshot_cache"] = SharedScreenshotCache(cache_manager.ScreenshotStore())
+        executor_kwargs["persistent_screenshot_cache"] = kwargs.get("persistent_screenshot_cache")
 
     if test_type == "wdspec":
         executor_kwargs["binary"] = kwargs.get("binary")
@@ -207,23 +210,27 @@ class RefTestExecutor(TestExecutor):
     convert_result = reftest_result_converter
 
     def __init__(self, browser, server_config, timeout_multiplier=1, screenshot_cache=None,
-                 debug_info=None, **kwargs):
+                 debug_info=None, persistent_screenshot_cache=None, **kwargs):
         TestExecutor.__init__(self, browser, server_config,
                               timeout_multiplier=timeout_multiplier,
                               debug_info=debug_info)
 
         self.screenshot_cache = screenshot_cache
+        self.persistent_screenshot_cache = persistent_screenshot_cache
 
 
 class RefTestImplementation(object):
     def __init__(self, executor):
         self.timeout_multiplier = executor.timeout_multiplier
         self.executor = executor
-        # Cache of url:(screenshot hash, screenshot). Typically the
-        # screenshot is None, but we set this value if a test fails
-        # and the screenshot was taken from the cache so that we may
-        # retrieve the screenshot from the cache directly in the future
+        # SharedScreenshotCache of (url, viewport_size, dpi): screenshot
+        # hash. Screenshots themselves are only stored for failing tests,
+        # so that they don't have to be retaken if a later test fails
+        # against the same page
         self.screenshot_cache = self.executor.screenshot_cache
+        # Optional ScreenshotCache of hashes that outlives the run, used
+        # for references only
+        self.persistent_screenshot_cache = self.executor.persistent_screenshot_cache
         self.message = None
 
     def setup(self):
@@ -236,39 +243,82 @@ class RefTestImplementation(object):
     def logger(self):
         return self.executor.logger
 
-    def get_hash(self, test, viewport_size, dpi):
+    def get_hash(self, test, viewport_size, dpi, persist=False):
         timeout = test.timeout * self.timeout_multiplier
         key = (test.url, viewport_size, dpi)
+        hash_value = self.screenshot_cache.get_hash(key)
+
+        if hash_value is None:
+            persistent_key = None
+            hash_value = None
+            if persist and self.persistent_screenshot_cache is not None:
+                persistent_key = self.persistent_screenshot_cache.key(test, viewport_size, dpi)
+                hash_value = self.persistent_screenshot_cache.get(persistent_key)
 
-        if key not in self.screenshot_cache:
-            success, data = self.executor.screenshot(test, viewport_size, dpi)
+            if hash_value is not None:
+                self.screenshot_cache.set_hash(key, hash_value)
+                rv = (hash_value, None)
+            else:
+                success, data = self.executor.screenshot(test, viewport_size, dpi)
 
-            if not success:
-                return False, data
+                if not success:
+                    return False, data
 
-            screenshot = data
-            hash_value = hashlib.sha1(screenshot).hexdigest()
+                screenshot = data
+                hash_value = hashlib.sha1(screenshot).hexdigest()
 
-            self.screenshot_cache[key] = (hash_value, None)
+                self.screenshot_cache.set_hash(key, hash_value)
+                if persistent_key is not None:
+                    self.persistent_screenshot_cache.set(persistent_key, hash_value)
 
-            rv = (hash_value, screenshot)
+                rv = (hash_value, screenshot)
         else:
-            rv = self.screenshot_cache[key]
+            rv = (hash_value, None)
 
         self.message.append("%s %s" % (test.url, rv[0]))
         return True, rv
 
-    def is_pass(self, lhs_hash, rhs_hash, relation):
+    def is_pass(self, lhs_hash, rhs_hash, relation, fuzzy=None, diff=None):
+        """Check a comparison between two screenshots
+
+        :param fuzzy: Allowed difference from imagediff.parse_fuzzy, or
+                      None to require identical screenshots
+        :param diff: ImageDiff of the screenshots, which is needed if the
+                     hashes differ and fuzzy is set"""
         assert relation in ("==", "!=")
         self.message.append("Testing %s %s %s" % (lhs_hash, relation, rhs_hash))
-        return ((relation == "==" and lhs_hash == rhs_hash) or
-                (relation == "!=" and lhs_hash != rhs_hash))
+        if lhs_hash == rhs_hash:
+            equal = imagediff.fuzzy_match(fuzzy, 0, 0)
+        else:
+            equal = diff is not None and diff.matches(fuzzy)
+        return equal == (relation == "==")
+
+    def get_diff(self, screenshots):
+        try:
+            diff = imagediff.ImageDiff(screenshots[0], screenshots[1])
+        except ValueError as e:
+            self.message.append("Failed to compare screenshots: %s" % e)
+            return None
+        self.message.append("Found %i pixels different, maximum difference per channel %i" %
+                            (diff.differing_pixels, diff.max_difference))
+        return diff
 
     def run_test(self, test):
         viewport_size = test.viewport_size
         dpi = test.dpi
         self.message = []
 
+        fuzzy = None
+        if test.fuzzy is not None:
+            try:
+                fuzzy = imagediff.parse_fuzzy(test.fuzzy)
+            except ValueError as e:
+                return {"status": "ERROR", "message": str(e)}
+
+        # Look up all the hashes that are already known in one go
+        self.screenshot_cache.get_hashes([(node.url, viewport_size, dpi)
+                                          for node in self.reference_nodes(test)])
+
         # Depth-first search of reference tree, with the goal
         # of reachings a leaf node with only pass results
 
@@ -280,13 +330,23 @@ class RefTestImplementation(object):
             nodes, relation = stack.pop()
 
             for i, node in enumerate(nodes):
-                success, data = self.get_hash(node, viewport_size, dpi)
+                success, data = self.get_hash(node, viewport_size, dpi,
+                                              persist=node is not test)
                 if success is False:
                     return {"status": data[0], "message": data[1]}
 
                 hashes[i], screenshots[i] = data
 
-            if self.is_pass(hashes[0], hashes[1], relation):
+            # Screenshots are only decoded and compared when their hashes
+            # differ but the test allows some difference
+            diff = None
+            if fuzzy is not None and hashes[0] != hashes[1]:
+                success, data = self.fill_screenshots(nodes, screenshots, viewport_size, dpi)
+                if success is False:
+                    return {"status": data[0], "message": data[1]}
+                diff = self.get_diff(screenshots)
+
+            if self.is_pass(hashes[0], hashes[1], relation, fuzzy, diff):
                 if nodes[1].references:
                     stack.extend(list(((nodes[1], item[0]), item[1]) for item in reversed(nodes[1].references)))
                 else:
@@ -295,29 +355,68 @@ class RefTestImplementation(object):
 
         # We failed, so construct a failure message
 
-        for i, (node, screenshot) in enumerate(zip(nodes, screenshots)):
-            if screenshot is None:
-                success, screenshot = self.retake_screenshot(node, viewport_size, dpi)
-                if success:
-                    screenshots[i] = screenshot
+        self.fill_screenshots(nodes, screenshots, viewport_size, dpi)
 
         log_data = [{"url": nodes[0].url, "screenshot": screenshots[0]}, relation,
                     {"url": nodes[1].url, "screenshot": screenshots[1]}]
+        extra = {"reftest_screenshots": log_data}
+
+        if relation == "==" and None not in screenshots:
+            if diff is None and not imagediff.fast_decode_available():
+                extra["reftest_diff"] = {"image": None,
+                                         "message": "No diff image, because PIL isn't installed"}
+            else:
+                if diff is None:
+                    diff = self.get_diff(screenshots)
+                if diff is not None:
+                    extra["reftest_diff"] = {"max_difference": diff.max_difference,
+                                             "differing_pixels": diff.differing_pixels,
+                                             "image": diff.image()}
 
         return {"status": "FAIL",
                 "message": "\n".join(self.message),
-                "extra": {"reftest_screenshots": log_data}}
+                "extra": extra}
+
+    def fill_screenshots(self, nodes, screenshots, viewport_size, dpi):
+        """Get the screenshots that weren't taken because their hash was
+        already known, from the store or by taking them again
+
+        :returns: (False, (status, message)) if taking a screenshot failed,
+                  otherwise (True, None)"""
+        for i, node in enumerate(nodes):
+            if screenshots[i] is not None:
+                continue
+            screenshot = self.screenshot_cache.get_screenshot((node.url, viewport_size, dpi))
+            if screenshot is None:
+                success, data = self.retake_screenshot(node, viewport_size, dpi)
+                if not success:
+                    return False, data
+                screenshot = data
+            screenshots[i] = screenshot
+        return True, None
 
     def retake_screenshot(self, node, viewport_size, dpi):
         success, data = self.executor.screenshot(node, viewport_size, dpi)
         if not success:
             return False, data
 
-        key = (node.url, viewport_size, dpi)
-        hash_val, _ = self.screenshot_cache[key]
-        self.screenshot_cache[key] = hash_val, data
+        self.screenshot_cache.set_screenshot((node.url, viewport_size, dpi), data)
         return True, data
 
+    def reference_nodes(self, test):
+        """Get the test and every node in its reference tree"""
+        rv = []
+        seen = set()
+        stack = [test]
+        while stack:
+            node = stack.pop()
+            if node.url in seen:
+                continue
+            seen.add(node.url)
+            rv.append(node)
+            stack.extend(ref for ref, _ in node.references)
+        return rv
+
 
 class WdspecExecutor(TestExecutor):
     convert_result = pytest_result_converter
@@ -180,7 +180,7 @@ class ServoRefTestExecutor(ProcessTestExecutor):
 
     def __init__(self, browser, server_config, binary=None, timeout_multiplier=1,
                  screenshot_cache=None, debug_info=None, pause_after_test=False,
-                 **kwargs):
+                 persistent_screenshot_cache=None, **kwargs):
         ProcessTestExecutor.__init__(self,
                                      browser,
                                      server_config,
@@ -189,6 +189,7 @@ class ServoRefTestExecutor(ProcessTestExecutor):
 
         self.protocol = Protocol(self, browser)
         self.screenshot_cache = screenshot_cache
+        self.persistent_screenshot_cache = persistent_screenshot_cache
         self.implementation = RefTestImplementation(self)
         self.tempdir = tempfile.mkdtemp()
         self.hosts_path = make_hosts_file()
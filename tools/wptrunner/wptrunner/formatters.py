@@ -8,6 +8,7 @@ class WptreportFormatter(BaseFormatter):
 
     def __init__(self):
         self.raw_results = {}
+        self.start_times = {}
 
     def suite_end(self, data):
         results = {}
@@ -47,8 +48,15 @@ class WptreportFormatter(BaseFormatter):
         if "message" in data:
             subtest["message"] = data["message"]
 
+    def test_start(self, data):
+        self.start_times[data["test"]] = data["time"]
+
     def test_end(self, data):
         test = self.find_or_create_test(data)
         test["status"] = data["status"]
         if "message" in data:
             test["message"] = data["message"]
+        start_time = self.start_times.pop(data["test"], None)
+        if start_time is not None:
+            # Duration in ms, as used for log timestamps
+            test["duration"] = data["time"] - start_time
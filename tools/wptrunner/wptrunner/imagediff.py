@@ -0,0 +1,370 @@
+"""Pixel comparison of reftest screenshots.
+
+Screenshots are only compared pixel by pixel when their hashes differ and
+the test allows some difference, or to describe a failure. PNGs are
+decoded with PIL when it's installed, and otherwise by the decoder here,
+which handles the 8 bit non-interlaced images that browsers produce. That
+decoder is much slower than PIL for rows using the Average and Paeth
+filters, so without PIL failures are only described by a diff image if
+the screenshots were decoded anyway. The comparison uses NumPy when it's
+installed; otherwise identical rows are skipped as whole byte strings, so
+only rows that differ are examined pixel by pixel."""
+
+import base64
+import binascii
+import re
+import struct
+import zlib
+from io import BytesIO
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+png_signature = b"\x89PNG\r\n\x1a\n"
+
+# Number of bytes in a pixel for each 8 bit PNG colour type
+channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+fuzzy_re = re.compile(r"^\s*(?:maxDifference\s*=\s*)?(\d+)(?:\s*-\s*(\d+))?\s*;"
+                      r"\s*(?:totalPixels\s*=\s*)?(\d+)(?:\s*-\s*(\d+))?\s*$")
+
+# Colour of differing pixels in diff images
+diff_colour = b"\xff\x00\x00\xff"
+
+# Unchanged pixels in diff images are faded towards white
+fade_table = bytes(bytearray((value + 3 * 255) // 4 for value in range(256)))
+
+
+def parse_fuzzy(value):
+    """Parse a fuzzy reftest tolerance.
+
+    The format is "maxDifference=<range>;totalPixels=<range>", where the
+    names are optional and each range is either "min-max" or a single
+    number N meaning 0-N.
+
+    :param value: String from a fuzzy meta element or metadata file
+    :returns: ((min, max) difference in any channel,
+               (min, max) number of differing pixels)
+    :raises ValueError: If the value isn't in the expected format"""
+    m = fuzzy_re.match(value)
+    if m is None:
+        raise ValueError("Invalid fuzzy value %r" % value)
+    rv = []
+    for low, high in [m.group(1, 2), m.group(3, 4)]:
+        if high is None:
+            low, high = 0, low
+        rv.append((int(low), int(high)))
+    return tuple(rv)
+
+
+def fuzzy_match(fuzzy, max_difference, differing_pixels):
+    """Check whether two images are equal within a tolerance
+
+    :param fuzzy: Tolerance from parse_fuzzy, or None for exact equality
+    :param max_difference: Largest difference in any channel of any pixel
+    :param differing_pixels: Number of pixels that differ at all"""
+    if fuzzy is None:
+        return differing_pixels == 0
+    (min_difference, max_allowed_difference), (min_pixels, max_pixels) = fuzzy
+    if differing_pixels == 0:
+        return min_difference == 0 or min_pixels == 0
+    return (min_difference <= max_difference <= max_allowed_difference and
+            min_pixels <= differing_pixels <= max_pixels)
+
+
+class DecodedImage(object):
+    """Image as a list of rows of RGBA bytes"""
+
+    def __init__(self, width, height, rows):
+        self.width = width
+        self.height = height
+        self.rows = rows
+
+
+def read_chunks(data):
+    if not data.startswith(png_signature):
+        raise ValueError("Not a PNG image")
+    pos = len(png_signature)
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        yield chunk_type, data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+
+
+def to_int(data):
+    return int(binascii.hexlify(bytes(data)), 16) if data else 0
+
+
+def from_int(value, length):
+    return binascii.unhexlify("%0*x" % (2 * length, value))
+
+
+def add_bytes(lhs, rhs, low_bits, high_bits):
+    """Add each byte of two integers modulo 256, without carrying between
+    bytes. low_bits has 0x7f in each byte and high_bits 0x80."""
+    return ((lhs & low_bits) + (rhs & low_bits)) ^ ((lhs ^ rhs) & high_bits)
+
+
+# Line length: (low_bits, high_bits) for add_bytes
+byte_masks = {}
+
+
+def unfilter_average(raw, prev):
+    """Undo the Average filter for one channel of a scanline"""
+    rv = bytearray(len(raw))
+    left = 0
+    for i, (value, up) in enumerate(zip(raw, prev)):
+        left = (value + ((left + up) >> 1)) & 0xff
+        rv[i] = left
+    return rv
+
+
+def unfilter_paeth(raw, prev):
+    """Undo the Paeth filter for one channel of a scanline"""
+    rv = bytearray(len(raw))
+    left = upper_left = 0
+    for i, (value, up) in enumerate(zip(raw, prev)):
+        pa = up - upper_left
+        pb = left - upper_left
+        pc = pa + pb
+        if pa < 0:
+            pa = -pa
+        if pb < 0:
+            pb = -pb
+        if pc < 0:
+            pc = -pc
+        if pa <= pb and pa <= pc:
+            predictor = left
+        elif pb <= pc:
+            predictor = up
+        else:
+            predictor = upper_left
+        left = (value + predictor) & 0xff
+        upper_left = up
+        rv[i] = left
+    return rv
+
+
+def unfilter(filter_type, line, prev, bpp):
+    """Undo the filter applied to a scanline, in place.
+
+    The Sub and Up filters are undone for the whole line at once, treating
+    it as a single integer. Each byte of the Average and Paeth filters
+    depends on the byte before it, so those are undone one channel at a
+    time, keeping the previous pixel's values in local variables."""
+    length = len(line)
+    if filter_type == 0:
+        return
+    if filter_type in (1, 2):
+        if length not in byte_masks:
+            byte_masks[length] = (to_int(b"\x7f" * length), to_int(b"\x80" * length))
+        low_bits, high_bits = byte_masks[length]
+        value = to_int(line)
+        if filter_type == 1:
+            # Prefix sum of each channel, with log2(width) additions
+            shift = bpp
+            while shift < length:
+                value = add_bytes(value, value >> (8 * shift), low_bits, high_bits)
+                shift *= 2
+        else:
+            value = add_bytes(value, to_int(prev), low_bits, high_bits)
+        line[:] = from_int(value, length)
+    elif filter_type in (3, 4):
+        func = unfilter_average if filter_type == 3 else unfilter_paeth
+        for channel in range(bpp):
+            line[channel::bpp] = func(line[channel::bpp], prev[channel::bpp])
+    else:
+        raise ValueError("Unknown PNG filter type %i" % filter_type)
+
+
+def to_rgba(line, colour_type, palette):
+    if colour_type == 6:
+        return bytes(line)
+    if colour_type == 2:
+        rv = bytearray(len(line) // 3 * 4)
+        for i in range(3):
+            rv[i::4] = line[i::3]
+        rv[3::4] = b"\xff" * (len(line) // 3)
+        return bytes(rv)
+    if colour_type == 0:
+        return b"".join(struct.pack("4B", value, value, value, 255) for value in line)
+    if colour_type == 4:
+        return b"".join(struct.pack("4B", line[i], line[i], line[i], line[i + 1])
+                        for i in range(0, len(line), 2))
+    return b"".join(palette[value] for value in line)
+
+
+def decode_png(data):
+    """Decode a PNG without PIL
+
+    :param data: PNG as bytes
+    :raises ValueError: If the image isn't an 8 bit, non-interlaced PNG"""
+    header = None
+    palette = None
+    idat = []
+    transparency = b""
+    for chunk_type, chunk in read_chunks(data):
+        if chunk_type == b"IHDR":
+            header = struct.unpack(">IIBBBBB", chunk)
+        elif chunk_type == b"PLTE":
+            palette = chunk
+        elif chunk_type == b"tRNS":
+            transparency = chunk
+        elif chunk_type == b"IDAT":
+            idat.append(chunk)
+        elif chunk_type == b"IEND":
+            break
+    if header is None:
+        raise ValueError("PNG has no header")
+    width, height, bit_depth, colour_type, _, _, interlace = header
+    if bit_depth != 8 or colour_type not in channels or interlace:
+        raise ValueError("Unsupported PNG format")
+
+    if colour_type == 3:
+        if palette is None:
+            raise ValueError("PNG has no palette")
+        transparency = bytearray(transparency)
+        palette = [palette[i * 3:i * 3 + 3] +
+                   struct.pack("B", transparency[i] if i < len(transparency) else 255)
+                   for i in range(len(palette) // 3)]
+
+    bpp = channels[colour_type]
+    stride = width * bpp
+    raw = bytearray(zlib.decompress(b"".join(idat)))
+    if len(raw) < (stride + 1) * height:
+        raise ValueError("PNG data is truncated")
+
+    rows = []
+    prev = bytearray(stride)
+    for y in range(height):
+        start = y * (stride + 1)
+        line = raw[start + 1:start + 1 + stride]
+        unfilter(raw[start], line, prev, bpp)
+        rows.append(to_rgba(line, colour_type, palette))
+        prev = line
+    return DecodedImage(width, height, rows)
+
+
+def fast_decode_available():
+    """Whether screenshots are decoded with PIL rather than the pure Python
+    decoder"""
+    return Image is not None
+
+
+def decode(screenshot):
+    """Decode a base64 encoded PNG screenshot into a DecodedImage"""
+    try:
+        data = base64.b64decode(screenshot)
+    except (TypeError, binascii.Error) as e:
+        raise ValueError("Invalid base64 data: %s" % e)
+    if Image is None:
+        return decode_png(data)
+    try:
+        image = Image.open(BytesIO(data)).convert("RGBA")
+    except (IOError, SyntaxError) as e:
+        raise ValueError(str(e))
+    width, height = image.size
+    pixels = image.tobytes()
+    stride = width * 4
+    return DecodedImage(width, height, [pixels[y * stride:(y + 1) * stride]
+                                        for y in range(height)])
+
+
+def encode_png(width, height, rows):
+    """Encode rows of RGBA bytes as a PNG"""
+    def chunk(chunk_type, data):
+        return (struct.pack(">I", len(data)) + chunk_type + data +
+                struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    raw = b"".join(b"\x00" + row for row in rows)
+    return b"".join([png_signature,
+                     chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+                     chunk(b"IDAT", zlib.compress(raw)),
+                     chunk(b"IEND", b"")])
+
+
+class ImageDiff(object):
+    """Differences between two screenshots.
+
+    :param lhs: base64 encoded PNG
+    :param rhs: base64 encoded PNG
+    :raises ValueError: If either image can't be decoded
+    """
+
+    def __init__(self, lhs, rhs):
+        self.lhs = decode(lhs)
+        self.rhs = decode(rhs)
+        self.size_differs = (self.lhs.width, self.lhs.height) != (self.rhs.width,
+                                                                 self.rhs.height)
+        # Per row list of per pixel booleans for rows that differ
+        self._masks = {}
+        if self.size_differs:
+            self.max_difference = 255
+            self.differing_pixels = max(self.lhs.width * self.lhs.height,
+                                        self.rhs.width * self.rhs.height)
+        elif numpy is not None:
+            self._compare_numpy()
+        else:
+            self._compare_rows()
+
+    def _compare_numpy(self):
+        width = self.lhs.width
+        lhs = numpy.frombuffer(b"".join(self.lhs.rows), dtype=numpy.uint8)
+        rhs = numpy.frombuffer(b"".join(self.rhs.rows), dtype=numpy.uint8)
+        difference = numpy.abs(lhs.astype(numpy.int16) - rhs.astype(numpy.int16))
+        per_pixel = difference.reshape(-1, 4).max(axis=1)
+        self.max_difference = int(per_pixel.max()) if per_pixel.size else 0
+        differs = per_pixel > 0
+        self.differing_pixels = int(differs.sum())
+        for y in numpy.flatnonzero(differs.reshape(-1, width).any(axis=1)):
+            self._masks[int(y)] = differs[y * width:(y + 1) * width].tolist()
+
+    def _compare_rows(self):
+        self.max_difference = 0
+        self.differing_pixels = 0
+        for y, (lhs_row, rhs_row) in enumerate(zip(self.lhs.rows, self.rhs.rows)):
+            if lhs_row == rhs_row:
+                continue
+            lhs_row = bytearray(lhs_row)
+            rhs_row = bytearray(rhs_row)
+            mask = []
+            for x in range(0, len(lhs_row), 4):
+                difference = max(abs(lhs_row[x + i] - rhs_row[x + i]) for i in range(4))
+                mask.append(difference > 0)
+                if difference:
+                    self.differing_pixels += 1
+                    if difference > self.max_difference:
+                        self.max_difference = difference
+            self._masks[y] = mask
+
+    def matches(self, fuzzy):
+        """Check whether the images are equal within the tolerance from
+        parse_fuzzy, or exactly equal if fuzzy is None"""
+        if self.size_differs:
+            return False
+        return fuzzy_match(fuzzy, self.max_difference, self.differing_pixels)
+
+    def image(self):
+        """Get an image of the differences, in which differing pixels are
+        red and the rest show the first image faded.
+
+        :returns: base64 encoded PNG, or None if the images have different
+                  sizes"""
+        if self.size_differs:
+            return None
+        rows = []
+        for y, row in enumerate(self.lhs.rows):
+            faded = row.translate(fade_table)
+            mask = self._masks.get(y)
+            if mask is not None:
+                faded = b"".join(diff_colour if differs else faded[x * 4:x * 4 + 4]
+                                 for x, differs in enumerate(mask))
+            rows.append(faded)
+        return base64.b64encode(encode_png(self.lhs.width, self.lhs.height, rows))
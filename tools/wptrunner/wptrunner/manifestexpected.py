@@ -33,6 +33,14 @@ def bool_prop(name, node):
         return None
 
 
+def str_prop(name, node):
+    """String property"""
+    try:
+        return node.get(name)
+    except KeyError:
+        return None
+
+
 def tags(node):
     """Set of tags that have been applied to the test"""
     try:
@@ -123,6 +131,10 @@ class ExpectedManifest(ManifestItem):
     def prefs(self):
         return prefs(self)
 
+    @property
+    def fuzzy(self):
+        return str_prop("fuzzy", self)
+
 
 class DirectoryManifest(ManifestItem):
     @property
@@ -145,6 +157,10 @@ class DirectoryManifest(ManifestItem):
     def prefs(self):
         return prefs(self)
 
+    @property
+    def fuzzy(self):
+        return str_prop("fuzzy", self)
+
 
 class TestNode(ManifestItem):
     def __init__(self, name):
@@ -194,6 +210,10 @@ class TestNode(ManifestItem):
     def prefs(self):
         return prefs(self)
 
+    @property
+    def fuzzy(self):
+        return str_prop("fuzzy", self)
+
     def append(self, node):
         """Add a subtest to the current test
 
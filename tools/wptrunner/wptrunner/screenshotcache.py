@@ -0,0 +1,473 @@
+"""Caches of reftest screenshot hashes.
+
+ScreenshotStore holds the hashes of the screenshots taken during a run,
+shared between the test processes. SharedScreenshotCache is the client
+used by each process; it keeps the hashes it has seen locally, so only
+unknown keys need a round trip to the store.
+
+ScreenshotCache is an optional persistent cache of the hashes of
+references. Its entries are keyed by a hash of the reference file and
+the subresources it loads from the test server, together with a hash of
+the browser build and run info. A reference whose key is in the cache
+doesn't need to be rendered again, so the cache can be kept between runs
+(and shared between jobs) to skip rendering unchanged references.
+
+Only documents whose rendering is known to depend on nothing but those
+files are cached. Anything that runs script, loads resources generated
+by the server, or loads resources that can't be mapped to a file is
+treated as uncacheable."""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+from collections import OrderedDict
+from multiprocessing.managers import SyncManager
+
+format_version = 1
+
+# Entries that haven't been used for this long are dropped when the cache
+# is saved
+max_age = 30 * 24 * 60 * 60
+
+# Command line arguments, other than the binary itself, that may change the
+# rendering of a page
+environment_args = ["binary_args", "webdriver_binary", "webdriver_args",
+                    "extra_prefs", "prefs_root", "install_fonts", "font_dir"]
+
+document_extensions = (".html", ".htm", ".xhtml", ".xht", ".svg", ".xml")
+
+tag_re = re.compile(r"<\s*([a-zA-Z][\w:.-]*)((?:[^>\"']|\"[^\"]*\"|'[^']*')*)>")
+xml_stylesheet_re = re.compile(r"<\?xml-stylesheet((?:[^>\"']|\"[^\"]*\"|'[^']*')*)\?>")
+attr_re = re.compile(r"""([^\s=/>"']+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+css_url_re = re.compile(r"""url\(\s*(?:"([^"]*)"|'([^']*)'|([^)\s]*))\s*\)|"""
+                        r"""@import\s+(?:"([^"]*)"|'([^']*)')""")
+
+url_attrs = set(["src", "href", "xlink:href", "data", "poster"])
+link_rels = set(["stylesheet", "import", "icon"])
+
+
+class Uncacheable(Exception):
+    """The rendering of a document may depend on more than the files it
+    loads, so it can't be cached"""
+    pass
+
+
+def environment_key(product, run_info, **kwargs):
+    """Get a hash identifying the browser and its configuration.
+
+    :param product: Name of the product being tested
+    :param run_info: RunInfo for the run
+    :param kwargs: Command line arguments
+    """
+    binary = kwargs.get("binary")
+    binary_stat = None
+    if binary and os.path.exists(binary):
+        stat = os.stat(binary)
+        binary_stat = [stat.st_mtime, stat.st_size]
+
+    data = {"version": format_version,
+            "product": product,
+            "run_info": dict(run_info),
+            "binary": binary,
+            "binary_stat": binary_stat}
+    for name in environment_args:
+        if name in kwargs:
+            data[name] = kwargs[name]
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=repr)).hexdigest()
+
+
+def attributes(data):
+    rv = {}
+    for match in attr_re.finditer(data):
+        name = match.group(1).lower()
+        value = next((item for item in match.groups()[1:] if item is not None), "")
+        rv[name] = value
+    return rv
+
+
+def css_subresources(data):
+    for match in css_url_re.finditer(data):
+        yield next(item for item in match.groups() if item is not None)
+
+
+def document_subresources(data):
+    """Get the urls of the subresources of a HTML, XHTML or SVG document.
+
+    :raises Uncacheable: If the document can run script or has urls that
+                         can't be resolved statically"""
+    for match in xml_stylesheet_re.finditer(data):
+        href = attributes(match.group(1)).get("href")
+        if href:
+            yield href
+
+    for match in tag_re.finditer(data):
+        name = match.group(1).lower()
+        if name in ("script", "base"):
+            raise Uncacheable("Document has a %s element" % name)
+        attrs = attributes(match.group(2))
+        if "srcset" in attrs or any(attr.startswith("on") for attr in attrs):
+            raise Uncacheable("Document has a %s element with dynamic attributes" % name)
+        if name == "meta" and attrs.get("http-equiv", "").lower() == "refresh":
+            raise Uncacheable("Document has a meta refresh")
+        if name == "a":
+            continue
+        if name == "link" and not link_rels & set(attrs.get("rel", "").lower().split()):
+            continue
+        for attr in url_attrs:
+            if attrs.get(attr):
+                yield attrs[attr]
+
+    for url in css_subresources(data):
+        yield url
+
+
+def subresources(path, data):
+    if path.endswith(document_extensions):
+        return document_subresources(data)
+    if path.endswith(".css"):
+        return css_subresources(data)
+    return iter([])
+
+
+def resolve(base_url, url):
+    """Resolve a url used in a document to a path on the test server
+
+    :returns: The path, or None if the url doesn't load anything from the
+              server"""
+    url = url.strip()
+    if not url or url.startswith("#") or url.startswith("data:"):
+        # The content is already part of the document
+        return None
+    parts = urlparse.urlsplit(urlparse.urljoin(base_url, url))
+    if parts.scheme or parts.netloc or parts.query:
+        raise Uncacheable("Can't resolve url %s" % url)
+    return parts.path
+
+
+def read_headers(path):
+    rv = []
+    for headers_path in [path + ".headers",
+                         os.path.join(os.path.dirname(path), "__dir__.headers")]:
+        if os.path.isfile(headers_path):
+            with open(headers_path, "rb") as f:
+                rv.append(f.read())
+    return rv
+
+
+class PersistentScreenshotStore(object):
+    """Entries of a ScreenshotCache, along with counts of how lookups
+    went.
+
+    This lives in the manager process and is used through a proxy, so
+    each method call is a round trip; a lookup updates the entry's time
+    and the counts in the same call.
+
+    :param entries: Dictionary of key: [screenshot hash, time last used]
+    """
+
+    def __init__(self, entries=None):
+        self._entries = entries or {}
+        self._stats = {"hits": 0, "misses": 0, "uncacheable": 0}
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """Get the screenshot hash stored for a key, or None. A key of None
+        is counted as an uncacheable reference."""
+        with self._lock:
+            if key is None:
+                self._stats["uncacheable"] += 1
+                return None
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            entry[1] = time.time()
+            return entry[0]
+
+    def set(self, key, hash_value):
+        with self._lock:
+            self._entries[key] = [hash_value, time.time()]
+
+    def entries(self):
+        with self._lock:
+            return {key: list(entry) for key, entry in self._entries.iteritems()}
+
+    def stats(self):
+        with self._lock:
+            return self._stats.copy()
+
+    def reset_stats(self):
+        with self._lock:
+            for name in self._stats:
+                self._stats[name] = 0
+
+
+class ScreenshotCache(object):
+    """Mapping from reference content to screenshot hashes that can be
+    shared between processes and saved to disk.
+
+    :param path: Path to the file holding the cache
+    :param env_key: Hash identifying the browser, from environment_key()
+    :param store: PersistentScreenshotStore holding the entries, or a
+                  proxy for one
+    """
+
+    def __init__(self, path, env_key, store):
+        self.path = path
+        self.env_key = env_key
+        self.store = store
+        # Per process cache of (tests_root, url): content hash, or None
+        # for uncacheable references
+        self._content_hashes = {}
+
+    @classmethod
+    def load(cls, path, cache_manager, env_key):
+        """Create a cache holding the entries saved at path, if any.
+
+        :param cache_manager: multiprocessing.Manager used to share the
+                              cache between processes"""
+        return cls(path, env_key, cache_manager.PersistentScreenshotStore(cls.read(path)))
+
+    def __getstate__(self):
+        rv = self.__dict__.copy()
+        rv["_content_hashes"] = {}
+        return rv
+
+    @staticmethod
+    def read(path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if data.get("version") != format_version:
+            return {}
+        return data.get("entries", {})
+
+    def key(self, test, viewport_size, dpi):
+        """Get the key for a screenshot of a test
+
+        :returns: The key, or None if the test can't be cached"""
+        memo_key = (test.tests_root, test.url)
+        if memo_key not in self._content_hashes:
+            try:
+                content_hash = self.content_hash(test)
+            except Uncacheable:
+                content_hash = None
+            self._content_hashes[memo_key] = content_hash
+        content_hash = self._content_hashes[memo_key]
+        if content_hash is None:
+            return None
+        data = json.dumps([self.env_key, test.url, content_hash, viewport_size, dpi])
+        return hashlib.sha1(data).hexdigest()
+
+    def content_hash(self, test):
+        """Get a hash of the files that a test loads
+
+        :raises Uncacheable: If the test may load something other than
+                             static files"""
+        parts = urlparse.urlsplit(test.url)
+        if parts.query:
+            raise Uncacheable("Test url has a query")
+
+        url_base = "/"
+        if test.path:
+            rel_path = test.path.replace(os.path.sep, "/")
+            if parts.path.endswith(rel_path):
+                url_base = parts.path[:-len(rel_path)]
+
+        hashes = {}
+        stack = [parts.path]
+        while stack:
+            url_path = stack.pop()
+            if url_path in hashes:
+                continue
+            path = self.local_path(test.tests_root, url_base, url_path)
+            with open(path, "rb") as f:
+                data = f.read()
+            file_hash = hashlib.sha1(data)
+            for headers in read_headers(path):
+                file_hash.update(headers)
+            hashes[url_path] = file_hash.hexdigest()
+            for url in subresources(path, data):
+                resource_path = resolve(url_path, url)
+                if resource_path is not None:
+                    stack.append(resource_path)
+
+        return hashlib.sha1("\n".join("%s %s" % item
+                                      for item in sorted(hashes.items()))).hexdigest()
+
+    def local_path(self, tests_root, url_base, url_path):
+        if not url_path.startswith(url_base):
+            raise Uncacheable("%s is outside %s" % (url_path, url_base))
+        rel_path = urllib.unquote(url_path[len(url_base):])
+        path = os.path.join(tests_root, *rel_path.split("/"))
+        name = os.path.basename(path)
+        if name.endswith((".py", ".asis")) or ".sub." in name:
+            raise Uncacheable("%s is generated by the server" % url_path)
+        if not os.path.isfile(path):
+            raise Uncacheable("%s isn't a file" % url_path)
+        return path
+
+    def get(self, key):
+        """Get the screenshot hash stored for a key, or None"""
+        return self.store.lookup(key)
+
+    def set(self, key, hash_value):
+        if key is not None:
+            self.store.set(key, hash_value)
+
+    def reset_stats(self):
+        self.store.reset_stats()
+
+    def summary(self):
+        stats = self.store.stats()
+        cacheable = stats["hits"] + stats["misses"]
+        hit_rate = 100. * stats["hits"] / cacheable if cacheable else 0.
+        return ("Reftest screenshot cache: %i hits, %i misses, %i uncacheable "
+                "(%.1f%% hit rate)" % (stats["hits"], stats["misses"],
+                                       stats["uncacheable"], hit_rate))
+
+    def save(self):
+        """Write the cache to disk, merging it with any entries that other
+        runs have saved since it was loaded"""
+        now = time.time()
+        entries = self.read(self.path)
+        for key, entry in self.store.entries().iteritems():
+            if key not in entries or entries[key][1] < entry[1]:
+                entries[key] = entry
+        entries = {key: entry for key, entry in entries.iteritems()
+                   if now - entry[1] < max_age}
+
+        dir_name = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=dir_name, prefix=".screenshot-cache")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": format_version, "entries": entries}, f)
+            if os.name == "nt" and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+class ScreenshotStore(object):
+    """Hashes of the screenshots taken during a run, along with the
+    screenshots themselves for failing tests.
+
+    This lives in the manager process and is used through a proxy, so
+    each method call is a round trip; callers should use
+    SharedScreenshotCache rather than using it directly.
+
+    :param max_size: Maximum number of bytes of screenshot data to hold.
+                     The least recently used screenshots are dropped
+                     beyond this; hashes are never dropped.
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.hashes = {}
+        self.screenshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_hashes(self, keys):
+        """Get the hashes of those keys that have one
+
+        :returns: Dictionary of key: hash"""
+        with self._lock:
+            return {key: self.hashes[key] for key in keys if key in self.hashes}
+
+    def set_hash(self, key, hash_value):
+        with self._lock:
+            self.hashes[key] = hash_value
+
+    def get_screenshot(self, key):
+        """Get a stored screenshot, or None"""
+        with self._lock:
+            screenshot = self.screenshots.pop(key, None)
+            if screenshot is not None:
+                self.screenshots[key] = screenshot
+            return screenshot
+
+    def set_screenshot(self, key, screenshot):
+        with self._lock:
+            old = self.screenshots.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            if len(screenshot) > self.max_size:
+                return
+            self.screenshots[key] = screenshot
+            self.size += len(screenshot)
+            while self.size > self.max_size:
+                _, evicted = self.screenshots.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {"hashes": len(self.hashes),
+                    "screenshots": len(self.screenshots),
+                    "size": self.size}
+
+
+class CacheManager(SyncManager):
+    """multiprocessing manager that can also create ScreenshotStores and
+    PersistentScreenshotStores"""
+    pass
+
+CacheManager.register("ScreenshotStore", ScreenshotStore)
+CacheManager.register("PersistentScreenshotStore", PersistentScreenshotStore)
+
+
+class SharedScreenshotCache(object):
+    """Per process read-through cache in front of a ScreenshotStore.
+
+    A key's hash doesn't change once it has been set, so hashes are kept
+    locally once they are known. Screenshots are only ever needed for
+    failing tests, so they aren't cached locally.
+
+    :param store: ScreenshotStore, or a proxy for one
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._hashes = {}
+
+    def __getstate__(self):
+        return {"store": self.store}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_hashes(self, keys):
+        """Get the hashes of those keys that have one, with a single round
+        trip to the store for all the keys not known locally.
+
+        :returns: Dictionary of key: hash"""
+        missing = [key for key in keys if key not in self._hashes]
+        if missing:
+            self._hashes.update(self.store.get_hashes(missing))
+        return {key: self._hashes[key] for key in keys if key in self._hashes}
+
+    def get_hash(self, key):
+        """Get the hash for a key, or None"""
+        return self.get_hashes([key]).get(key)
+
+    def set_hash(self, key, hash_value):
+        self._hashes[key] = hash_value
+        self.store.set_hash(key, hash_value)
+
+    def get_screenshot(self, key):
+        return self.store.get_screenshot(key)
+
+    def set_screenshot(self, key, screenshot):
+        self.store.set_screenshot(key, screenshot)
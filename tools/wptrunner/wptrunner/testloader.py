@@ -1,4 +1,5 @@
 import hashlib
+import heapq
 import json
 import os
 import urlparse
@@ -589,6 +590,17 @@ class GroupedSource(TestSource):
     def new_group(cls, state, test, **kwargs):
         raise NotImplementedError
 
+    @classmethod
+    def starts_group(cls, state, test, **kwargs):
+        """Check whether a test starts a new group. A group only ever
+        contains tests of one type, so that when several test types share
+        the same queue each group is run with a single executor."""
+        rv = cls.new_group(state, test, **kwargs)
+        if test.test_type != state.get("prev_test_type"):
+            rv = True
+        state["prev_test_type"] = test.test_type
+        return rv
+
     @classmethod
     def make_queue(cls, tests, **kwargs):
         test_queue = Queue()
@@ -597,7 +609,7 @@ class GroupedSource(TestSource):
         state = {}
 
         for test in tests:
-            if cls.new_group(state, test, **kwargs):
+            if cls.starts_group(state, test, **kwargs):
                 groups.append((deque(), {}))
 
             group, metadata = groups[-1]
@@ -614,16 +626,18 @@ class SingleTestSource(TestSource):
     def make_queue(cls, tests, **kwargs):
         test_queue = Queue()
         processes = kwargs["processes"]
-        queues = [deque([]) for _ in xrange(processes)]
-        metadatas = [{} for _ in xrange(processes)]
+        # Tests are split between processes separately for each test type,
+        # since a group is run with a single executor
+        groups = OrderedDict()
         for test in tests:
-            idx = hash(test.id) % processes
-            group = queues[idx]
-            metadata = metadatas[idx]
+            key = (test.test_type, hash(test.id) % processes)
+            if key not in groups:
+                groups[key] = (deque([]), {})
+            group, metadata = groups[key]
             group.append(test)
             test.update_metadata(metadata)
 
-        for item in zip(queues, metadatas):
+        for item in groups.itervalues():
             test_queue.put(item)
 
         return test_queue
@@ -639,3 +653,151 @@ class PathGroupedSource(GroupedSource):
         rv = path != state.get("prev_path")
         state["prev_path"] = path
         return rv
+
+
+class DurationGroupedSource(PathGroupedSource):
+    """Source that queues groups of tests longest first, using the
+    durations of the tests in previous runs.
+
+    Tests are grouped by directory as for PathGroupedSource. Every
+    TestRunnerManager takes the next group from the shared queue when it
+    finishes one, so queuing the groups in decreasing order of duration
+    gives a longest processing time first schedule, in which processes
+    that get through their groups quickly take on more of the remaining
+    ones.
+
+    If depth is False, the tests of each type are instead split between
+    one group per process, as for SingleTestSource, since the browser is
+    restarted between groups. Each test is added to the group with the
+    shortest total duration so far, longest test first."""
+
+    @classmethod
+    def make_queue(cls, tests, **kwargs):
+        durations = kwargs["durations"]
+        default_duration = median(durations.values()) if durations else 1.
+
+        if kwargs.get("depth") is False:
+            groups = cls.balanced_groups(tests, durations, default_duration,
+                                         kwargs["processes"])
+        else:
+            groups = []
+            state = {}
+            for test in tests:
+                if cls.starts_group(state, test, **kwargs):
+                    groups.append([0., deque(), {}])
+                group = groups[-1]
+                group[0] += durations.get(test.id, default_duration)
+                group[1].append(test)
+                test.update_metadata(group[2])
+
+        # The sort is stable, so groups with the same duration stay in order
+        groups.sort(key=lambda item: -item[0])
+
+        test_queue = Queue()
+        for _, group, metadata in groups:
+            test_queue.put((group, metadata))
+
+        logger = structured.get_default_logger()
+        if logger is not None:
+            known = sum(1 for test in tests if test.id in durations)
+            logger.info("Predicted time for %i groups on %i processes: %.1fs "
+                        "(durations known for %i of %i tests)" %
+                        (len(groups), kwargs["processes"],
+                         predict_makespan([item[0] for item in groups], kwargs["processes"]),
+                         known, len(tests)))
+        return test_queue
+
+    @staticmethod
+    def balanced_groups(tests, durations, default_duration, processes):
+        """Split the tests of each type into at most processes groups with
+        similar total durations.
+
+        :returns: List of [total duration, deque of tests, group metadata]"""
+        tests_by_type = OrderedDict()
+        for index, test in enumerate(tests):
+            duration = durations.get(test.id, default_duration)
+            tests_by_type.setdefault(test.test_type, []).append((duration, index, test))
+
+        groups = []
+        for type_tests in tests_by_type.itervalues():
+            # Heap of [total duration, group number, [(index, test)]]
+            bins = [[0., i, []] for i in xrange(min(processes, len(type_tests)))]
+            for duration, index, test in sorted(type_tests, key=lambda item: (-item[0], item[1])):
+                item = heapq.heappop(bins)
+                item[0] += duration
+                item[2].append((index, test))
+                heapq.heappush(bins, item)
+
+            for total, _, indexed_tests in sorted(bins, key=lambda item: item[1]):
+                group, metadata = deque(), {}
+                # Tests within a group run in their original order
+                for _, test in sorted(indexed_tests, key=lambda item: item[0]):
+                    group.append(test)
+                    test.update_metadata(metadata)
+                groups.append([total, group, metadata])
+        return groups
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.
+
+
+def predict_makespan(durations, processes):
+    """Predict the time taken to run groups of tests, by giving each group
+    in turn to the process that becomes free first
+
+    :param durations: Durations of the groups, in the order they are queued
+    :param processes: Number of processes running the groups"""
+    finish_times = [0.] * processes
+    for duration in durations:
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + duration)
+    return max(finish_times)
+
+
+def iter_durations(f):
+    """Get the durations of tests from a mozlog raw log or wptreport JSON
+    file
+
+    :returns: Iterator of (test id, duration in seconds)"""
+    data = f.read()
+    try:
+        report = json.loads(data)
+    except ValueError:
+        report = None
+    if isinstance(report, dict) and "results" in report:
+        for result in report["results"]:
+            if result.get("duration") is not None:
+                yield result["test"], result["duration"] / 1000.
+        return
+
+    start_times = {}
+    for line in data.splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(entry, dict) or "test" not in entry:
+            continue
+        if entry.get("action") == "test_start":
+            start_times[entry["test"]] = entry["time"]
+        elif entry.get("action") == "test_end" and entry["test"] in start_times:
+            yield entry["test"], (entry["time"] - start_times.pop(entry["test"])) / 1000.
+
+
+def load_durations(paths):
+    """Load the durations of tests from the logs of previous runs
+
+    :param paths: Paths to mozlog raw logs or wptreport JSON files
+    :returns: Dictionary of test id: mean duration in seconds"""
+    totals = defaultdict(float)
+    counts = defaultdict(int)
+    for path in paths:
+        with open(path) as f:
+            for test_id, duration in iter_durations(f):
+                totals[test_id] += duration
+                counts[test_id] += 1
+    return {test_id: totals[test_id] / counts[test_id] for test_id in totals}
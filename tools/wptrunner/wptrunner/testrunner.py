@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 import multiprocessing
 import sys
 import threading
+import time
 import traceback
 from Queue import Empty
 from collections import namedtuple
@@ -246,10 +247,16 @@ class _RunnerManagerState(object):
 RunnerManagerState = _RunnerManagerState()
 
 
+# The classes and arguments used to run tests of a single type
+TestImplementation = namedtuple("TestImplementation",
+                                ["executor_cls", "executor_kwargs",
+                                 "browser_cls", "browser_kwargs"])
+
+
 class TestRunnerManager(threading.Thread):
-    def __init__(self, suite_name, test_queue, test_source_cls, browser_cls, browser_kwargs,
-                 executor_cls, executor_kwargs, stop_flag, pause_after_test=False,
-                 pause_on_unexpected=False, restart_on_unexpected=True, debug_info=None):
+    def __init__(self, suite_name, test_queue, test_source_cls, test_implementations,
+                 stop_flag, pause_after_test=False, pause_on_unexpected=False,
+                 restart_on_unexpected=True, debug_info=None):
         """Thread that owns a single TestRunner process and any processes required
         by the TestRunner (e.g. the Firefox binary).
 
@@ -264,16 +271,26 @@ class TestRunnerManager(threading.Thread):
         * Log the test results
         * Take any remedial action required e.g. restart crashed or hung
           processes
+
+        The test queue may contain tests of several types. The TestRunner is
+        restarted with the executor for the type of each group of tests; the
+        Browser is only replaced if the new type needs a different browser
+        class or browser arguments.
+
+        :param test_implementations: Dictionary of test type: TestImplementation
         """
         self.suite_name = suite_name
 
         self.test_source = test_source_cls(test_queue)
 
-        self.browser_cls = browser_cls
-        self.browser_kwargs = browser_kwargs
+        self.test_implementations = test_implementations
+        self.test_type = None
+
+        self.browser_cls = None
+        self.browser_kwargs = None
 
-        self.executor_cls = executor_cls
-        self.executor_kwargs = executor_kwargs
+        self.executor_cls = None
+        self.executor_kwargs = None
 
         # Flags used to shut down this thread if we get a sigint
         self.parent_stop_flag = stop_flag
@@ -313,53 +330,49 @@ class TestRunnerManager(threading.Thread):
         that the manager should shut down the next time the event loop
         spins."""
         self.logger = structuredlog.StructuredLogger(self.suite_name)
-        with self.browser_cls(self.logger, **self.browser_kwargs) as browser:
-            self.browser = BrowserManager(self.logger,
-                                          browser,
-                                          self.command_queue,
-                                          no_timeout=self.debug_info is not None)
-            dispatch = {
-                RunnerManagerState.before_init: self.start_init,
-                RunnerManagerState.initializing: self.init,
-                RunnerManagerState.running: self.run_test,
-                RunnerManagerState.restarting: self.restart_runner
-            }
+        dispatch = {
+            RunnerManagerState.before_init: self.start_init,
+            RunnerManagerState.initializing: self.init,
+            RunnerManagerState.running: self.run_test,
+            RunnerManagerState.restarting: self.restart_runner
+        }
 
-            self.state = RunnerManagerState.before_init()
-            end_states = (RunnerManagerState.stop,
-                          RunnerManagerState.error)
+        self.state = RunnerManagerState.before_init()
+        end_states = (RunnerManagerState.stop,
+                      RunnerManagerState.error)
 
-            try:
-                while not isinstance(self.state, end_states):
-                    f = dispatch.get(self.state.__class__)
-                    while f:
-                        self.logger.debug("Dispatch %s" % f.__name__)
-                        if self.should_stop():
-                            return
-                        new_state = f()
-                        if new_state is None:
-                            break
-                        self.state = new_state
-                        self.logger.debug("new state: %s" % self.state.__class__.__name__)
-                        if isinstance(self.state, end_states):
-                            return
-                        f = dispatch.get(self.state.__class__)
-
-                    new_state = None
-                    while new_state is None:
-                        new_state = self.wait_event()
-                        if self.should_stop():
-                            return
+        try:
+            while not isinstance(self.state, end_states):
+                f = dispatch.get(self.state.__class__)
+                while f:
+                    self.logger.debug("Dispatch %s" % f.__name__)
+                    if self.should_stop():
+                        return
+                    new_state = f()
+                    if new_state is None:
+                        break
                     self.state = new_state
                     self.logger.debug("new state: %s" % self.state.__class__.__name__)
-            except Exception as e:
-                self.logger.error(traceback.format_exc(e))
-                raise
-            finally:
-                self.logger.debug("TestRunnerManager main loop terminating, starting cleanup")
-                clean = isinstance(self.state, RunnerManagerState.stop)
-                self.stop_runner(force=not clean)
-                self.teardown()
+                    if isinstance(self.state, end_states):
+                        return
+                    f = dispatch.get(self.state.__class__)
+
+                new_state = None
+                while new_state is None:
+                    new_state = self.wait_event()
+                    if self.should_stop():
+                        return
+                self.state = new_state
+                self.logger.debug("new state: %s" % self.state.__class__.__name__)
+        except Exception as e:
+            self.logger.error(traceback.format_exc(e))
+            raise
+        finally:
+            self.logger.debug("TestRunnerManager main loop terminating, starting cleanup")
+            clean = isinstance(self.state, RunnerManagerState.stop)
+            self.stop_runner(force=not clean)
+            self.teardown()
+            self.close_browser()
         self.logger.debug("TestRunnerManager main loop terminated")
 
     def wait_event(self):
@@ -391,6 +404,7 @@ class TestRunnerManager(threading.Thread):
             return RunnerManagerState.restarting(0)
         except Empty:
             if (self.debug_info and self.debug_info.interactive and
+                self.browser is not None and
                 self.browser.started and not self.browser.is_alive()):
                 self.logger.debug("Debugger exited")
                 return RunnerManagerState.stop()
@@ -439,6 +453,7 @@ class TestRunnerManager(threading.Thread):
             self.logger.error("Max restarts exceeded")
             return RunnerManagerState.error()
 
+        self.use_implementation(self.state.test.test_type)
         self.browser.update_settings(self.state.test)
 
         result = self.browser.init()
@@ -453,6 +468,40 @@ class TestRunnerManager(threading.Thread):
             self.executor_kwargs["group_metadata"] = self.state.group_metadata
             self.start_test_runner()
 
+    def use_implementation(self, test_type):
+        """Set up the executor for a test type, and the browser if it differs
+        from the one used for the previous type. This must only be called
+        when the TestRunner and the browser process are stopped."""
+        if test_type == self.test_type:
+            return
+        implementation = self.test_implementations[test_type]
+        self.logger.debug("Using the %s executor" % test_type)
+        self.test_type = test_type
+        self.executor_cls = implementation.executor_cls
+        self.executor_kwargs = implementation.executor_kwargs
+
+        if (self.browser is not None and
+            implementation.browser_cls == self.browser_cls and
+            implementation.browser_kwargs == self.browser_kwargs):
+            return
+
+        self.close_browser()
+        self.logger.debug("Setting up browser for %s tests" % test_type)
+        browser = implementation.browser_cls(self.logger, **implementation.browser_kwargs)
+        browser.setup()
+        self.browser_cls = implementation.browser_cls
+        self.browser_kwargs = implementation.browser_kwargs
+        self.browser = BrowserManager(self.logger,
+                                      browser,
+                                      self.command_queue,
+                                      no_timeout=self.debug_info is not None)
+
+    def close_browser(self):
+        """Do the browser-specific cleanup for the current browser, if any"""
+        if self.browser is not None:
+            self.browser.cleanup()
+            self.browser = None
+
     def start_test_runner(self):
         # Note that we need to be careful to start the browser before the
         # test runner to ensure that any state set when the browser is started
@@ -594,7 +643,8 @@ class TestRunnerManager(threading.Thread):
         test, test_group, group_metadata = self.get_next_test()
         if test is None:
             return RunnerManagerState.stop()
-        if test_group != self.state.test_group:
+        if (test_group != self.state.test_group or
+            test.test_type != self.state.test.test_type):
             # We are starting a new group of tests, so force a restart
             restart = True
         if restart:
@@ -683,21 +733,20 @@ def make_test_queue(tests, test_source_cls, **test_source_kwargs):
 
 class ManagerGroup(object):
     def __init__(self, suite_name, size, test_source_cls, test_source_kwargs,
-                 browser_cls, browser_kwargs,
-                 executor_cls, executor_kwargs,
+                 test_implementations,
                  pause_after_test=False,
                  pause_on_unexpected=False,
                  restart_on_unexpected=True,
                  debug_info=None):
-        """Main thread object that owns all the TestManager threads."""
+        """Main thread object that owns all the TestManager threads.
+
+        :param test_implementations: Dictionary of test type: TestImplementation
+                                     for each type that the group may run"""
         self.suite_name = suite_name
         self.size = size
         self.test_source_cls = test_source_cls
         self.test_source_kwargs = test_source_kwargs
-        self.browser_cls = browser_cls
-        self.browser_kwargs = browser_kwargs
-        self.executor_cls = executor_cls
-        self.executor_kwargs = executor_kwargs
+        self.test_implementations = test_implementations
         self.pause_after_test = pause_after_test
         self.pause_on_unexpected = pause_on_unexpected
         self.restart_on_unexpected = restart_on_unexpected
@@ -715,24 +764,31 @@ class ManagerGroup(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop()
 
-    def run(self, test_type, tests):
-        """Start all managers in the group"""
+    def run(self, test_types, tests):
+        """Start all managers in the group
+
+        :param test_types: List of the test types to run. Tests of all these
+                           types are put in a single queue, from which every
+                           manager takes groups of tests.
+        :param tests: Dictionary of test type: list of tests"""
         self.logger.debug("Using %i processes" % self.size)
-        type_tests = tests[test_type]
-        if not type_tests:
-            self.logger.info("No %s tests to run" % test_type)
+        type_names = ", ".join(test_types)
+        queued_tests = []
+        for test_type in test_types:
+            queued_tests.extend(tests[test_type])
+        if not queued_tests:
+            self.logger.info("No %s tests to run" % type_names)
             return
 
-        test_queue = make_test_queue(type_tests, self.test_source_cls, **self.test_source_kwargs)
+        start_time = time.time()
+        test_queue = make_test_queue(queued_tests, self.test_source_cls,
+                                     **self.test_source_kwargs)
 
         for _ in range(self.size):
             manager = TestRunnerManager(self.suite_name,
                                         test_queue,
                                         self.test_source_cls,
-                                        self.browser_cls,
-                                        self.browser_kwargs,
-                                        self.executor_cls,
-                                        self.executor_kwargs,
+                                        self.test_implementations,
                                         self.stop_flag,
                                         self.pause_after_test,
                                         self.pause_on_unexpected,
@@ -741,6 +797,8 @@ class ManagerGroup(object):
             manager.start()
             self.pool.add(manager)
         self.wait()
+        self.logger.info("Ran %s tests on %i processes in %.1fs" %
+                         (type_names, self.size, time.time() - start_time))
 
     def is_alive(self):
         """Boolean indicating whether any manager in the group is still alive"""
@@ -0,0 +1,231 @@
+import base64
+import struct
+import sys
+import zlib
+from os.path import join, dirname
+
+import pytest
+
+sys.path.insert(0, join(dirname(__file__), "..", ".."))
+
+from wptrunner import imagediff, screenshotcache
+from wptrunner.executors.base import RefTestImplementation
+
+
+def make_rows(width, height, changes=None):
+    rows = []
+    for y in range(height):
+        row = bytearray((x * 7 + y * 13 + c * 51) & 0xff
+                        for x in range(width) for c in range(4))
+        rows.append(row)
+    for (x, y), pixel in (changes or {}).items():
+        rows[y][x * 4:x * 4 + 4] = pixel
+    return [bytes(row) for row in rows]
+
+
+def filter_row(filter_type, line, prev, bpp):
+    line = bytearray(line)
+    prev = bytearray(prev)
+    rv = bytearray(len(line))
+    for i in range(len(line)):
+        left = line[i - bpp] if i >= bpp else 0
+        upper_left = prev[i - bpp] if i >= bpp else 0
+        up = prev[i]
+        if filter_type == 0:
+            predictor = 0
+        elif filter_type == 1:
+            predictor = left
+        elif filter_type == 2:
+            predictor = up
+        elif filter_type == 3:
+            predictor = (left + up) >> 1
+        else:
+            p = left + up - upper_left
+            pa, pb, pc = abs(p - left), abs(p - up), abs(p - upper_left)
+            if pa <= pb and pa <= pc:
+                predictor = left
+            elif pb <= pc:
+                predictor = up
+            else:
+                predictor = upper_left
+        rv[i] = (line[i] - predictor) & 0xff
+    return bytes(rv)
+
+
+def make_png(width, height, rows, colour_type=6):
+    """Encode a PNG cycling through every filter type"""
+    bpp = imagediff.channels[colour_type]
+    if colour_type == 2:
+        rows = [b"".join(row[x:x + 3] for x in range(0, len(row), 4)) for row in rows]
+    raw = []
+    prev = b"\x00" * (width * bpp)
+    for y, row in enumerate(rows):
+        filter_type = y % 5
+        raw.append(struct.pack("B", filter_type) + filter_row(filter_type, row, prev, bpp))
+        prev = row
+
+    def chunk(chunk_type, data):
+        return (struct.pack(">I", len(data)) + chunk_type + data +
+                struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    return base64.b64encode(b"".join([
+        imagediff.png_signature,
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, colour_type, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(b"".join(raw))),
+        chunk(b"IEND", b"")]))
+
+
+@pytest.mark.parametrize("value,expected", [
+    ("maxDifference=1-2;totalPixels=0-300", ((1, 2), (0, 300))),
+    ("2;300", ((0, 2), (0, 300))),
+    (" maxDifference = 5 ; totalPixels = 10-20 ", ((0, 5), (10, 20))),
+])
+def test_parse_fuzzy(value, expected):
+    assert imagediff.parse_fuzzy(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "2", "maxDifference=2", "a;b", "1-2-3;4"])
+def test_parse_fuzzy_invalid(value):
+    with pytest.raises(ValueError):
+        imagediff.parse_fuzzy(value)
+
+
+@pytest.mark.parametrize("colour_type", [2, 6])
+def test_decode_png(colour_type):
+    rows = make_rows(13, 11)
+    if colour_type == 2:
+        rows = [b"".join(row[x:x + 3] + b"\xff" for x in range(0, len(row), 4))
+                for row in rows]
+    image = imagediff.decode_png(base64.b64decode(make_png(13, 11, rows, colour_type)))
+    assert (image.width, image.height) == (13, 11)
+    assert image.rows == rows
+
+
+def test_encode_png():
+    rows = make_rows(5, 3)
+    data = imagediff.encode_png(5, 3, rows)
+    assert imagediff.decode_png(data).rows == rows
+
+
+@pytest.mark.parametrize("numpy", [False, True])
+def test_image_diff(monkeypatch, numpy):
+    if numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(imagediff, "numpy", None)
+    lhs = make_png(10, 10, make_rows(10, 10))
+    rhs = make_png(10, 10, make_rows(10, 10, {(1, 2): b"\x00\x00\x00\xff",
+                                              (9, 9): b"\x10\x20\x30\x40"}))
+    diff = imagediff.ImageDiff(lhs, rhs)
+    expected = max(abs(a - b) for a, b in zip(bytearray(make_rows(10, 10)[2][4:8]),
+                                              bytearray(b"\x00\x00\x00\xff")) +
+                   zip(bytearray(make_rows(10, 10)[9][36:40]),
+                       bytearray(b"\x10\x20\x30\x40")))
+    assert diff.differing_pixels == 2
+    assert diff.max_difference == expected
+    assert diff.matches(((0, 255), (0, 2)))
+    assert not diff.matches(((0, 255), (0, 1)))
+    assert not diff.matches(None)
+
+    image = imagediff.decode_png(base64.b64decode(diff.image()))
+    assert image.rows[2][4:8] == imagediff.diff_colour
+    assert image.rows[0][:4] == make_rows(10, 10)[0][:4].translate(imagediff.fade_table)
+
+
+def test_image_diff_size():
+    diff = imagediff.ImageDiff(make_png(10, 10, make_rows(10, 10)),
+                               make_png(10, 5, make_rows(10, 5)))
+    assert diff.size_differs
+    assert not diff.matches(((0, 255), (0, 1000)))
+    assert diff.image() is None
+
+
+@pytest.mark.parametrize("fuzzy,max_difference,differing_pixels,expected", [
+    (None, 0, 0, True),
+    (None, 1, 1, False),
+    (((0, 2), (0, 10)), 0, 0, True),
+    (((0, 2), (0, 10)), 2, 10, True),
+    (((0, 2), (0, 10)), 3, 10, False),
+    (((1, 2), (1, 10)), 0, 0, False),
+    (((1, 2), (1, 10)), 1, 1, True),
+])
+def test_fuzzy_match(fuzzy, max_difference, differing_pixels, expected):
+    assert imagediff.fuzzy_match(fuzzy, max_difference, differing_pixels) is expected
+
+
+class MockTest(object):
+    timeout = 10
+    viewport_size = None
+    dpi = None
+
+    def __init__(self, url, references=None, fuzzy=None):
+        self.url = url
+        self.references = references or []
+        self.fuzzy = fuzzy
+
+
+class MockExecutor(object):
+    timeout_multiplier = 1
+    logger = None
+    persistent_screenshot_cache = None
+
+    def __init__(self, screenshots):
+        self.screenshot_cache = screenshotcache.SharedScreenshotCache(
+            screenshotcache.ScreenshotStore())
+        self.screenshots = screenshots
+        self.taken = []
+
+    def screenshot(self, test, viewport_size, dpi):
+        self.taken.append(test.url)
+        return True, self.screenshots[test.url]
+
+
+@pytest.mark.parametrize("fuzzy,status", [(None, "FAIL"),
+                                          ("maxDifference=0-255;totalPixels=1", "PASS"),
+                                          ("maxDifference=1-255;totalPixels=2-3", "FAIL"),
+                                          ("invalid", "ERROR")])
+def test_reftest_fuzzy(monkeypatch, fuzzy, status):
+    monkeypatch.setattr(imagediff, "fast_decode_available", lambda: True)
+    ref = MockTest("/ref.html")
+    test = MockTest("/test.html", [(ref, "==")], fuzzy)
+    executor = MockExecutor({
+        "/test.html": make_png(10, 10, make_rows(10, 10)),
+        "/ref.html": make_png(10, 10, make_rows(10, 10, {(3, 3): b"\x00\x00\x00\x00"}))})
+    result = RefTestImplementation(executor).run_test(test)
+    assert result["status"] == status
+    if status == "FAIL":
+        diff = result["extra"]["reftest_diff"]
+        assert diff["differing_pixels"] == 1
+        assert diff["image"] is not None
+        assert "Found 1 pixels different" in result["message"]
+    if status != "ERROR":
+        assert executor.taken == ["/test.html", "/ref.html"]
+
+
+def test_reftest_fuzzy_mismatch():
+    ref = MockTest("/ref.html")
+    test = MockTest("/test.html", [(ref, "!=")], "0-255;0-1")
+    executor = MockExecutor({
+        "/test.html": make_png(10, 10, make_rows(10, 10)),
+        "/ref.html": make_png(10, 10, make_rows(10, 10, {(3, 3): b"\x00\x00\x00\x00"}))})
+    result = RefTestImplementation(executor).run_test(test)
+    assert result["status"] == "FAIL"
+    assert "reftest_diff" not in result["extra"]
+
+
+@pytest.mark.parametrize("fuzzy,diff_image", [(None, False),
+                                              ("maxDifference=1-255;totalPixels=2-3", True)])
+def test_reftest_diff_without_pil(monkeypatch, fuzzy, diff_image):
+    monkeypatch.setattr(imagediff, "Image", None)
+    ref = MockTest("/ref.html")
+    test = MockTest("/test.html", [(ref, "==")], fuzzy)
+    executor = MockExecutor({
+        "/test.html": make_png(10, 10, make_rows(10, 10)),
+        "/ref.html": make_png(10, 10, make_rows(10, 10, {(3, 3): b"\x00\x00\x00\x00"}))})
+    result = RefTestImplementation(executor).run_test(test)
+    assert result["status"] == "FAIL"
+    diff = result["extra"]["reftest_diff"]
+    # Screenshots are only decoded without PIL if that's needed for the result
+    assert (diff["image"] is not None) == diff_image
+    if not diff_image:
+        assert "PIL" in diff["message"]
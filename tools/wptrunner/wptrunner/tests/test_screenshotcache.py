@@ -0,0 +1,255 @@
+import os
+import sys
+from os.path import join, dirname
+
+import pytest
+
+sys.path.insert(0, join(dirname(__file__), "..", ".."))
+
+from wptrunner import screenshotcache
+from wptrunner.executors.base import RefTestImplementation
+
+
+class MockTest(object):
+    timeout = 10
+    fuzzy = None
+
+    def __init__(self, tests_root, url, path=None, references=None):
+        self.tests_root = tests_root
+        self.url = url
+        self.path = path
+        self.references = references or []
+        self.viewport_size = None
+        self.dpi = None
+
+
+class MockExecutor(object):
+    timeout_multiplier = 1
+    logger = None
+
+    def __init__(self, persistent_screenshot_cache=None, screenshot_cache=None):
+        if screenshot_cache is None:
+            screenshot_cache = screenshotcache.SharedScreenshotCache(
+                screenshotcache.ScreenshotStore())
+        self.screenshot_cache = screenshot_cache
+        self.persistent_screenshot_cache = persistent_screenshot_cache
+        self.screenshots = []
+
+    def screenshot(self, test, viewport_size, dpi):
+        self.screenshots.append(test.url)
+        return True, b"screenshot %s" % ("-ref" if test.url.endswith("-ref.html") else "")
+
+
+def write(tests_root, path, data):
+    path = os.path.join(tests_root, path)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def make_cache(path, env_key="env"):
+    store = screenshotcache.PersistentScreenshotStore(screenshotcache.ScreenshotCache.read(path))
+    return screenshotcache.ScreenshotCache(path, env_key, store)
+
+
+@pytest.fixture
+def tests_root(tmpdir):
+    root = str(tmpdir.mkdir("tests"))
+    write(root, "ref/ref.html", """<!doctype html>
+<link rel="help" href="https://drafts.csswg.org/css-text/">
+<link rel="stylesheet" href="ref.css">
+<a href="missing.html">Link</a>
+<img src="/images/green.png">""")
+    write(root, "ref/ref.css", "div {background: url('../images/bg.png')}")
+    write(root, "images/green.png", "green")
+    write(root, "images/bg.png", "bg")
+    return root
+
+
+def test_key(tests_root, tmpdir):
+    cache = make_cache(str(tmpdir.join("cache.json")))
+    ref = MockTest(tests_root, "/ref/ref.html", "ref/ref.html")
+    key = cache.key(ref, None, None)
+    assert key is not None
+    assert make_cache(cache.path).key(ref, None, None) == key
+    assert make_cache(cache.path, "other").key(ref, None, None) != key
+    assert cache.key(ref, [800, 600], None) != key
+
+
+@pytest.mark.parametrize("path", ["ref/ref.html", "ref/ref.css", "images/bg.png",
+                                  "images/green.png", "ref/ref.html.headers",
+                                  "ref/__dir__.headers"])
+def test_key_subresource_changed(tests_root, tmpdir, path):
+    ref = MockTest(tests_root, "/ref/ref.html", "ref/ref.html")
+    key = make_cache(str(tmpdir.join("cache.json"))).key(ref, None, None)
+    with open(os.path.join(tests_root, path), "a") as f:
+        f.write("changed")
+    assert make_cache(str(tmpdir.join("cache.json"))).key(ref, None, None) != key
+
+
+def test_key_url_base(tests_root, tmpdir):
+    cache = make_cache(str(tmpdir.join("cache.json")))
+    ref = MockTest(tests_root, "/_mozilla/ref/ref.html", "ref/ref.html")
+    # /images/green.png is outside the /_mozilla/ mount
+    assert cache.key(ref, None, None) is None
+    write(tests_root, "ref/simple.html", "<link rel=stylesheet href=ref.css>")
+    ref = MockTest(tests_root, "/_mozilla/ref/simple.html", "ref/simple.html")
+    assert cache.key(ref, None, None) is not None
+
+
+@pytest.mark.parametrize("data", ["<script src=ref.js></script>",
+                                  "<body onload='run()'>",
+                                  "<img srcset='green.png 2x'>",
+                                  "<img src='/images/missing.png'>",
+                                  "<img src='http://web-platform.test/images/green.png'>",
+                                  "<img src='/images/green.png?pipe=trickle(d1)'>",
+                                  "<img src='/common/image.py'>",
+                                  "<iframe src='frame.sub.html'></iframe>",
+                                  "<base href='/images/'>"])
+def test_uncacheable(tests_root, tmpdir, data):
+    write(tests_root, "ref/frame.sub.html", "frame")
+    write(tests_root, "common/image.py", "def main(request, response): pass")
+    write(tests_root, "ref/dynamic.html", data)
+    cache = make_cache(str(tmpdir.join("cache.json")))
+    assert cache.key(MockTest(tests_root, "/ref/dynamic.html", "ref/dynamic.html"),
+                     None, None) is None
+
+
+def test_save(tests_root, tmpdir):
+    path = str(tmpdir.join("cache.json"))
+    cache = make_cache(path)
+    assert cache.get("a") is None
+    cache.set("a", "hash-a")
+    cache.save()
+
+    other = make_cache(path)
+    assert other.get("a") == "hash-a"
+    other.set("b", "hash-b")
+    cache.set("c", "hash-c")
+    other.save()
+    cache.save()
+
+    loaded = make_cache(path)
+    entries = loaded.store.entries()
+    assert {key: entry[0] for key, entry in entries.items()} == {"a": "hash-a",
+                                                                 "b": "hash-b",
+                                                                 "c": "hash-c"}
+    assert cache.summary().startswith("Reftest screenshot cache: 0 hits, 1 misses")
+    assert other.summary().startswith("Reftest screenshot cache: 1 hits, 0 misses")
+
+
+class CallCounter(object):
+    def __init__(self, obj):
+        self.obj = obj
+        self.calls = []
+
+    def __getattr__(self, name):
+        self.calls.append(name)
+        return getattr(self.obj, name)
+
+
+def test_get_single_call(tmpdir):
+    path = str(tmpdir.join("cache.json"))
+    manager = screenshotcache.CacheManager()
+    manager.start()
+    try:
+        cache = screenshotcache.ScreenshotCache.load(path, manager, "env")
+        cache.set("a", "hash-a")
+        cache.store = CallCounter(cache.store)
+        assert cache.get("a") == "hash-a"
+        assert cache.get("b") is None
+        assert cache.get(None) is None
+        assert cache.store.calls == ["lookup", "lookup", "lookup"]
+        assert cache.summary().startswith(
+            "Reftest screenshot cache: 1 hits, 1 misses, 1 uncacheable")
+        cache.reset_stats()
+        assert cache.summary().startswith("Reftest screenshot cache: 0 hits, 0 misses")
+    finally:
+        manager.shutdown()
+
+
+def test_reftest_implementation(tests_root, tmpdir):
+    path = str(tmpdir.join("cache.json"))
+    write(tests_root, "test.html", "<link rel=stylesheet href=ref/ref.css>")
+    ref = MockTest(tests_root, "/ref/ref.html", "ref/ref.html")
+    test = MockTest(tests_root, "/test.html", "test.html", [(ref, "==")])
+
+    for expected_screenshots in [["/test.html", "/ref/ref.html"], ["/test.html"]]:
+        cache = make_cache(path)
+        executor = MockExecutor(cache)
+        assert RefTestImplementation(executor).run_test(test)["status"] == "PASS"
+        assert executor.screenshots == expected_screenshots
+        cache.save()
+
+
+class CountingStore(screenshotcache.ScreenshotStore):
+    def __init__(self, *args, **kwargs):
+        screenshotcache.ScreenshotStore.__init__(self, *args, **kwargs)
+        self.calls = []
+
+    def get_hashes(self, keys):
+        self.calls.append(sorted(keys))
+        return screenshotcache.ScreenshotStore.get_hashes(self, keys)
+
+
+def test_shared_cache_batched():
+    store = CountingStore()
+    store.set_hash("a", "hash-a")
+    cache = screenshotcache.SharedScreenshotCache(store)
+    assert cache.get_hashes(["a", "b", "c"]) == {"a": "hash-a"}
+    cache.set_hash("b", "hash-b")
+    assert cache.get_hash("a") == "hash-a"
+    assert cache.get_hash("b") == "hash-b"
+    assert cache.get_hashes(["a", "b", "c"]) == {"a": "hash-a", "b": "hash-b"}
+    assert store.calls == [["a", "b", "c"], ["c"]]
+
+
+def test_store_eviction():
+    store = screenshotcache.ScreenshotStore(max_size=10)
+    store.set_screenshot("a", b"aaaa")
+    store.set_screenshot("b", b"bbbb")
+    assert store.get_screenshot("a") == b"aaaa"
+    store.set_screenshot("c", b"cccc")
+    assert store.get_screenshot("b") is None
+    assert store.get_screenshot("a") == b"aaaa"
+    store.set_screenshot("d", b"d" * 11)
+    assert store.get_screenshot("d") is None
+    assert store.stats() == {"hashes": 0, "screenshots": 2, "size": 8}
+
+
+def test_cache_manager():
+    manager = screenshotcache.CacheManager()
+    manager.start()
+    try:
+        cache = screenshotcache.SharedScreenshotCache(manager.ScreenshotStore())
+        cache.set_hash(("/a.html", None, None), "hash-a")
+        cache.set_screenshot(("/a.html", None, None), b"a")
+        other = screenshotcache.SharedScreenshotCache(cache.store)
+        assert other.get_hashes([("/a.html", None, None), ("/b.html", None, None)]) == {
+            ("/a.html", None, None): "hash-a"}
+        assert other.get_screenshot(("/a.html", None, None)) == b"a"
+    finally:
+        manager.shutdown()
+
+
+def test_reftest_implementation_failure(tests_root):
+    write(tests_root, "test.html", "test")
+    write(tests_root, "test-ref.html", "ref")
+    ref = MockTest(tests_root, "/test-ref.html", "test-ref.html")
+    test = MockTest(tests_root, "/test.html", "test.html", [(ref, "==")])
+    other = MockTest(tests_root, "/other.html", "other.html", [(ref, "==")])
+
+    store = screenshotcache.ScreenshotStore()
+    # The second time the test runs its hashes are known, so both
+    # screenshots are retaken for the failure message and stored. The
+    # stored reference screenshot is then used for the failure of other
+    for node, expected_screenshots in [(test, ["/test.html", "/test-ref.html"]),
+                                       (test, ["/test.html", "/test-ref.html"]),
+                                       (other, ["/other.html"])]:
+        executor = MockExecutor(screenshot_cache=screenshotcache.SharedScreenshotCache(store))
+        result = RefTestImplementation(executor).run_test(node)
+        assert result["status"] == "FAIL"
+        assert executor.screenshots == expected_screenshots
+    screenshots = result["extra"]["reftest_screenshots"]
+    assert screenshots[2]["screenshot"] == b"screenshot -ref"
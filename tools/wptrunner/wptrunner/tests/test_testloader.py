@@ -1,13 +1,17 @@
 from __future__ import unicode_literals
 
+import json
 import os
 import sys
 import tempfile
+from Queue import Empty
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
 
 from mozlog import structured
 from wptrunner.testloader import TestFilter as Filter
+from wptrunner.testloader import (DurationGroupedSource, PathGroupedSource, SingleTestSource,
+                                  load_durations, predict_makespan)
 from .test_chunker import make_mock_manifest
 
 structured.set_default_logger(structured.structuredlog.StructuredLogger("TestLoader"))
@@ -28,3 +32,102 @@ def test_filter_unicode():
         f.flush()
 
         Filter(manifest_path=f.name, test_manifests=tests)
+
+
+class MockTest(object):
+    def __init__(self, id, test_type="testharness"):
+        self.id = id
+        self.url = id
+        self.test_type = test_type
+
+    def update_metadata(self, metadata):
+        metadata.setdefault("tests", []).append(self.id)
+        return metadata
+
+
+def queued_groups(queue):
+    rv = []
+    while True:
+        try:
+            rv.append(queue.get(timeout=1))
+        except Empty:
+            return rv
+
+
+def test_duration_grouped_source():
+    tests = [MockTest(id) for id in ["/a/1.html", "/a/2.html", "/b/1.html",
+                                     "/c/1.html", "/c/2.html", "/d/1.html"]]
+    durations = {"/a/1.html": 1., "/a/2.html": 2., "/b/1.html": 10.,
+                 "/c/1.html": 4., "/c/2.html": 4.}
+    queue = DurationGroupedSource.make_queue(tests, durations=durations, depth=None,
+                                             processes=2)
+    groups = queued_groups(queue)
+    # /d/1.html has the median duration of 4s
+    assert [list(test.id for test in group) for group, _ in groups] == [
+        ["/b/1.html"], ["/c/1.html", "/c/2.html"], ["/d/1.html"],
+        ["/a/1.html", "/a/2.html"]]
+    assert groups[1][1] == {"tests": ["/c/1.html", "/c/2.html"]}
+
+
+def test_duration_grouped_source_balanced():
+    # Without --run-by-dir there is one group per process for each test
+    # type, rather than one per test, since the browser restarts between groups
+    ids = ["/a/%i.html" % i for i in range(7)]
+    tests = [MockTest(id) for id in ids] + [MockTest("/b/ref.html", "reftest")]
+    durations = dict(zip(ids, [5., 1., 4., 3., 3., 2., 2.]))
+    queue = DurationGroupedSource.make_queue(tests, durations=durations,
+                                             depth=False, processes=3)
+    groups = [list(test.id for test in group) for group, _ in queued_groups(queue)]
+    assert len(groups) == 4
+    # The 20s of tests are split into groups of 7s, 7s and 6s, and keep
+    # their original order within each group
+    assert groups[:3] == [["/a/0.html", "/a/6.html"],
+                          ["/a/1.html", "/a/2.html", "/a/5.html"],
+                          ["/a/3.html", "/a/4.html"]]
+    assert groups[3] == ["/b/ref.html"]
+
+
+def test_groups_split_by_test_type():
+    tests = [MockTest("/a/1.html"), MockTest("/a/2.html"),
+             MockTest("/a/3.html", "reftest"), MockTest("/b/1.html", "reftest")]
+    queue = PathGroupedSource.make_queue(tests, depth=None, processes=2)
+    assert [list(test.id for test in group) for group, _ in queued_groups(queue)] == [
+        ["/a/1.html", "/a/2.html"], ["/a/3.html"], ["/b/1.html"]]
+
+    durations = {"/a/1.html": 1., "/a/2.html": 1., "/a/3.html": 5.}
+    queue = DurationGroupedSource.make_queue(tests, durations=durations,
+                                             depth=None, processes=2)
+    assert [list(test.id for test in group) for group, _ in queued_groups(queue)] == [
+        ["/a/3.html"], ["/a/1.html", "/a/2.html"], ["/b/1.html"]]
+
+    queue = SingleTestSource.make_queue(tests, processes=2)
+    for group, _ in queued_groups(queue):
+        assert len(set(test.test_type for test in group)) == 1
+
+
+def test_predict_makespan():
+    assert predict_makespan([10, 8, 4, 3, 2], 2) == 14
+    assert predict_makespan([10, 8, 4, 3, 2], 1) == 27
+    assert predict_makespan([], 3) == 0
+
+
+def test_load_durations():
+    raw_log = "\n".join(json.dumps(entry) for entry in [
+        {"action": "suite_start", "time": 0, "tests": []},
+        {"action": "test_start", "test": "/a.html", "time": 1000},
+        {"action": "test_end", "test": "/a.html", "time": 3000, "status": "OK"},
+        {"action": "test_start", "test": "/b.html", "time": 3000},
+        {"action": "test_end", "test": "/b.html", "time": 3500, "status": "OK"},
+        {"action": "test_start", "test": "/c.html", "time": 3500}])
+    report = json.dumps({"results": [{"test": "/a.html", "status": "OK", "duration": 4000},
+                                     {"test": "/c.html", "status": "OK"}]})
+    paths = []
+    try:
+        for data in [raw_log, report]:
+            with tempfile.NamedTemporaryFile("w", delete=False) as f:
+                f.write(data)
+            paths.append(f.name)
+        assert load_durations(paths) == {"/a.html": 3., "/b.html": 0.5}
+    finally:
+        for path in paths:
+            os.unlink(path)
@@ -0,0 +1,60 @@
+import sys
+import threading
+from os.path import join, dirname
+
+sys.path.insert(0, join(dirname(__file__), "..", ".."))
+
+from mozlog import structuredlog
+from wptrunner.browsers.base import Browser, NullBrowser
+from wptrunner.testloader import PathGroupedSource
+from wptrunner.testrunner import TestImplementation, TestRunnerManager
+
+
+class MockBrowser(Browser):
+    def __init__(self, logger, **kwargs):
+        super(MockBrowser, self).__init__(logger)
+        self.kwargs = kwargs
+        self.cleaned_up = False
+
+    def start(self, **kwargs):
+        pass
+
+    def stop(self, force=False):
+        pass
+
+    def pid(self):
+        return None
+
+    def is_alive(self):
+        return True
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+def test_use_implementation():
+    implementations = {
+        "testharness": TestImplementation("testharness executor", {}, MockBrowser, {"a": 1}),
+        "reftest": TestImplementation("reftest executor", {}, MockBrowser, {"a": 1}),
+        "wdspec": TestImplementation("wdspec executor", {}, NullBrowser, {})}
+    manager = TestRunnerManager("test", None, PathGroupedSource, implementations,
+                                threading.Event())
+    manager.logger = structuredlog.StructuredLogger("test")
+    try:
+        manager.use_implementation("testharness")
+        browser = manager.browser.browser
+        assert isinstance(browser, MockBrowser)
+        assert manager.executor_cls == "testharness executor"
+
+        # The same browser is kept when only the executor changes
+        manager.use_implementation("reftest")
+        assert manager.browser.browser is browser
+        assert manager.executor_cls == "reftest executor"
+        assert not browser.cleaned_up
+
+        manager.use_implementation("wdspec")
+        assert isinstance(manager.browser.browser, NullBrowser)
+        assert browser.cleaned_up
+    finally:
+        manager.close_browser()
+        manager.teardown()
@@ -58,6 +58,17 @@ scheme host and port.""")
                         help="Split run into groups by directories. With a parameter,"
                         "limit the depth of splits e.g. --run-by-dir=1 to split by top-level"
                         "directory")
+    parser.add_argument("--test-durations", action="append", type=abs_path,
+                        help="mozlog raw log or wptreport JSON file from a previous run. "
+                        "Groups of tests are run longest first using the durations "
+                        "in these files, to even out the time taken by each process. "
+                        "Without --run-by-dir, the tests are split into one group per "
+                        "process with similar total durations. May be given more than once.")
+    parser.add_argument("--single-pool", action="store_true", default=False,
+                        help="Run all the test types from a single pool of processes, "
+                        "rather than one type after another. Each process switches "
+                        "executor between groups of tests of different types, and keeps "
+                        "its browser where the types use the same browser settings.")
     parser.add_argument("--processes", action="store", type=int, default=None,
                         help="Number of simultaneous processes to use")
 
@@ -143,6 +154,10 @@ scheme host and port.""")
                               help="Allow the wptrunner to install fonts on your system")
     config_group.add_argument("--font-dir", action="store", type=abs_path, dest="font_dir",
                               help="Path to local font installation directory", default=None)
+    config_group.add_argument("--reftest-screenshot-cache", action="store", type=abs_path,
+                              default=None,
+                              help="Path to a file used to store reference screenshot hashes "
+                              "between runs, so that unchanged references aren't rendered again")
 
     build_type = parser.add_mutually_exclusive_group()
     build_type.add_argument("--debug-build", dest="debug", action="store_true",
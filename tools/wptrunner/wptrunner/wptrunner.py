@@ -6,12 +6,13 @@ import sys
 
 import environment as env
 import products
+import screenshotcache
 import testloader
 import wptcommandline
 import wptlogging
 import wpttest
 from font import FontInstaller
-from testrunner import ManagerGroup
+from testrunner import ManagerGroup, TestImplementation
 from browsers.base import NullBrowser
 
 here = os.path.split(__file__)[0]
@@ -160,7 +161,11 @@ def run_tests(config, test_paths, product, **kwargs):
                                                **kwargs)
 
         test_source_kwargs = {"processes": kwargs["processes"]}
-        if kwargs["run_by_dir"] is False:
+        if kwargs.get("test_durations"):
+            test_source_cls = testloader.DurationGroupedSource
+            test_source_kwargs["durations"] = testloader.load_durations(kwargs["test_durations"])
+            test_source_kwargs["depth"] = kwargs["run_by_dir"]
+        elif kwargs["run_by_dir"] is False:
             test_source_cls = testloader.SingleTestSource
         else:
             # A value of None indicates infinite depth
@@ -185,6 +190,13 @@ def run_tests(config, test_paths, product, **kwargs):
                 logger.critical("Error starting test environment: %s" % e.message)
                 raise
 
+            screenshot_cache = None
+            if kwargs.get("reftest_screenshot_cache") and "reftest" in kwargs["test_types"]:
+                env_key = screenshotcache.environment_key(product, run_info, **kwargs)
+                screenshot_cache = screenshotcache.ScreenshotCache.load(
+                    kwargs["reftest_screenshot_cache"], test_environment.cache_manager, env_key)
+            kwargs["persistent_screenshot_cache"] = screenshot_cache
+
             repeat = kwargs["repeat"]
             repeat_count = 0
             repeat_until_unexpected = kwargs["repeat_until_unexpected"]
@@ -198,9 +210,8 @@ def run_tests(config, test_paths, product, **kwargs):
 
                 unexpected_count = 0
                 logger.suite_start(test_loader.test_ids, run_info)
+                test_implementations = {}
                 for test_type in kwargs["test_types"]:
-                    logger.info("Running %s tests" % test_type)
-
                     # WebDriver tests may create and destroy multiple browser
                     # processes as part of their expected behavior. These
                     # processes are managed by a WebDriver server binary. This
@@ -233,26 +244,47 @@ def run_tests(config, test_paths, product, **kwargs):
                         logger.test_start(test.id)
                         logger.test_end(test.id, status="SKIP")
 
+                    test_implementations[test_type] = TestImplementation(executor_cls,
+                                                                         executor_kwargs,
+                                                                         browser_cls,
+                                                                         browser_kwargs)
+
+                run_types = [test_type for test_type in kwargs["test_types"]
+                             if test_type in test_implementations]
+                if kwargs.get("single_pool"):
+                    # All the test types share one queue and one set of
+                    # processes, so no type waits for the slowest process
+                    # running the previous one
+                    pools = [run_types] if run_types else []
+                else:
+                    pools = [[test_type] for test_type in run_types]
+
+                for pool_types in pools:
+                    logger.info("Running %s tests" % ", ".join(pool_types))
+
                     with ManagerGroup("web-platform-tests",
                                       kwargs["processes"],
                                       test_source_cls,
                                       test_source_kwargs,
-                                      browser_cls,
-                                      browser_kwargs,
-                                      executor_cls,
-                                      executor_kwargs,
+                                      {test_type: test_implementations[test_type]
+                                       for test_type in pool_types},
                                       kwargs["pause_after_test"],
                                       kwargs["pause_on_unexpected"],
                                       kwargs["restart_on_unexpected"],
                                       kwargs["debug_info"]) as manager_group:
                         try:
-                            manager_group.run(test_type, test_loader.tests)
+                            manager_group.run(pool_types, test_loader.tests)
                         except KeyboardInterrupt:
                             logger.critical("Main thread got signal")
                             manager_group.stop()
                             raise
                     unexpected_count += manager_group.unexpected_count()
 
+                if screenshot_cache is not None:
+                    screenshot_cache.save()
+                    logger.info(screenshot_cache.summary())
+                    screenshot_cache.reset_stats()
+
                 unexpected_total += unexpected_count
                 logger.info("Got %i unexpected results" % unexpected_count)
                 if repeat_until_unexpected and unexpected_total > 0:
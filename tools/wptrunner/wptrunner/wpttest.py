@@ -260,7 +260,8 @@ class ReftestTest(Test):
     test_type = "reftest"
 
     def __init__(self, tests_root, url, inherit_metadata, test_metadata, references,
-                 timeout=None, path=None, viewport_size=None, dpi=None, protocol="http"):
+                 timeout=None, path=None, viewport_size=None, dpi=None, fuzzy=None,
+                 protocol="http"):
         Test.__init__(self, tests_root, url, inherit_metadata, test_metadata, timeout,
                       path, protocol)
 
@@ -271,6 +272,7 @@ class ReftestTest(Test):
         self.references = references
         self.viewport_size = viewport_size
         self.dpi = dpi
+        self.manifest_fuzzy = fuzzy
 
     @classmethod
     def from_manifest(cls,
@@ -298,6 +300,7 @@ class ReftestTest(Test):
                    path=manifest_test.path,
                    viewport_size=manifest_test.viewport_size,
                    dpi=manifest_test.dpi,
+                   fuzzy=manifest_test.fuzzy,
                    protocol="https" if hasattr(manifest_test, "https") and manifest_test.https else "http")
 
         nodes[url] = node
@@ -353,6 +356,18 @@ class ReftestTest(Test):
     def keys(self):
         return ("reftype", "refurl")
 
+    @property
+    def fuzzy(self):
+        """Difference allowed between the screenshots of the test and its
+        references, as a string in the format of imagediff.parse_fuzzy,
+        or None. A value in the metadata overrides the test file."""
+        rv = self.manifest_fuzzy
+        for meta in self.itermeta():
+            fuzzy = meta.fuzzy
+            if fuzzy is not None:
+                rv = fuzzy
+        return rv
+
 
 class WdspecTest(Test):
 
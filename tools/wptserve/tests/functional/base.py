@@ -37,12 +37,15 @@ class Request(BaseRequest):
 
 
 class TestUsingServer(unittest.TestCase):
+    server_cls = None
+
     def setUp(self):
         self.server = wptserve.server.WebTestHttpd(host="localhost",
                                                    port=0,
                                                    use_ssl=False,
                                                    certificate=None,
-                                                   doc_root=doc_root)
+                                                   doc_root=doc_root,
+                                                   server_cls=self.server_cls)
         self.server.start(False)
 
     def tearDown(self):
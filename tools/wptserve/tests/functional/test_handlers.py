@@ -1,5 +1,7 @@
 import json
 import os
+import shutil
+import tempfile
 import unittest
 import uuid
 
@@ -7,6 +9,7 @@ import pytest
 from six.moves.urllib.error import HTTPError
 
 wptserve = pytest.importorskip("wptserve")
+from wptserve.filecache import FileCache
 from .base import TestUsingServer, doc_root
 
 
@@ -101,6 +104,217 @@ class TestFileHandler(TestUsingServer):
         assert resp.read().rstrip() == expected
 
 
+class TestFileHandlerLarge(TestUsingServer):
+    def setUp(self):
+        super(TestFileHandlerLarge, self).setUp()
+        self.base_path = tempfile.mkdtemp()
+        self.data = os.urandom(3 * 1024 * 1024 + 7)
+        with open(os.path.join(self.base_path, "large.bin"), "wb") as f:
+            f.write(self.data)
+        self.server.router.register("GET", "/large/*",
+                                    wptserve.handlers.FileHandler(base_path=self.base_path,
+                                                                  url_base="/large/"))
+
+    def tearDown(self):
+        wptserve.response.ResponseWriter.use_sendfile = True
+        shutil.rmtree(self.base_path)
+        super(TestFileHandlerLarge, self).tearDown()
+
+    def check(self):
+        resp = self.request("/large/large.bin")
+        self.assertEqual(200, resp.getcode())
+        self.assertEqual(self.data, resp.read())
+
+        resp = self.request("/large/large.bin", headers={"Range": "bytes=100-2000000"})
+        self.assertEqual(206, resp.getcode())
+        self.assertEqual("1999901", resp.info()["Content-Length"])
+        self.assertEqual(self.data[100:2000001], resp.read())
+
+        resp = self.request("/large/large.bin", query="pipe=slice(1,4)",
+                            headers={"Range": "bytes=10-19"})
+        self.assertEqual(206, resp.getcode())
+        self.assertEqual(self.data[11:14], resp.read())
+
+    def test_sendfile(self):
+        self.check()
+
+    def test_no_sendfile(self):
+        wptserve.response.ResponseWriter.use_sendfile = False
+        self.check()
+
+
+class TestFileHandlerCache(TestUsingServer):
+    def setUp(self):
+        super(TestFileHandlerCache, self).setUp()
+        self.base_path = tempfile.mkdtemp()
+        self.write("test.txt", b"PASS")
+        self.write("test.txt.headers", b"X-Test: PASS\n")
+        self.write("test.sub.txt", b"{{GET[test]}}")
+        self.write("test.sub.txt.sub.headers", b"X-Test: {{GET[test]}}\n")
+        self.cache = FileCache(check_interval=60)
+        self.server.router.register("GET", "/cached/*",
+                                    wptserve.handlers.FileHandler(base_path=self.base_path,
+                                                                  url_base="/cached/",
+                                                                  cache=self.cache))
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+        super(TestFileHandlerCache, self).tearDown()
+
+    def write(self, name, data):
+        with open(os.path.join(self.base_path, name), "wb") as f:
+            f.write(data)
+
+    def check(self, path, data, header, query=None, headers=None):
+        resp = self.request(path, query=query, headers=headers)
+        self.assertEqual(data, resp.read())
+        self.assertEqual(header, resp.info().get("X-Test"))
+        return resp
+
+    def test_cached(self):
+        self.check("/cached/test.txt", b"PASS", "PASS")
+        self.write("test.txt", b"FAILED")
+        os.unlink(os.path.join(self.base_path, "test.txt.headers"))
+        self.write("test.txt.sub.headers", b"X-Test: FAIL\n")
+        resp = self.check("/cached/test.txt", b"PASS", "PASS")
+        self.assertEqual("4", resp.info()["Content-Length"])
+        self.check("/cached/test.txt", b"AS", "PASS", headers={"Range": "bytes=1-2"})
+
+        self.cache.check_interval = 0
+        self.check("/cached/test.txt", b"FAILED", "FAIL")
+
+    def test_max_size(self):
+        self.cache.max_size = 1024
+        self.cache.max_file_size = 600
+        for name in ["a", "b", "c"]:
+            self.write(name, name * 500)
+            self.check("/cached/" + name, name * 500, None)
+        self.write("large", b"d" * 700)
+        self.check("/cached/large", b"d" * 700, None)
+        self.assertTrue(self.cache.size <= 1024)
+        self.assertEqual(self.cache.read(os.path.join(self.base_path, "large")), None)
+
+    def test_sub(self):
+        self.check("/cached/test.sub.txt", b"PASS", "PASS", query="test=PASS")
+        self.check("/cached/test.sub.txt", b"FAIL", "FAIL", query="test=FAIL")
+
+    def test_missing(self):
+        for _ in range(2):
+            with self.assertRaises(HTTPError) as cm:
+                self.request("/cached/missing.txt")
+            self.assertEqual(cm.exception.code, 404)
+        self.assertTrue(self.cache.stat(os.path.join(self.base_path, "missing.txt")) is None)
+
+    def test_stat_error(self):
+        # A name that's too long makes stat fail with something other than ENOENT
+        with self.assertRaises(HTTPError) as cm:
+            self.request("/cached/" + "a" * 300)
+        self.assertEqual(cm.exception.code, 404)
+
+    def test_directory(self):
+        os.mkdir(os.path.join(self.base_path, "subdir"))
+        resp = self.request("/cached/subdir/")
+        self.assertEqual("text/html", resp.info()["Content-Type"])
+
+
+class TestFileHandlerValidators(TestUsingServer):
+    def setUp(self):
+        super(TestFileHandlerValidators, self).setUp()
+        self.base_path = tempfile.mkdtemp()
+        self.write("test.txt", b"0123456789")
+        self.write("override.txt", b"PASS")
+        self.write("override.txt.headers", b'ETag: "custom"\n')
+        self.write("test.sub.txt", b"{{GET[test]}}")
+        self.server.router.register("GET", "/validated/*",
+                                    wptserve.handlers.FileHandler(base_path=self.base_path,
+                                                                  url_base="/validated/",
+                                                                  validators=True))
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+        super(TestFileHandlerValidators, self).tearDown()
+
+    def write(self, name, data):
+        with open(os.path.join(self.base_path, name), "wb") as f:
+            f.write(data)
+
+    def assertNotModified(self, path, headers):
+        with self.assertRaises(HTTPError) as cm:
+            self.request(path, headers=headers)
+        self.assertEqual(cm.exception.code, 304)
+        self.assertEqual(cm.exception.read(), b"")
+        return cm.exception
+
+    def test_not_enabled(self):
+        resp = self.request("/document.txt")
+        self.assertFalse("ETag" in resp.info())
+        self.assertFalse("Last-Modified" in resp.info())
+
+    def test_if_none_match(self):
+        resp = self.request("/validated/test.txt")
+        etag = resp.info()["ETag"]
+        self.assertTrue(etag.startswith('"'))
+        self.assertEqual(resp.read(), b"0123456789")
+
+        err = self.assertNotModified("/validated/test.txt", {"If-None-Match": etag})
+        self.assertEqual(err.info()["ETag"], etag)
+        self.assertNotModified("/validated/test.txt", {"If-None-Match": '"other", W/%s' % etag})
+        self.assertNotModified("/validated/test.txt", {"If-None-Match": "*"})
+
+        resp = self.request("/validated/test.txt", headers={"If-None-Match": '"other"'})
+        self.assertEqual(200, resp.getcode())
+
+        self.write("test.txt", b"01234567890")
+        resp = self.request("/validated/test.txt", headers={"If-None-Match": etag})
+        self.assertEqual(200, resp.getcode())
+        self.assertNotEqual(resp.info()["ETag"], etag)
+
+    def test_if_modified_since(self):
+        resp = self.request("/validated/test.txt")
+        last_modified = resp.info()["Last-Modified"]
+        self.assertNotModified("/validated/test.txt", {"If-Modified-Since": last_modified})
+
+        for value in ["Thu, 01 Jan 1970 00:00:00 GMT", "invalid"]:
+            resp = self.request("/validated/test.txt", headers={"If-Modified-Since": value})
+            self.assertEqual(200, resp.getcode())
+
+        # If-None-Match takes precedence
+        resp = self.request("/validated/test.txt", headers={"If-Modified-Since": last_modified,
+                                                            "If-None-Match": '"other"'})
+        self.assertEqual(200, resp.getcode())
+
+    def test_if_range(self):
+        resp = self.request("/validated/test.txt")
+        etag = resp.info()["ETag"]
+        last_modified = resp.info()["Last-Modified"]
+
+        for if_range in [etag, last_modified]:
+            resp = self.request("/validated/test.txt", headers={"Range": "bytes=2-4",
+                                                                "If-Range": if_range})
+            self.assertEqual(206, resp.getcode())
+            self.assertEqual(b"234", resp.read())
+
+        for if_range in ['"other"', "W/" + etag, "Thu, 01 Jan 1970 00:00:00 GMT"]:
+            resp = self.request("/validated/test.txt", headers={"Range": "bytes=2-4",
+                                                                "If-Range": if_range})
+            self.assertEqual(200, resp.getcode())
+            self.assertEqual(b"0123456789", resp.read())
+
+    def test_headers_override(self):
+        resp = self.request("/validated/override.txt")
+        self.assertEqual('"custom"', resp.info()["ETag"])
+        self.assertNotModified("/validated/override.txt", {"If-None-Match": '"custom"'})
+
+    def test_pipe(self):
+        resp = self.request("/validated/test.sub.txt", query="test=PASS")
+        self.assertEqual(b"PASS", resp.read())
+        self.assertFalse("ETag" in resp.info())
+
+        resp = self.request("/validated/test.txt", query="pipe=slice(1,3)")
+        self.assertEqual(b"12", resp.read())
+        self.assertFalse("ETag" in resp.info())
+
+
 class TestFunctionHandler(TestUsingServer):
     def test_string_rv(self):
         @wptserve.handlers.handler
@@ -269,6 +483,56 @@ class TestPythonHandler(TestUsingServer):
         assert cm.value.code == 404
 
 
+class TestPythonHandlerCache(TestUsingServer):
+    counter_script = b"""%s
+count = [0]
+
+def main(request, response):
+    count[0] += 1
+    return str(count[0])
+"""
+
+    def setUp(self):
+        super(TestPythonHandlerCache, self).setUp()
+        self.base_path = tempfile.mkdtemp()
+        self.server.router.register("GET", "/scripts/*.py",
+                                    wptserve.handlers.PythonScriptHandler(base_path=self.base_path,
+                                                                          url_base="/scripts/"))
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+        super(TestPythonHandlerCache, self).tearDown()
+
+    def write(self, name, data):
+        with open(os.path.join(self.base_path, name), "wb") as f:
+            f.write(data)
+
+    def test_changed(self):
+        self.write("test.py", b"def main(request, response):\n    return 'PASS'\n")
+        self.assertEqual(b"PASS", self.request("/scripts/test.py").read())
+        self.write("test.py", b"def main(request, response):\n    return 'CHANGED'\n")
+        self.assertEqual(b"CHANGED", self.request("/scripts/test.py").read())
+
+    def test_module_run_per_request(self):
+        self.write("test.py", self.counter_script % b"")
+        self.assertEqual(b"1", self.request("/scripts/test.py").read())
+        self.assertEqual(b"1", self.request("/scripts/test.py").read())
+
+    def test_stateless(self):
+        self.write("test.py", self.counter_script % b"__stateless__ = True")
+        self.assertEqual(b"1", self.request("/scripts/test.py").read())
+        self.assertEqual(b"2", self.request("/scripts/test.py").read())
+
+    def test_removed(self):
+        self.write("test.py", b"def main(request, response):\n    return 'PASS'\n")
+        self.assertEqual(b"PASS", self.request("/scripts/test.py").read())
+        os.unlink(os.path.join(self.base_path, "test.py"))
+        with pytest.raises(HTTPError) as cm:
+            self.request("/scripts/test.py")
+
+        assert cm.value.code == 404
+
+
 class TestDirectoryHandler(TestUsingServer):
     def test_directory(self):
         resp = self.request("/")
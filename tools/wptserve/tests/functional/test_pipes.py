@@ -1,9 +1,12 @@
 import os
 import unittest
 import time
+import zlib
 
 import pytest
+from six.moves.urllib.error import HTTPError
 
+wptserve = pytest.importorskip("wptserve")
 from .base import TestUsingServer, doc_root
 
 
@@ -50,6 +53,23 @@ class TestSlice(TestUsingServer):
         expected = open(os.path.join(doc_root, "document.txt"), 'rb').read()
         self.assertEqual(resp.read(), expected[:10])
 
+    def test_negative(self):
+        resp = self.request("/document.txt", query="pipe=slice(-5,-1)")
+        expected = open(os.path.join(doc_root, "document.txt"), 'rb').read()
+        self.assertEqual("4", resp.info()["Content-Length"])
+        self.assertEqual(resp.read(), expected[-5:-1])
+
+    def test_empty(self):
+        resp = self.request("/document.txt", query="pipe=slice(10,5)")
+        self.assertEqual("0", resp.info()["Content-Length"])
+        self.assertEqual(resp.read(), b"")
+
+    def test_range(self):
+        resp = self.request("/document.txt", query="pipe=slice(1,-1)",
+                            headers={"Range": "bytes=5-14"})
+        expected = open(os.path.join(doc_root, "document.txt"), 'rb').read()
+        self.assertEqual(resp.read(), expected[5:15][1:-1])
+
 class TestSub(TestUsingServer):
     def test_sub_config(self):
         resp = self.request("/sub.txt", query="pipe=sub")
@@ -66,6 +86,22 @@ class TestSub(TestUsingServer):
         expected = "PASS"
         self.assertEqual(resp.read().rstrip(), expected)
 
+    def test_sub_var(self):
+        ids = set()
+        for _ in range(2):
+            resp = self.request("/sub_var.txt", query="pipe=sub(none)")
+            first, second, port = resp.read().split(" ")
+            self.assertEqual(first, second)
+            self.assertEqual(port, "%i<%i>" % (self.server.port, self.server.port))
+            ids.add(first)
+        self.assertEqual(len(ids), 2)
+
+    def test_sub_error(self):
+        for _ in range(2):
+            with self.assertRaises(HTTPError) as cm:
+                self.request("/sub_error.txt", query="pipe=sub")
+            self.assertEqual(cm.exception.code, 500)
+
 class TestTrickle(TestUsingServer):
     def test_trickle(self):
         #Actually testing that the response trickles in is not that easy
@@ -76,5 +112,46 @@ class TestTrickle(TestUsingServer):
         self.assertEqual(resp.read(), expected)
         self.assertGreater(6, t1-t0)
 
+    def test_repeat_large(self):
+        chunk_size = wptserve.pipes.chunk_size
+        wptserve.pipes.chunk_size = 7
+        try:
+            resp = self.request("/document.txt", query="pipe=trickle(3:d0:r2)")
+        finally:
+            wptserve.pipes.chunk_size = chunk_size
+        expected = open(os.path.join(doc_root, "document.txt"), 'rb').read()
+        self.assertEqual(resp.read(), expected)
+
+
+class TestGzip(TestUsingServer):
+    def decompress(self, data):
+        return zlib.decompress(data, zlib.MAX_WBITS | 16)
+
+    def test_gzip(self):
+        resp = self.request("/document.txt", query="pipe=gzip")
+        expected = open(os.path.join(doc_root, "document.txt"), 'rb').read()
+        self.assertEqual("gzip", resp.info()["Content-Encoding"])
+        data = resp.read()
+        self.assertEqual(str(len(data)), resp.info()["Content-Length"])
+        self.assertEqual(self.decompress(data), expected)
+
+    def test_streamed(self):
+        gzip_buffer_size = wptserve.pipes.gzip_buffer_size
+        wptserve.pipes.gzip_buffer_size = 1
+        try:
+            resp = self.request("/document.txt", query="pipe=gzip")
+        finally:
+            wptserve.pipes.gzip_buffer_size = gzip_buffer_size
+        expected = open(os.path.join(doc_root, "document.txt"), 'rb').read()
+        self.assertEqual("gzip", resp.info()["Content-Encoding"])
+        self.assertNotIn("Content-Length", resp.info())
+        self.assertEqual(self.decompress(resp.read()), expected)
+
+    def test_trickle(self):
+        resp = self.request("/document.txt", query="pipe=trickle(5:d0.1)|gzip")
+        expected = open(os.path.join(doc_root, "document.txt"), 'rb').read()
+        self.assertNotIn("Content-Length", resp.info())
+        self.assertEqual(self.decompress(resp.read()), expected)
+
 if __name__ == '__main__':
     unittest.main()
@@ -47,6 +47,46 @@ class TestInputFile(TestUsingServer):
         self.assertEqual(200, resp.getcode())
         self.assertEqual(["12345\n", "abcdef\r\n", "zyxwv"], resp.read().split(" "))
 
+    def test_readline_max_bytes(self):
+        @wptserve.handlers.handler
+        def handler(request, response):
+            f = request.raw_input
+            rv = [f.readline(3), f.readline(10), f.readline(2)]
+            f.seek(1)
+            rv.append(f.readline(4))
+            rv.append(f.readline())
+            return "|".join(rv)
+
+        route = ("POST", "/test/test_readline_max_bytes", handler)
+        self.server.router.register(*route)
+        resp = self.request(route[1], method="POST", body="12345\nabcdef")
+        self.assertEqual("123|45\n|ab|2345|\n", resp.read())
+
+    def test_large(self):
+        lines = ["%i\n" % i for i in range(200000)]
+        body = "".join(lines)
+
+        @wptserve.handlers.handler
+        def handler(request, response):
+            f = request.raw_input
+            assert f.length > f.max_buffer_size
+            rv = []
+            rv.append(f.readline())
+            f.seek(len(body) - len(lines[-1]))
+            rv.append(f.readline())
+            f.seek(len(lines[0]))
+            rv.append(f.readline())
+            f.seek(0)
+            rv.append(str(f.readlines() == lines))
+            rv.append(str(request.body == body))
+            return "|".join(rv)
+
+        route = ("POST", "/test/test_large", handler)
+        self.server.router.register(*route)
+        resp = self.request(route[1], method="POST", body=body)
+        self.assertEqual("0\n|199999\n|1\n|True|True", resp.read())
+
+
 class TestRequest(TestUsingServer):
     def test_body(self):
         @wptserve.handlers.handler
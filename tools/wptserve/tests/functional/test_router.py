@@ -0,0 +1,92 @@
+import unittest
+
+import pytest
+
+wptserve = pytest.importorskip("wptserve")
+from wptserve.router import Router, any_method, literal_affixes
+
+
+class Request(object):
+    def __init__(self, method, path):
+        self.method = method
+        self.url_parts = type("UrlParts", (object,), {"path": path})
+        self.route_match = None
+
+
+def handler(name):
+    def inner(request, response):
+        pass
+    inner.__name__ = name
+    return inner
+
+
+class TestLiteralAffixes(unittest.TestCase):
+    def test_affixes(self):
+        self.assertEqual(literal_affixes("/tools/*"), ("/tools/", ""))
+        self.assertEqual(literal_affixes("*.any.html"), ("/", ".any.html"))
+        self.assertEqual(literal_affixes("{spec}/tools/*"), ("/", ""))
+        self.assertEqual(literal_affixes("api/{resource}/*.json"), ("/api/", ".json"))
+        self.assertEqual(literal_affixes("/serve.py"), ("/serve.py", ""))
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        self.file = handler("file")
+        self.py = handler("py")
+        self.forbidden = handler("forbidden")
+        self.spec_forbidden = handler("spec_forbidden")
+        self.api = handler("api")
+        self.exact = handler("exact")
+        self.router = Router("/", [
+            ("*", "/tools/*", self.forbidden),
+            ("*", "{spec}/tools/*", self.spec_forbidden),
+            ("POST", "/api/{resource}/*.json", self.api),
+            ("GET", "/serve.py", self.exact),
+            (any_method, "*.py", self.py),
+            ("GET", "*", self.file),
+        ])
+
+    def get(self, method, path):
+        request = Request(method, path)
+        return self.router.get_handler(request), request.route_match
+
+    def test_priority(self):
+        self.assertEqual(self.get("GET", "/tools/runner/index.html"),
+                         (self.forbidden, {"*": "runner/index.html"}))
+        self.assertEqual(self.get("GET", "/css/tools/a.py"),
+                         (self.spec_forbidden, {"spec": "css", "*": "a.py"}))
+        self.assertEqual(self.get("GET", "/serve.py"), (self.exact, {}))
+        self.assertEqual(self.get("POST", "/serve.py"), (self.py, {"*": "serve.py"}))
+        self.assertEqual(self.get("HEAD", "/a/b.html"), (self.file, {"*": "a/b.html"}))
+        self.assertEqual(self.get("POST", "/api/test/sub/data.json"),
+                         (self.api, {"resource": "test", "*": "sub/data.json"}))
+        self.assertEqual(self.get("GET", "/api/test/data.json"),
+                         (self.file, {"*": "api/test/data.json"}))
+        self.assertEqual(self.get("POST", "/a/b.html"), (None, None))
+
+    def test_cached(self):
+        first = self.get("GET", "/css/tools/a.py")
+        second = self.get("GET", "/css/tools/a.py")
+        self.assertEqual(first, second)
+        self.assertIsNot(first[1], second[1])
+        self.assertEqual(list(self.router._cache.keys()), [("GET", "/css/tools/a.py")])
+
+    def test_cache_size(self):
+        self.router.cache_size = 2
+        self.get("GET", "/a.html")
+        self.get("GET", "/b.html")
+        self.get("GET", "/a.html")
+        self.get("GET", "/c.html")
+        self.assertEqual(list(self.router._cache.keys()),
+                         [("GET", "/a.html"), ("GET", "/c.html")])
+
+    def test_register_invalidates(self):
+        self.assertEqual(self.get("GET", "/new/a.html")[0], self.file)
+        new = handler("new")
+        self.router.register("GET", "/new/*", new)
+        self.assertEqual(self.get("GET", "/new/a.html"), (new, {"*": "a.html"}))
+        self.assertEqual(self.get("GET", "/tools/a.html")[0], self.forbidden)
+
+
+if __name__ == "__main__":
+    unittest.main()
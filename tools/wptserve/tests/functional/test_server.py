@@ -1,10 +1,15 @@
+import socket
+import threading
+import time
 import unittest
 
 import pytest
+from six.moves import http_client
 from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import urlopen
 
 wptserve = pytest.importorskip("wptserve")
-from .base import TestUsingServer
+from .base import TestUsingServer, doc_root
 
 
 class TestFileHandler(TestUsingServer):
@@ -40,5 +45,221 @@ class TestRequestHandler(TestUsingServer):
 
         self.assertEqual(cm.exception.code, 500)
 
+class PooledServer(wptserve.server.WebTestServer):
+    max_workers = 2
+    idle_timeout = 0.5
+
+
+class TestPooledServer(TestUsingServer):
+    server_cls = PooledServer
+
+    def test_file(self):
+        resp = self.request("/document.txt")
+        self.assertEqual(200, resp.getcode())
+        self.assertEqual("This is a test document\n", resp.read())
+
+    def test_concurrent(self):
+        statuses = []
+
+        def fetch():
+            resp = self.request("/document.txt")
+            resp.read()
+            statuses.append(resp.getcode())
+
+        threads = [threading.Thread(target=fetch) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([200] * 20, statuses)
+
+    def test_pool_stats(self):
+        # Make sure that the server is running
+        self.request("/document.txt").read()
+        stats = self.server.httpd.pool_stats()
+        self.assertEqual(2, stats["workers"])
+        self.assertEqual(0, stats["queued"])
+
+        @wptserve.handlers.handler
+        def handler(request, response):
+            return str(self.server.httpd.pool_stats()["busy"])
+
+        self.server.router.register("GET", "/test/busy", handler)
+        self.assertEqual("1", self.request("/test/busy").read())
+
+    def test_idle_connection_closed(self):
+        # Idle keep-alive connections are closed after idle_timeout, so they
+        # don't hold on to the workers
+        socks = [socket.create_connection((self.server.host, self.server.port))
+                 for _ in range(2)]
+        try:
+            resp = self.request("/document.txt")
+            self.assertEqual(200, resp.getcode())
+            for sock in socks:
+                sock.settimeout(5)
+                self.assertEqual(b"", sock.recv(1))
+        finally:
+            for sock in socks:
+                sock.close()
+
+
+class SingleWorkerServer(wptserve.server.WebTestServer):
+    max_workers = 1
+
+    def __init__(self, *args, **kwargs):
+        wptserve.server.WebTestServer.__init__(self, *args, **kwargs)
+        self.accepted = []
+
+    def process_request(self, request, client_address):
+        # Keep a reference to each connection, so that it is only closed by
+        # the server and not when a dropped task is garbage collected
+        self.accepted.append(request)
+        wptserve.server.WebTestServer.process_request(self, request, client_address)
+
+
+class TestPooledServerShutdown(TestUsingServer):
+    server_cls = SingleWorkerServer
+
+    def test_queued_connection_closed(self):
+        # A connection still waiting for a worker when the server stops is
+        # closed rather than left open
+        release = threading.Event()
+
+        @wptserve.handlers.handler
+        def handler(request, response):
+            release.wait(5)
+            return "ok"
+
+        self.server.router.register("GET", "/test/block", handler)
+        busy = socket.create_connection((self.server.host, self.server.port))
+        queued = socket.create_connection((self.server.host, self.server.port))
+        stop_thread = threading.Thread(target=self.server.stop)
+        try:
+            busy.sendall(b"GET /test/block HTTP/1.1\r\nHost: localhost\r\n"
+                         b"Connection: close\r\n\r\n")
+            end = time.time() + 5
+            while time.time() < end:
+                # The pool is created once the server thread is running
+                stats = self.server.httpd.pool_stats()
+                if stats is not None and stats["busy"] == 1 and stats["queued"] == 1:
+                    break
+                time.sleep(0.01)
+            self.assertEqual({"workers": 1, "busy": 1, "queued": 1}, stats)
+
+            stop_thread.start()
+            queued.settimeout(5)
+            self.assertEqual(b"", queued.recv(1))
+        finally:
+            release.set()
+            if stop_thread.is_alive():
+                stop_thread.join()
+            busy.close()
+            queued.close()
+
+
+@pytest.mark.skipif(not hasattr(socket, "SO_REUSEPORT"),
+                    reason="SO_REUSEPORT is not supported")
+class TestReusePort(unittest.TestCase):
+    def test_shared_port(self):
+        servers = []
+        try:
+            for _ in range(2):
+                port = servers[0].port if servers else 0
+                server = wptserve.server.WebTestHttpd(host="localhost",
+                                                      port=port,
+                                                      doc_root=doc_root,
+                                                      reuse_port=True)
+                server.start(False)
+                servers.append(server)
+            self.assertEqual(servers[0].port, servers[1].port)
+            resp = urlopen("http://localhost:%i/document.txt" % servers[0].port)
+            self.assertEqual(200, resp.getcode())
+        finally:
+            for server in servers:
+                server.stop()
+
+
+class SmallEventLoopServer(wptserve.server.EventLoopServer):
+    max_workers = 2
+
+
+class TestEventLoopServer(TestUsingServer):
+    server_cls = SmallEventLoopServer
+
+    def setUp(self):
+        TestUsingServer.setUp(self)
+
+        @wptserve.handlers.handler
+        def handler(request, response):
+            return [("Content-Length", "2")], "ok"
+
+        self.server.router.register("GET", "/test/ok", handler)
+
+    def test_file(self):
+        resp = self.request("/document.txt")
+        self.assertEqual(200, resp.getcode())
+        self.assertEqual("This is a test document\n", resp.read())
+
+    def test_not_handled(self):
+        with self.assertRaises(HTTPError) as cm:
+            self.request("/not_existing")
+
+        self.assertEqual(cm.exception.code, 404)
+
+    def test_keep_alive(self):
+        conn = http_client.HTTPConnection(self.server.host, self.server.port)
+        try:
+            for _ in range(3):
+                conn.request("GET", "/test/ok")
+                resp = conn.getresponse()
+                self.assertEqual(200, resp.status)
+                self.assertEqual("ok", resp.read())
+                self.assertFalse(resp.will_close)
+                # Let the connection go idle between requests
+                time.sleep(0.1)
+        finally:
+            conn.close()
+
+    def test_pipelined(self):
+        sock = socket.create_connection((self.server.host, self.server.port))
+        try:
+            sock.settimeout(5)
+            sock.sendall(b"GET /test/ok HTTP/1.1\r\nHost: localhost\r\n\r\n" * 3)
+            data = b""
+            while data.count(b"HTTP/1.1 200") < 3 or not data.endswith(b"ok"):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            self.assertEqual(3, data.count(b"HTTP/1.1 200"))
+        finally:
+            sock.close()
+
+    def test_trickle_does_not_block_workers(self):
+        # Each response is delayed for 1s, but the delays don't occupy a
+        # worker thread, so two workers serve all the requests at once
+        statuses = []
+
+        def fetch():
+            resp = self.request("/document.txt", query="pipe=trickle(d1)")
+            resp.read()
+            statuses.append(resp.getcode())
+
+        threads = [threading.Thread(target=fetch) for _ in range(8)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([200] * 8, statuses)
+        self.assertLess(time.time() - start, 4)
+
+    def test_latency(self):
+        self.server.httpd.latency = 200
+        start = time.time()
+        resp = self.request("/test/ok")
+        self.assertEqual("ok", resp.read())
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
 if __name__ == "__main__":
     unittest.main()
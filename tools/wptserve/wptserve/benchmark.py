@@ -0,0 +1,147 @@
+"""Measure the throughput of wptserve for large request and response
+bodies.
+
+The sendfile benchmark serves large static files to concurrent clients,
+with and without sendfile. The upload benchmark posts large
+multipart/form-data bodies to a handler that parses them with
+request.POST.
+
+Run from the tools/wptserve directory as:
+
+    python -m wptserve.benchmark [sendfile|upload] [--size MB] [--clients N]
+                                 [--requests N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from six.moves import http_client
+
+from .handlers import handler
+from .response import ResponseWriter
+from .server import WebTestHttpd
+
+
+def fetch(host, port, path, requests, headers, results, method="GET", body=None):
+    received = 0
+    conn = http_client.HTTPConnection(host, port)
+    try:
+        for _ in range(requests):
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            while True:
+                data = resp.read(256 * 1024)
+                if not data:
+                    break
+                received += len(data)
+            if resp.getheader("Connection", "").lower() == "close" or resp.will_close:
+                conn.close()
+                conn = http_client.HTTPConnection(host, port)
+    finally:
+        conn.close()
+    results.append(received)
+
+
+def run(server, path, clients, requests, headers=None, method="GET", body=None):
+    results = []
+    threads = [threading.Thread(target=fetch,
+                                args=(server.host, server.port, path, requests,
+                                      headers or {}, results, method, body))
+               for _ in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(results), time.time() - start
+
+
+def multipart_body(data, boundary):
+    return b"".join([b"--%s\r\n" % boundary,
+                     b'Content-Disposition: form-data; name="name"\r\n\r\n',
+                     b"value\r\n",
+                     b"--%s\r\n" % boundary,
+                     b'Content-Disposition: form-data; name="file"; filename="file.bin"\r\n',
+                     b"Content-Type: application/octet-stream\r\n\r\n",
+                     data,
+                     b"\r\n--%s--\r\n" % boundary])
+
+
+@handler
+def upload_handler(request, response):
+    return str(len(request.POST["file"].value))
+
+
+def benchmark_sendfile(args):
+    doc_root = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(doc_root, "large.bin"), "wb") as f:
+            f.write(os.urandom(int(args.size * 1024 * 1024)))
+
+        server = WebTestHttpd(host="127.0.0.1", port=0, doc_root=doc_root)
+        server.start(False)
+        try:
+            range_header = {"Range": "bytes=1-%i" % (args.size * 1024 * 1024 / 2)}
+            for use_sendfile in [False, True]:
+                ResponseWriter.use_sendfile = use_sendfile
+                name = "sendfile" if use_sendfile else "copy"
+                for label, headers in [("file", None), ("range", range_header)]:
+                    received, elapsed = run(server, "/large.bin", args.clients,
+                                            args.requests, headers)
+                    print("%-8s %-5s %8.1f MB in %.3fs, %8.1f MB/s" %
+                          (name, label, received / 1048576., elapsed,
+                           received / 1048576. / elapsed))
+        finally:
+            ResponseWriter.use_sendfile = True
+            server.stop()
+    finally:
+        shutil.rmtree(doc_root)
+
+
+def benchmark_upload(args):
+    server = WebTestHttpd(host="127.0.0.1", port=0, doc_root=os.curdir,
+                          routes=[("POST", "/upload", upload_handler)])
+    server.start(False)
+    try:
+        boundary = b"wptserve-benchmark-boundary"
+        body = multipart_body(os.urandom(int(args.size * 1024 * 1024)), boundary)
+        headers = {"Content-Type": "multipart/form-data; boundary=%s" % boundary}
+        _, elapsed = run(server, "/upload", args.clients, args.requests, headers,
+                         method="POST", body=body)
+        sent = len(body) * args.clients * args.requests
+        print("upload %8.1f MB in %.3fs, %8.1f MB/s" %
+              (sent / 1048576., elapsed, sent / 1048576. / elapsed))
+    finally:
+        server.stop()
+
+
+benchmarks = {"sendfile": benchmark_sendfile,
+              "upload": benchmark_upload}
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", nargs="?", choices=sorted(benchmarks),
+                        default="sendfile", help="Benchmark to run")
+    parser.add_argument("--size", type=float, default=8,
+                        help="Size of the file to serve or upload in MB")
+    parser.add_argument("--clients", type=int, default=8,
+                        help="Number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=10,
+                        help="Number of requests made by each client")
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+    benchmarks[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
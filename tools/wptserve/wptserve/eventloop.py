@@ -0,0 +1,264 @@
+import errno
+import heapq
+import itertools
+import select
+import socket
+import threading
+import time
+import traceback
+
+from six.moves import queue
+
+from .logger import get_logger
+
+
+class Poller(object):
+    """Wait for file descriptors to become readable, using poll where it is
+    available and select otherwise"""
+
+    def __init__(self):
+        self.fds = set()
+        self._poll = select.poll() if hasattr(select, "poll") else None
+
+    def register(self, fd):
+        self.fds.add(fd)
+        if self._poll is not None:
+            self._poll.register(fd, select.POLLIN | select.POLLPRI)
+
+    def unregister(self, fd):
+        self.fds.discard(fd)
+        if self._poll is not None:
+            self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        """Wait for registered file descriptors to become readable.
+
+        :param timeout: Maximum time to wait in seconds, or None to wait
+                        indefinitely
+        :returns: List of file descriptors that are readable, or that have
+                  been closed or errored"""
+        try:
+            if self._poll is not None:
+                return [fd for fd, _ in
+                        self._poll.poll(None if timeout is None else timeout * 1000)]
+            readable, _, errored = select.select(list(self.fds), [], list(self.fds), timeout)
+            return list(set(readable) | set(errored))
+        except (select.error, OSError, IOError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+class EventLoop(object):
+    """Single threaded loop dispatching callbacks when file descriptors become
+    readable and when timers expire.
+
+    Only call_soon_threadsafe and stop may be called from other threads;
+    everything else must happen on the thread running the loop."""
+
+    def __init__(self):
+        self.poller = Poller()
+        self.readers = {}
+        self.timers = []
+        self._timer_ids = itertools.count()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._stopped = False
+        if hasattr(socket, "socketpair"):
+            self._wake_read, self._wake_write = socket.socketpair()
+        else:
+            self._wake_read, self._wake_write = _socketpair()
+        self._wake_read.setblocking(False)
+        self._wake_write.setblocking(False)
+        self.add_reader(self._wake_read.fileno(), self._drain_wakeup)
+
+    def add_reader(self, fd, callback):
+        """Call callback() when fd becomes readable, until remove_reader
+        is called for fd"""
+        self.readers[fd] = callback
+        self.poller.register(fd)
+
+    def remove_reader(self, fd):
+        if self.readers.pop(fd, None) is not None:
+            self.poller.unregister(fd)
+
+    def call_later(self, delay, callback):
+        """Call callback() after delay seconds"""
+        heapq.heappush(self.timers, (time.time() + delay, next(self._timer_ids), callback))
+
+    def call_soon_threadsafe(self, callback):
+        """Call callback() on the loop thread as soon as possible. This may
+        be used from any thread."""
+        with self._pending_lock:
+            self._pending.append(callback)
+        self._wakeup()
+
+    def stop(self):
+        """Make run() return after the current iteration. This may be used
+        from any thread."""
+        self._stopped = True
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wake_write.send(b"\0")
+        except socket.error:
+            # The buffer is full, so the loop will wake up anyway
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while self._wake_read.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _run_callback(self, callback):
+        try:
+            callback()
+        except Exception:
+            get_logger().error(traceback.format_exc())
+
+    def run(self):
+        """Run the loop until stop() is called"""
+        while not self._stopped:
+            timeout = None
+            if self.timers:
+                timeout = max(self.timers[0][0] - time.time(), 0)
+            with self._pending_lock:
+                if self._pending:
+                    timeout = 0
+
+            for fd in self.poller.poll(timeout):
+                callback = self.readers.get(fd)
+                if callback is not None:
+                    self._run_callback(callback)
+
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, callback = heapq.heappop(self.timers)
+                self._run_callback(callback)
+
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            for callback in pending:
+                self._run_callback(callback)
+
+    def close(self):
+        self.remove_reader(self._wake_read.fileno())
+        self._wake_read.close()
+        self._wake_write.close()
+
+
+def _socketpair():
+    # socket.socketpair isn't available on Windows with Python 2
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+    finally:
+        listener.close()
+    return server, client
+
+
+class WorkerPool(object):
+    """Fixed number of threads running submitted functions in order.
+
+    :param size: Number of worker threads
+    :param name: Prefix for the names of the threads
+    :param max_queued: Maximum number of functions waiting for a thread,
+                       beyond which submit blocks, or None for no limit
+    """
+
+    def __init__(self, size, name="worker", max_queued=None):
+        self.size = size
+        self.tasks = queue.Queue(max_queued or 0)
+        self.threads = []
+        self.busy = 0
+        self._busy_lock = threading.Lock()
+        for i in range(size):
+            thread = threading.Thread(target=self._run, name="%s-%i" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    @property
+    def queued(self):
+        """Number of submitted functions waiting for a thread"""
+        return self.tasks.qsize()
+
+    def stats(self):
+        """Get a snapshot of the pool's usage.
+
+        :returns: Dictionary with the number of worker threads, the number
+                  of those running a function, and the number of functions
+                  waiting for a thread"""
+        return {"workers": self.size,
+                "busy": self.busy,
+                "queued": self.queued}
+
+    def submit(self, func, *args):
+        """Run func(*args) on a worker thread"""
+        self.tasks.put((func, args))
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            func, args = task
+            with self._busy_lock:
+                self.busy += 1
+            try:
+                func(*args)
+            except Exception:
+                get_logger().error(traceback.format_exc())
+            finally:
+                with self._busy_lock:
+                    self.busy -= 1
+            # Drop references before waiting for the next task
+            task = func = args = None
+
+    def shutdown(self, wait=True, timeout=None, on_drop=None):
+        """Stop the worker threads once the tasks already submitted have run.
+
+        If the queue is full, the oldest waiting tasks are dropped to make
+        room for the stop signals, so that shutdown never blocks on a
+        queue that the (possibly stuck) workers aren't emptying.
+
+        :param wait: Wait for the threads to finish
+        :param timeout: Maximum time in seconds to wait, or None to wait
+                        indefinitely
+        :param on_drop: Function called as on_drop(func, *args) for each
+                        task that is dropped, so that any resources it
+                        holds can be released
+        """
+        dropped = 0
+        for _ in self.threads:
+            while True:
+                try:
+                    self.tasks.put_nowait(None)
+                    break
+                except queue.Full:
+                    try:
+                        task = self.tasks.get_nowait()
+                    except queue.Empty:
+                        continue
+                    dropped += 1
+                    if task is not None and on_drop is not None:
+                        func, args = task
+                        try:
+                            on_drop(func, *args)
+                        except Exception:
+                            get_logger().error(traceback.format_exc())
+        if dropped:
+            get_logger().warning("Dropped %i queued tasks on shutdown" % dropped)
+        if wait:
+            end = None if timeout is None else time.time() + timeout
+            current = threading.current_thread()
+            for thread in self.threads:
+                if thread is not current:
+                    thread.join(None if end is None else max(end - time.time(), 0))
+        self.threads = []
@@ -0,0 +1,168 @@
+import errno
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Approximate memory used by an entry, in addition to any file content
+entry_overhead = 256
+
+
+def stat_or_none(path):
+    try:
+        return os.stat(path)
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
+
+
+def stat_key(stat):
+    if stat is None:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+class CacheEntry(object):
+    __slots__ = ("stat", "key", "checked", "data", "values")
+
+    def __init__(self, stat, checked):
+        self.stat = stat
+        self.key = stat_key(stat)
+        self.checked = checked
+        self.data = None
+        self.values = {}
+
+    @property
+    def size(self):
+        return entry_overhead + (len(self.data) if self.data is not None else 0)
+
+
+class FileCache(object):
+    """Thread-safe LRU cache of file stat data, file content, and values
+    derived from file content, bounded by the total size of the content.
+
+    Files that don't exist are cached too, so that repeatedly checking
+    for optional files doesn't touch the disk. An entry is checked
+    against the file on disk when it is used, if it hasn't been checked
+    for more than check_interval seconds, and is dropped if the mtime or
+    size of the file has changed.
+
+    :param max_size: Maximum number of bytes of content to hold
+    :param max_file_size: Size in bytes of the largest file whose content
+                          will be cached. Defaults to max_size / 16.
+    :param check_interval: Time in seconds for which a file is assumed
+                           to be unchanged after it was last checked.
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024, max_file_size=None, check_interval=1.0):
+        self.max_size = max_size
+        self.max_file_size = max_file_size if max_file_size is not None else max_size // 16
+        self.check_interval = check_interval
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Cached data isn't useful in another process, and locks can't be
+        # pickled
+        return {"max_size": self.max_size,
+                "max_file_size": self.max_file_size,
+                "check_interval": self.check_interval}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_entry(self, path):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self.size -= entry.size
+        if entry is not None and now - entry.checked > self.check_interval:
+            stat = stat_or_none(path)
+            if stat_key(stat) != entry.key:
+                entry = CacheEntry(stat, now)
+            else:
+                entry.checked = now
+        if entry is None:
+            entry = CacheEntry(stat_or_none(path), now)
+        self._put_entry(path, entry)
+        return entry
+
+    def _put_entry(self, path, entry):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= old.size
+            self._entries[path] = entry
+            self.size += entry.size
+            self._evict()
+
+    def _evict(self):
+        # The most recently used entry is always kept
+        while self.size > self.max_size and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stat(self, path):
+        """Get the stat data for a path.
+
+        :returns: os.stat_result, or None if the path doesn't exist"""
+        return self._get_entry(path).stat
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def read(self, path):
+        """Get the content of a file, if it's small enough to cache.
+
+        :returns: The file content as bytes, or None if the file is too
+                  large to cache and should be read directly
+        :raises IOError: If the file doesn't exist or can't be read"""
+        entry = self._get_entry(path)
+        if entry.stat is None:
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        if entry.data is not None:
+            return entry.data
+        if entry.stat.st_size > self.max_file_size:
+            return None
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) == entry.stat.st_size:
+            # Otherwise the file changed after it was checked
+            with self._lock:
+                if self._entries.get(path) is entry:
+                    entry.data = data
+                    self.size += len(data)
+                    self._evict()
+        return data
+
+    def get(self, path, name, func):
+        """Get a value computed from the content of a file, caching it for
+        as long as the file content is cached.
+
+        :param path: Path to the file
+        :param name: Name distinguishing this value from others derived
+                     from the same file
+        :param func: Function taking the file content as bytes and
+                     returning the value
+        :raises IOError: If the file doesn't exist or can't be read"""
+        data = self.read(path)
+        if data is None:
+            with open(path, "rb") as f:
+                return func(f.read())
+        entry = self._entries.get(path)
+        if entry is None or entry.data is not data:
+            return func(data)
+        if name not in entry.values:
+            entry.values[name] = func(data)
+        return entry.values[name]
@@ -1,15 +1,23 @@
 import cgi
+import errno
 import json
 import os
+import stat as stat_module
+import threading
 import traceback
+from collections import OrderedDict
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from io import BytesIO
 
+from six import exec_
 from six.moves.urllib.parse import parse_qs, quote, unquote, urljoin
 
 from .constants import content_types
+from .filecache import stat_key, stat_or_none
 from .pipes import Pipeline, template
 from .ranges import RangeParser
 from .request import Authentication
-from .response import MultipartContent
+from .response import FileRange, MultipartContent
 from .utils import HTTPException
 
 __all__ = ["file_handler", "python_script_handler",
@@ -101,7 +109,9 @@ class DirectoryHandler(object):
                    {"link": link, "name": cgi.escape(item), "class": class_})
 
 
-def wrap_pipeline(path, request, response):
+def get_pipeline(path, request):
+    """Get the Pipeline to apply to the response for a file, or None if the
+    file is sent unchanged"""
     query = parse_qs(request.url_parts.query)
 
     pipeline = None
@@ -112,16 +122,79 @@ def wrap_pipeline(path, request, response):
         escape_type = "html" if os.path.splitext(path)[1] in ml_extensions else "none"
         pipeline = Pipeline("sub(%s)" % escape_type)
 
+    return pipeline
+
+
+def wrap_pipeline(path, request, response):
+    pipeline = get_pipeline(path, request)
+
     if pipeline is not None:
         response = pipeline(request, response)
 
     return response
 
 
+def parse_headers(data):
+    return [tuple(item.strip() for item in line.split(":", 1))
+            for line in data.splitlines() if line]
+
+
+def make_etag(stat):
+    """Get a strong entity tag for a file from its mtime and size"""
+    return '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def parse_http_date(value):
+    """Parse a HTTP date into a timestamp, or return None if it isn't valid"""
+    if value is None:
+        return None
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+
+def etag_matches(header, etag):
+    """Check whether a If-None-Match header value matches an entity tag,
+    using the weak comparison function"""
+    etag = etag[2:] if etag.startswith("W/") else etag
+    for item in header.split(","):
+        item = item.strip()
+        if item == "*":
+            return True
+        if item.startswith("W/"):
+            item = item[2:]
+        if item == etag:
+            return True
+    return False
+
+
 class FileHandler(object):
-    def __init__(self, base_path=None, url_base="/"):
+    """Handler serving files from the filesystem.
+
+    :param base_path: Path to the directory to serve from, defaulting
+                      to the doc_root of the request
+    :param url_base: URL path that maps to base_path
+    :param cache: Optional filecache.FileCache used to avoid reading
+                  frequently requested files and their headers from
+                  disk on every request
+    :param validators: Send ETag and Last-Modified headers for files that
+                       aren't altered by a pipe, and respond to conditional
+                       requests with 304 Not Modified. Either header may be
+                       overridden in a .headers file.
+    """
+    def __init__(self, base_path=None, url_base="/", cache=None, validators=False):
         self.base_path = base_path
         self.url_base = url_base
+        self.cache = cache
+        self.validators = validators
         self.directory_handler = DirectoryHandler(self.base_path, self.url_base)
 
     def __repr__(self):
@@ -130,13 +203,30 @@ class FileHandler(object):
     def __call__(self, request, response):
         path = filesystem_path(self.base_path, request, self.url_base)
 
-        if os.path.isdir(path):
+        if self.cache is not None:
+            try:
+                stat = self.cache.stat(path)
+            except OSError:
+                raise HTTPException(404)
+            if stat is None:
+                raise HTTPException(404)
+            is_dir = stat_module.S_ISDIR(stat.st_mode)
+        else:
+            is_dir = os.path.isdir(path)
+        if is_dir:
             return self.directory_handler(request, response)
         try:
             #This is probably racy with some other process trying to change the file
-            file_size = os.stat(path).st_size
+            if self.cache is None:
+                stat = os.stat(path)
+            file_size = stat.st_size
             response.headers.update(self.get_headers(request, path))
-            if "Range" in request.headers:
+            use_range = "Range" in request.headers
+            if self.validators and get_pipeline(path, request) is None:
+                if self.check_validators(request, response, stat):
+                    return response
+                use_range = use_range and self.if_range_matches(request, response)
+            if use_range:
                 try:
                     byte_ranges = RangeParser()(request.headers['Range'], file_size)
                 except HTTPException as e:
@@ -153,6 +243,50 @@ class FileHandler(object):
         except (OSError, IOError):
             raise HTTPException(404)
 
+    def check_validators(self, request, response, stat):
+        """Add validators for a file to a response, unless they are already
+        set, and check them against any conditions in the request.
+
+        :returns: True if the client's copy of the file is current, in which
+                  case the response has been made a 304 Not Modified
+                  response."""
+        if "ETag" not in response.headers:
+            response.headers.set("ETag", make_etag(stat))
+        if "Last-Modified" not in response.headers:
+            response.headers.set("Last-Modified", http_date(stat.st_mtime))
+
+        if request.method not in ("GET", "HEAD"):
+            return False
+
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            not_modified = etag_matches(if_none_match, response.headers.get("ETag")[-1])
+        else:
+            if_modified_since = parse_http_date(request.headers.get("If-Modified-Since"))
+            last_modified = parse_http_date(response.headers.get("Last-Modified")[-1])
+            not_modified = (if_modified_since is not None and last_modified is not None and
+                            last_modified <= if_modified_since)
+
+        if not_modified:
+            response.status = 304
+            response.content = ""
+        return not_modified
+
+    def if_range_matches(self, request, response):
+        """Check whether a Range header should be used, given any If-Range
+        header in the request"""
+        if_range = request.headers.get("If-Range")
+        if if_range is None:
+            return True
+        if if_range.startswith('"'):
+            # Requires a strong match
+            etag = response.headers.get("ETag")[-1]
+            return not etag.startswith("W/") and if_range == etag
+        if if_range.startswith("W/"):
+            return False
+        date = parse_http_date(if_range)
+        return date is not None and date == parse_http_date(response.headers.get("Last-Modified")[-1])
+
     def get_headers(self, request, path):
         rv = (self.load_headers(request, os.path.join(os.path.split(path)[0], "__dir__")) +
               self.load_headers(request, path))
@@ -164,43 +298,61 @@ class FileHandler(object):
 
     def load_headers(self, request, path):
         headers_path = path + ".sub.headers"
-        if os.path.exists(headers_path):
-            use_sub = True
+        if self.cache is not None:
+            use_sub = self.cache.exists(headers_path)
         else:
+            use_sub = os.path.exists(headers_path)
+        if not use_sub:
             headers_path = path + ".headers"
-            use_sub = False
 
         try:
-            with open(headers_path) as headers_file:
-                data = headers_file.read()
+            if self.cache is not None:
+                if not use_sub:
+                    return list(self.cache.get(headers_path, "headers", parse_headers))
+                data = self.cache.read(headers_path)
+            else:
+                with open(headers_path) as headers_file:
+                    data = headers_file.read()
         except IOError:
             return []
         else:
             if use_sub:
                 data = template(request, data, escape_type="none")
-            return [tuple(item.strip() for item in line.split(":", 1))
-                    for line in data.splitlines() if line]
+            return parse_headers(data)
+
+    def open_file(self, path):
+        """Open a file for reading, from the cache if it's cached"""
+        if self.cache is not None:
+            data = self.cache.read(path)
+            if data is not None:
+                return BytesIO(data)
+        return open(path, 'rb')
 
     def get_data(self, response, path, byte_ranges):
         """Return either the handle to a file, or a string containing
         the content of a chunk of the file, if we have a range request."""
         if byte_ranges is None:
+            if self.cache is not None:
+                data = self.cache.read(path)
+                if data is not None:
+                    return data
             return open(path, 'rb')
+        elif len(byte_ranges) == 1:
+            # Returned as a file so that it can be sent with sendfile
+            response.status = 206
+            response.headers.set("Content-Range", byte_ranges[0].header_value())
+            return FileRange(self.open_file(path), byte_ranges[0].lower, byte_ranges[0].upper)
         else:
-            with open(path, 'rb') as f:
+            with self.open_file(path) as f:
                 response.status = 206
-                if len(byte_ranges) > 1:
-                    parts_content_type, content = self.set_response_multipart(response,
-                                                                              byte_ranges,
-                                                                              f)
-                    for byte_range in byte_ranges:
-                        content.append_part(self.get_range_data(f, byte_range),
-                                            parts_content_type,
-                                            [("Content-Range", byte_range.header_value())])
-                    return content
-                else:
-                    response.headers.set("Content-Range", byte_ranges[0].header_value())
-                    return self.get_range_data(f, byte_ranges[0])
+                parts_content_type, content = self.set_response_multipart(response,
+                                                                          byte_ranges,
+                                                                          f)
+                for byte_range in byte_ranges:
+                    content.append_part(self.get_range_data(f, byte_range),
+                                        parts_content_type,
+                                        [("Content-Range", byte_range.header_value())])
+                return content
 
     def set_response_multipart(self, response, ranges, f):
         parts_content_type = response.headers.get("Content-Type")
@@ -220,6 +372,78 @@ class FileHandler(object):
 file_handler = FileHandler()
 
 
+class ScriptEntry(object):
+    __slots__ = ("key", "code", "namespace")
+
+    def __init__(self, key, code):
+        self.key = key
+        self.code = code
+        self.namespace = None
+
+
+class ScriptCache(object):
+    """Thread-safe LRU cache of the compiled code of python handler scripts,
+    checked against the mtime and size of the file on each use.
+
+    A script that sets __stateless__ = True at module level is only run
+    once, and its namespace is reused until the file changes. Scripts that
+    keep state in globals, or that do work at import time which must be
+    repeated for each request, must not set this.
+
+    :param max_entries: Maximum number of scripts to cache
+    """
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_entry(self, path):
+        stat = stat_or_none(path)
+        if stat is None:
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        key = stat_key(stat)
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None and entry.key == key:
+                self._entries[path] = entry
+                return entry
+
+        with open(path, "rb") as f:
+            code = compile(f.read(), path, "exec")
+        entry = ScriptEntry(key, code)
+        with self._lock:
+            self._entries[path] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def load(self, path):
+        """Run the script at path, or reuse its namespace from an earlier
+        run if it is stateless.
+
+        :returns: The module namespace of the script
+        :raises IOError: If the script doesn't exist or can't be read"""
+        entry = self._get_entry(path)
+        namespace = entry.namespace
+        if namespace is not None:
+            return namespace
+        environ = {"__file__": path}
+        exec_(entry.code, environ, environ)
+        if environ.get("__stateless__") is True:
+            entry.namespace = environ
+        return environ
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+script_cache = ScriptCache()
+
+
 class PythonScriptHandler(object):
     def __init__(self, base_path=None, url_base="/"):
         self.base_path = base_path
@@ -232,8 +456,7 @@ class PythonScriptHandler(object):
         path = filesystem_path(self.base_path, request, self.url_base)
 
         try:
-            environ = {"__file__": path}
-            execfile(path, environ, environ)
+            environ = script_cache.load(path)
             if "main" in environ:
                 handler = FunctionHandler(environ["main"])
                 handler(request, response)
@@ -1,16 +1,117 @@
 from cgi import escape
 import gzip as gzip_module
 import re
-import time
+import threading
 import types
 import uuid
+import zlib
+from collections import OrderedDict
 from cStringIO import StringIO
 
+from six.moves import builtins
+
+from .response import Delay, FileRange
+
+# Size of the blocks in which pipes that stream the response read files
+chunk_size = 64 * 1024
+
+# Largest file that the gzip pipe compresses in one go, so that it can
+# set Content-Length; larger files are compressed as they are sent
+gzip_buffer_size = 1024 * 1024
+
 
 def resolve_content(response):
     return b"".join(item for item in response.iter_content(read_file=True))
 
 
+def iter_file(f):
+    """Iterate over the content of a file in blocks, closing it at the end"""
+    try:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+
+def iter_chunks(content, delays=False):
+    """Iterate over response content in chunks, reading files in blocks
+    rather than all at once.
+
+    This takes the content rather than the response, since pipes replace
+    the response content with a generator that uses this one.
+
+    :param content: The response content
+    :param delays: Boolean indicating whether to return Delays in the
+                   content rather than calling them, as for
+                   Response.iter_content"""
+    if isinstance(content, types.StringTypes) or hasattr(content, "read"):
+        content = [content]
+    for item in content:
+        if delays and isinstance(item, Delay):
+            yield item
+            continue
+        if hasattr(item, "__call__"):
+            item = item()
+        if hasattr(item, "read"):
+            for data in iter_file(item):
+                yield data
+        elif item:
+            yield item
+
+
+def remaining_size(f):
+    """Get the number of bytes left to read in a file, or None if that
+    can't be found without reading it"""
+    if isinstance(f, FileRange):
+        return f.remaining
+    try:
+        position = f.tell()
+        f.seek(0, 2)
+        end = f.tell()
+        f.seek(position)
+    except (AttributeError, IOError, ValueError):
+        return None
+    return end - position
+
+
+class ChunkReader(object):
+    """Read arbitrary amounts of data from an iterator of chunks, without
+    joining the chunks together"""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b""
+        self.position = 0
+
+    def _next_chunk(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.chunk = chunk
+                self.position = 0
+                return True
+        return False
+
+    def at_end(self):
+        return self.position >= len(self.chunk) and not self._next_chunk()
+
+    def read(self, size):
+        parts = []
+        while size > 0 and not self.at_end():
+            data = self.chunk[self.position:self.position + size]
+            self.position += len(data)
+            size -= len(data)
+            parts.append(data)
+        return b"".join(parts)
+
+    def iter_remaining(self):
+        while not self.at_end():
+            data = self.chunk[self.position:]
+            self.position = len(self.chunk)
+            yield data
+
+
 class Pipeline(object):
     pipes = {}
 
@@ -228,25 +329,24 @@ def trickle(request, response, delays):
     delays = parse_delays()
     if not delays:
         return response
-    content = resolve_content(response)
-    offset = [0]
+    content = ChunkReader(iter_chunks(response.content))
 
     def add_content(delays, repeat=False):
         for i, (item_type, value) in enumerate(delays):
             if item_type == "bytes":
-                yield content[offset[0]:offset[0] + value]
-                offset[0] += value
+                yield content.read(value)
             elif item_type == "delay":
-                time.sleep(value)
+                yield Delay(value)
             elif item_type == "repeat":
                 if i != len(delays) - 1:
                     continue
-                while offset[0] < len(content):
+                while not content.at_end():
                     for item in add_content(delays[-(value + 1):-1], True):
                         yield item
 
-        if not repeat and offset[0] < len(content):
-            yield content[offset[0]:]
+        if not repeat:
+            for item in content.iter_remaining():
+                yield item
 
     response.content = add_content(delays)
     return response
@@ -263,6 +363,19 @@ def slice(request, response, start, end=None):
                 (spelled "null" in a query string) to indicate the end of
                 the file.
     """
+    content = response.content
+    if hasattr(content, "read"):
+        size = remaining_size(content)
+        if size is not None:
+            # Send just the slice of the file, without reading the rest
+            lower, upper, _ = builtins.slice(start, end).indices(size)
+            if isinstance(content, FileRange):
+                f, offset = content.file, content.position
+            else:
+                f, offset = content, content.tell()
+            response.content = FileRange(f, offset + lower, offset + max(lower, upper))
+            return response
+
     content = resolve_content(response)
     response.content = content[start:end]
     return response
@@ -357,26 +470,41 @@ def sub(request, response, escape_type="html"):
     response.content = new_content
     return response
 
-def template(request, content, escape_type="html"):
-    #TODO: There basically isn't any error handling here
-    tokenizer = ReplacementTokenizer()
 
-    variables = {}
+class Substitution(object):
+    """A single {{...}} substitution in a template, with the tokens already
+    split into the variable being assigned, the field being looked up, and
+    the chain of indices applied to the field's value."""
+    __slots__ = ("tokens", "variable", "field", "indices", "error")
 
-    def config_replacement(match):
-        content, = match.groups()
+    def __init__(self, content):
+        self.tokens = None
+        self.variable = None
+        self.field = None
+        self.indices = None
+        # Errors are raised when the substitution is rendered, so that
+        # templates fail in the same place as they would if they were
+        # processed in a single pass.
+        self.error = None
 
-        tokens = tokenizer.tokenize(content)
+        try:
+            tokens = self.tokens = ReplacementTokenizer().tokenize(content)
+            if tokens[0][0] == "var":
+                self.variable = tokens[0][1]
+                tokens = tokens[1:]
 
-        if tokens[0][0] == "var":
-            variable = tokens[0][1]
-            tokens = tokens[1:]
-        else:
-            variable = None
+            assert tokens[0][0] == "ident" and all(item[0] == "index" for item in tokens[1:]), tokens
+
+            self.field = tokens[0][1]
+            self.indices = [item[1] for item in tokens[1:]]
+        except Exception as e:
+            self.error = e
 
-        assert tokens[0][0] == "ident" and all(item[0] == "index" for item in tokens[1:]), tokens
+    def lookup(self, request, variables):
+        if self.error is not None:
+            raise self.error
 
-        field = tokens[0][1]
+        field = self.field
 
         if field in variables:
             value = variables[field]
@@ -385,7 +513,7 @@ def template(request, content, escape_type="html"):
         elif field == "GET":
             value = FirstWrapper(request.GET)
         elif field in request.server.config:
-            value = request.server.config[tokens[0][1]]
+            value = request.server.config[field]
         elif field == "location":
             value = {"server": "%s://%s:%s" % (request.url_parts.scheme,
                                                request.url_parts.hostname,
@@ -405,25 +533,105 @@ def template(request, content, escape_type="html"):
         else:
             raise Exception("Undefined template variable %s" % field)
 
-        for item in tokens[1:]:
-            value = value[item[1]]
+        for index in self.indices:
+            value = value[index]
+
+        assert isinstance(value, (int,) + types.StringTypes), self.tokens
+
+        if self.variable is not None:
+            variables[self.variable] = value
+
+        return value
 
-        assert isinstance(value, (int,) + types.StringTypes), tokens
 
-        if variable is not None:
-            variables[variable] = value
+escape_funcs = {"html": lambda x: escape(x, quote=True),
+                "none": lambda x: x}
 
-        escape_func = {"html": lambda x:escape(x, quote=True),
-                       "none": lambda x:x}[escape_type]
 
-        #Should possibly support escaping for other contexts e.g. script
-        #TODO: read the encoding of the response
-        return escape_func(unicode(value)).encode("utf-8")
+class CompiledTemplate(object):
+    """Content split into literal chunks and the substitutions between
+    them, so that it can be rendered repeatedly without being parsed again.
 
+    :param content: The template content as bytes
+    """
     template_regexp = re.compile(r"{{([^}]*)}}")
-    new_content = template_regexp.sub(config_replacement, content)
 
-    return new_content
+    def __init__(self, content):
+        # Empty bytes or unicode, matching the type of the content
+        self.empty = content[:0]
+        self.parts = []
+        pos = 0
+        for match in self.template_regexp.finditer(content):
+            if match.start() > pos:
+                self.parts.append(content[pos:match.start()])
+            self.parts.append(Substitution(match.group(1)))
+            pos = match.end()
+        if pos < len(content) or not self.parts:
+            self.parts.append(content[pos:])
+
+    def render(self, request, escape_type="html"):
+        if len(self.parts) == 1 and not isinstance(self.parts[0], Substitution):
+            return self.parts[0]
+
+        escape_func = escape_funcs[escape_type]
+        variables = {}
+        rv = []
+        for part in self.parts:
+            if isinstance(part, Substitution):
+                value = part.lookup(request, variables)
+                #Should possibly support escaping for other contexts e.g. script
+                #TODO: read the encoding of the response
+                rv.append(escape_func(unicode(value)).encode("utf-8"))
+            else:
+                rv.append(part)
+        return self.empty.join(rv)
+
+
+class TemplateCache(object):
+    """Thread-safe LRU cache of CompiledTemplates keyed on the template
+    content, so that edited files get a new entry.
+
+    :param max_size: Maximum total length of the cached templates
+    """
+    def __init__(self, max_size=16 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, content):
+        # str and unicode content that compare equal render differently
+        key = (type(content), content)
+        with self._lock:
+            compiled = self._templates.pop(key, None)
+            if compiled is not None:
+                self._templates[key] = compiled
+                return compiled
+
+        compiled = CompiledTemplate(content)
+        if len(content) <= self.max_size:
+            with self._lock:
+                if key not in self._templates:
+                    self.size += len(content)
+                self._templates[key] = compiled
+                while self.size > self.max_size:
+                    (_, evicted), _ = self._templates.popitem(last=False)
+                    self.size -= len(evicted)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self.size = 0
+
+
+template_cache = TemplateCache()
+
+
+def template(request, content, escape_type="html"):
+    #TODO: There basically isn't any error handling here
+    return template_cache.get(content).render(request, escape_type)
+
 
 @pipe()
 def gzip(request, response):
@@ -432,9 +640,31 @@ def gzip(request, response):
     It sets (or overwrites) these HTTP headers:
     Content-Encoding is set to gzip
     Content-Length is set to the length of the compressed content
+
+    Content that is generated as it is sent, or files larger than
+    gzip_buffer_size, are instead compressed as they are sent, without a
+    Content-Length.
     """
-    content = resolve_content(response)
+    content = response.content
+    if isinstance(content, types.StringTypes):
+        buffered = True
+    elif isinstance(content, (list, tuple)):
+        buffered = all(isinstance(item, types.StringTypes) for item in content)
+    elif hasattr(content, "read"):
+        size = remaining_size(content)
+        buffered = size is not None and size <= gzip_buffer_size
+    else:
+        buffered = False
+
     response.headers.set("Content-Encoding", "gzip")
+    if not buffered:
+        if "Content-Length" in response.headers:
+            del response.headers["Content-Length"]
+        response.content = gzip_chunks(iter_chunks(content, delays=True),
+                                       response.writer.encode)
+        return response
+
+    content = resolve_content(response)
 
     out = StringIO()
     with gzip_module.GzipFile(fileobj=out, mode="w") as f:
@@ -444,3 +674,18 @@ def gzip(request, response):
     response.headers.set("Content-Length", len(response.content))
 
     return response
+
+
+def gzip_chunks(chunks, encode):
+    """Compress an iterator of content chunks as a gzip stream.
+
+    Data compressed so far is flushed out at each Delay in the content,
+    so that it can be decompressed by the client during the pause."""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        if isinstance(chunk, Delay):
+            yield compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield chunk
+        else:
+            yield compressor.compress(encode(chunk))
+    yield compressor.flush()
@@ -1,8 +1,8 @@
 import base64
 import cgi
 import Cookie
-import StringIO
 import tempfile
+from io import BytesIO
 
 from six.moves.urllib.parse import parse_qsl, urlsplit
 
@@ -47,47 +47,50 @@ class InputFile(object):
         self._file = rfile
         self.length = length
 
+        # Number of bytes read from rfile so far, all of which are in _buf
         self._file_position = 0
 
         if length > self.max_buffer_size:
             self._buf = tempfile.TemporaryFile(mode="rw+b")
         else:
-            self._buf = StringIO.StringIO()
+            self._buf = BytesIO()
 
     @property
     def _buf_position(self):
-        rv = self._buf.tell()
-        assert rv <= self._file_position
-        return rv
+        return self._buf.tell()
+
+    def _read_file(self, bytes, readline=False):
+        # Reads at most up to the end of the body, since anything after
+        # that belongs to the next request on the connection. rfile is
+        # buffered, so this reads from the socket in blocks.
+        bytes = min(bytes, self.length - self._file_position)
+        if bytes <= 0:
+            return b""
+        if readline:
+            data = self._file.readline(bytes)
+        else:
+            data = self._file.read(bytes)
+        # Also needed when switching from reading to writing a real file
+        self._buf.seek(self._file_position)
+        self._buf.write(data)
+        self._file_position += len(data)
+        return data
 
     def read(self, bytes=-1):
-        assert self._buf_position <= self._file_position
+        position = self._buf.tell()
+        if bytes < 0 or bytes > self.length - position:
+            bytes = self.length - position
 
-        if bytes < 0:
-            bytes = self.length - self._buf_position
-        bytes_remaining = min(bytes, self.length - self._buf_position)
-
-        if bytes_remaining == 0:
-            return ""
-
-        if self._buf_position != self._file_position:
-            buf_bytes = min(bytes_remaining, self._file_position - self._buf_position)
-            old_data = self._buf.read(buf_bytes)
-            bytes_remaining -= buf_bytes
-        else:
-            old_data = ""
+        if bytes <= 0:
+            return b""
 
-        assert self._buf_position == self._file_position, (
-            "Before reading buffer position (%i) didn't match file position (%i)" %
-            (self._buf_position, self._file_position))
-        new_data = self._file.read(bytes_remaining)
-        self._buf.write(new_data)
-        self._file_position += bytes_remaining
-        assert self._buf_position == self._file_position, (
-            "After reading buffer position (%i) didn't match file position (%i)" %
-            (self._buf_position, self._file_position))
+        if position < self._file_position:
+            data = self._buf.read(min(bytes, self._file_position - position))
+            if len(data) == bytes:
+                return data
+            return data + self._read_file(bytes - len(data))
 
-        return old_data + new_data
+        return self._read_file(bytes)
 
     def tell(self):
         return self._buf_position
@@ -98,41 +101,24 @@ class InputFile(object):
         if offset <= self._file_position:
             self._buf.seek(offset)
         else:
+            self._buf.seek(self._file_position)
             self.read(offset - self._file_position)
 
     def readline(self, max_bytes=None):
-        if max_bytes is None:
-            max_bytes = self.length - self._buf_position
+        position = self._buf.tell()
+        if max_bytes is None or max_bytes < 0 or max_bytes > self.length - position:
+            max_bytes = self.length - position
+
+        if max_bytes <= 0:
+            return b""
 
-        if self._buf_position < self._file_position:
-            data = self._buf.readline(max_bytes)
-            if data.endswith("\n") or len(data) == max_bytes:
+        if position < self._file_position:
+            data = self._buf.readline(min(max_bytes, self._file_position - position))
+            if data.endswith(b"\n") or len(data) == max_bytes:
                 return data
-        else:
-            data = ""
-
-        assert self._buf_position == self._file_position
-
-        initial_position = self._file_position
-        found = False
-        buf = []
-        max_bytes -= len(data)
-        while not found:
-            readahead = self.read(min(2, max_bytes))
-            max_bytes -= len(readahead)
-            for i, c in enumerate(readahead):
-                if c == "\n":
-                    buf.append(readahead[:i+1])
-                    found = True
-                    break
-            if not found:
-                buf.append(readahead)
-            if not readahead or not max_bytes:
-                break
-        new_data = "".join(buf)
-        data += new_data
-        self.seek(initial_position + len(new_data))
-        return data
+            return data + self._read_file(max_bytes - len(data), readline=True)
+
+        return self._read_file(max_bytes, readline=True)
 
     def readlines(self):
         rv = []
@@ -5,7 +5,10 @@ import json
 import types
 import uuid
 import socket
+import ssl
+import time
 
+from . import sendfile
 from .constants import response_codes
 from .logger import get_logger
 
@@ -168,7 +171,7 @@ class Response(object):
         self.set_cookie(name, None, path=path, domain=domain, max_age=0,
                         expires=timedelta(days=-1))
 
-    def iter_content(self, read_file=False):
+    def iter_content(self, read_file=False, delays=False):
         """Iterator returning chunks of response body content.
 
         If any part of the content is a function, this will be called
@@ -179,6 +182,10 @@ class Response(object):
         allowing the file to be passed to the output in small chunks. When set to
         True, the entire content of the file will be returned as a string facilitating
         non-streaming operations like template substitution.
+        :param delays: - boolean controlling the behaviour when part of the content
+        is a Delay. When set to False the Delay is called like any other function,
+        sleeping for its duration. When set to True the Delay is returned, so that
+        the caller can wait without blocking the thread.
         """
         if isinstance(self.content, types.StringTypes):
             yield self.content
@@ -189,6 +196,9 @@ class Response(object):
                 yield self.content
         else:
             for item in self.content:
+                if delays and isinstance(item, Delay):
+                    yield item
+                    continue
                 if hasattr(item, "__call__"):
                     value = item()
                 else:
@@ -214,6 +224,18 @@ class Response(object):
         self.write_status_headers()
         self.write_content()
 
+    def iter_write(self):
+        """Write the whole response, yielding a Delay wherever the content
+        calls for a pause rather than sleeping. The caller is responsible
+        for waiting for each Delay before continuing the iteration."""
+        self.write_status_headers()
+        if self.request.method != "HEAD" or self.send_body_for_head_request:
+            for item in self.iter_content(delays=True):
+                if isinstance(item, Delay):
+                    yield item
+                else:
+                    self.writer.write_content(item)
+
     def set_error(self, code, message=""):
         """Set the response status headers and body to indicate an
         error"""
@@ -228,6 +250,25 @@ class Response(object):
             self.logger.error(message)
 
 
+class Delay(object):
+    """Part of the response content that pauses the response.
+
+    Calling the Delay sleeps for its duration, so it can be used as content
+    wherever a function can. Servers that write responses with
+    Response.iter_write may instead wait without blocking a thread.
+
+    :param seconds: Length of the pause in seconds
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self):
+        time.sleep(self.seconds)
+
+    def __repr__(self):
+        return "<Delay %ss>" % self.seconds
+
+
 class MultipartContent(object):
     def __init__(self, boundary=None, default_content_type=None):
         self.items = []
@@ -284,6 +325,37 @@ class MultipartPart(object):
         return "\r\n".join(rv)
 
 
+class FileRange(object):
+    """File-like object for reading a single byte range of a file.
+
+    :param f: The file object, which this takes ownership of
+    :param lower: Offset of the first byte of the range
+    :param upper: Offset one past the last byte of the range
+    """
+    def __init__(self, f, lower, upper):
+        self.file = f
+        self.position = lower
+        self.upper = upper
+
+    @property
+    def remaining(self):
+        return max(self.upper - self.position, 0)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        self.file.seek(self.position)
+        data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
 class ResponseHeaders(object):
     """Dictionary-like object holding the headers for the response"""
     def __init__(self):
@@ -358,7 +430,14 @@ class ResponseWriter(object):
 
     After each part of the response is written, the output is
     flushed unless response.explicit_flush is False, in which case
-    the user must call .flush() explicitly."""
+    the user must call .flush() explicitly.
+
+    Files are sent with sendfile where possible, so that their content
+    doesn't have to be copied through Python. Set use_sendfile to False
+    to always copy files in chunks of file_chunk_size bytes."""
+
+    use_sendfile = True
+
     def __init__(self, handler, response):
         self._wfile = handler.wfile
         self._response = response
@@ -400,10 +479,22 @@ class ResponseWriter(object):
             if name.lower() not in self._headers_seen:
                 self.write_header(name, f())
 
-        if (type(self._response.content) in (str, unicode) and
-            "content-length" not in self._headers_seen):
+        if self._empty_not_modified():
+            # The Content-Length of a Not Modified response would be that of
+            # the full response, so it's left out
+            pass
+        elif (type(self._response.content) in (str, unicode) and
+              "content-length" not in self._headers_seen):
             #Would be nice to avoid double-encoding here
             self.write_header("Content-Length", len(self.encode(self._response.content)))
+        elif (isinstance(self._response.content, FileRange) and
+              "content-length" not in self._headers_seen):
+            self.write_header("Content-Length", self._response.content.remaining)
+
+    def _empty_not_modified(self):
+        content = self._response.content
+        return (self._response.status[0] == 304 and
+                isinstance(content, types.StringTypes) and not content)
 
     def end_headers(self):
         """Finish writing headers and write the separator.
@@ -416,7 +507,7 @@ class ResponseWriter(object):
             self.write_default_headers()
 
         self.write("\r\n")
-        if "content-length" not in self._headers_seen:
+        if "content-length" not in self._headers_seen and not self._empty_not_modified():
             self._response.close_connection = True
         if not self._response.explicit_flush:
             self.flush()
@@ -445,6 +536,9 @@ class ResponseWriter(object):
         """Write a file-like object directly to the response in chunks.
         Does not flush."""
         self.content_written = True
+        if self.use_sendfile and self.sendfile(data):
+            data.close()
+            return
         while True:
             buf = data.read(self.file_chunk_size)
             if not buf:
@@ -455,6 +549,37 @@ class ResponseWriter(object):
                 break
         data.close()
 
+    def sendfile(self, data):
+        """Try to send a file to the socket with sendfile.
+
+        :returns: False if the file wasn't sent and has to be copied
+                  instead."""
+        connection = self._handler.connection
+        if not sendfile.available() or isinstance(connection, ssl.SSLSocket):
+            return False
+        if isinstance(data, FileRange):
+            f, offset, count = data.file, data.position, data.remaining
+        else:
+            f, count = data, None
+        try:
+            f.fileno()
+            if f is data:
+                offset = f.tell()
+        except (AttributeError, IOError, ValueError):
+            # Not backed by a real file
+            return False
+
+        if not self.flush():
+            return True
+        try:
+            sendfile.sendfile(connection, f, offset, count)
+        except sendfile.SendfileUnsupported:
+            return False
+        except socket.error:
+            # This can happen if the socket got closed by the remote end
+            pass
+        return True
+
     def encode(self, data):
         """Convert unicode to bytes according to response.encoding."""
         if isinstance(data, str):
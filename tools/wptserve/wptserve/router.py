@@ -1,6 +1,8 @@
 import itertools
 import re
+import threading
 import types
+from collections import OrderedDict
 
 from .logger import get_logger
 
@@ -72,18 +74,52 @@ class RouteCompiler(object):
         self.star_seen = True
         return "(.*"
 
-def compile_path_match(route_pattern):
-    """tokens: / or literal or match or *"""
-
+def tokenize_path_match(route_pattern):
     tokenizer = RouteTokenizer()
     tokens, unmatched = tokenizer.scan(route_pattern)
 
     assert unmatched == "", unmatched
 
+    return tokens
+
+def compile_path_match(route_pattern):
+    """tokens: / or literal or match or *"""
+
+    tokens = tokenize_path_match(route_pattern)
+
     compiler = RouteCompiler()
 
     return compiler.compile(tokens)
 
+def literal_affixes(route_pattern):
+    """Get the literal text that any path matching a route pattern must
+    start and end with.
+
+    :param route_pattern: Route pattern as passed to Router.register
+    :returns: Tuple of (prefix, suffix). If the pattern has no groups
+              the prefix is the whole path and the suffix is empty.
+    """
+    tokens = tokenize_path_match(route_pattern)
+    if not tokens or tokens[0][0] != "slash":
+        tokens = [("slash", None)] + tokens
+
+    parts = [("/" if token_type == "slash" else value
+              if token_type == "literal" else None)
+             for token_type, value in tokens]
+    if None not in parts:
+        return "".join(parts), ""
+    first = parts.index(None)
+    last = len(parts) - parts[::-1].index(None)
+    return "".join(parts[:first]), "".join(parts[last:])
+
+def first_segment(path):
+    """Get the part of a path up to and including the second /, or
+    None if there is no second /"""
+    end = path.find("/", 1)
+    if end == -1:
+        return None
+    return path[:end + 1]
+
 class Router(object):
     """Object for matching handler functions to requests.
 
@@ -92,12 +128,23 @@ class Router(object):
     :param routes: Initial routes to add; a list of three item tuples
                    (method, path_pattern, handler_function), defined
                    as for register()
+    :param cache_size: Maximum number of (method, path) pairs to remember
+                       the matching handler for
     """
 
-    def __init__(self, doc_root, routes):
+    def __init__(self, doc_root, routes, cache_size=1024):
         self.doc_root = doc_root
         self.routes = []
         self.logger = get_logger()
+        self.cache_size = cache_size
+        # Literal (prefix, suffix) of each entry in self.routes
+        self._affixes = []
+        # Routes in priority order, with the literal prefix and suffix
+        # a path has to have to match, grouped by the first path segment
+        # of the prefix.
+        self._index = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
         for route in reversed(routes):
             self.register(*route)
 
@@ -137,21 +184,48 @@ class Router(object):
         """
         if type(methods) in types.StringTypes or methods in (any_method, "*"):
             methods = [methods]
-        for method in methods:
-            self.routes.append((method, compile_path_match(path), handler))
-            self.logger.debug("Route pattern: %s" % self.routes[-1][1].pattern)
-
-    def get_handler(self, request):
-        """Get a handler for a request or None if there is no handler.
-
-        :param request: Request to get a handler for.
-        :rtype: Callable or None
-        """
-        for method, regexp, handler in reversed(self.routes):
-            if (request.method == method or
+        prefix, suffix = literal_affixes(path)
+        with self._lock:
+            for method in methods:
+                self.routes.append((method, compile_path_match(path), handler))
+                self.logger.debug("Route pattern: %s" % self.routes[-1][1].pattern)
+                self._affixes.append((prefix, suffix))
+            self._index = None
+            self._cache.clear()
+
+    def _build_index(self):
+        generic = []
+        segments = {}
+        for i in xrange(len(self.routes) - 1, -1, -1):
+            method, regexp, handler = self.routes[i]
+            prefix, suffix = self._affixes[i]
+            entry = (method, regexp, handler, prefix, suffix)
+            segment = first_segment(prefix)
+            if segment is None:
+                generic.append((i, entry))
+                for items in segments.itervalues():
+                    items.append((i, entry))
+            else:
+                if segment not in segments:
+                    segments[segment] = list(generic)
+                segments[segment].append((i, entry))
+        return ([entry for _, entry in generic],
+                {segment: [entry for _, entry in items]
+                 for segment, items in segments.iteritems()})
+
+    def _find(self, request_method, path):
+        if self._index is None:
+            self._index = self._build_index()
+        generic, segments = self._index
+        candidates = segments.get(first_segment(path), generic)
+
+        for method, regexp, handler, prefix, suffix in candidates:
+            if (request_method == method or
                 method in (any_method, "*") or
-                (request.method == "HEAD" and method == "GET")):
-                m = regexp.match(request.url_parts.path)
+                (request_method == "HEAD" and method == "GET")):
+                if not path.startswith(prefix) or not path.endswith(suffix):
+                    continue
+                m = regexp.match(path)
                 if m:
                     if not hasattr(handler, "__class__"):
                         name = handler.__name__
@@ -162,7 +236,25 @@ class Router(object):
                     match_parts = m.groupdict().copy()
                     if len(match_parts) < len(m.groups()):
                         match_parts["*"] = m.groups()[-1]
-                    request.route_match = match_parts
+                    return handler, match_parts
+        return None, None
 
-                    return handler
-        return None
+    def get_handler(self, request):
+        """Get a handler for a request or None if there is no handler.
+
+        :param request: Request to get a handler for.
+        :rtype: Callable or None
+        """
+        key = (request.method, request.url_parts.path)
+        with self._lock:
+            rv = self._cache.pop(key, None)
+            if rv is None:
+                rv = self._find(*key)
+            self._cache[key] = rv
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        handler, match_parts = rv
+        if handler is not None:
+            request.route_match = match_parts.copy()
+        return handler
@@ -0,0 +1,99 @@
+"""Copy data from a file to a socket without reading it into Python.
+
+os.sendfile is used where it exists (Python 3). Python 2 doesn't expose
+the system call, so on Linux it is called from the C library directly."""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import sys
+
+
+def _libc_sendfile():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError:
+        return None
+    func = getattr(libc, "sendfile64", None)
+    if func is None:
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        c_offset = ctypes.c_int64(offset)
+        rv = func(out_fd, in_fd, ctypes.byref(c_offset), count)
+        if rv < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return rv
+
+    return sendfile
+
+
+_sendfile = getattr(os, "sendfile", None) or _libc_sendfile()
+
+
+def available():
+    """Check whether sendfile can be used on this platform"""
+    return _sendfile is not None
+
+
+class SendfileUnsupported(Exception):
+    """Nothing was sent because sendfile doesn't work for this pair of
+    files, so the data has to be copied some other way"""
+    pass
+
+
+def sendfile(sock, in_file, offset, count):
+    """Send count bytes from in_file, starting at offset, to sock.
+
+    :param sock: Connected socket to send to. It may have a timeout set.
+    :param in_file: File object, or file descriptor, to read from
+    :param offset: Offset in in_file of the first byte to send
+    :param count: Number of bytes to send, or None to send up to the end
+                  of the file
+    :returns: Number of bytes sent, which is less than count if the
+              file was truncated
+    :raises SendfileUnsupported: If sendfile can't be used and no data
+                                 was sent
+    :raises socket.error: If sending fails
+    """
+    if _sendfile is None:
+        raise SendfileUnsupported()
+
+    in_fd = in_file if isinstance(in_file, int) else in_file.fileno()
+    out_fd = sock.fileno()
+    if count is None:
+        count = max(os.fstat(in_fd).st_size - offset, 0)
+    timeout = sock.gettimeout()
+
+    sent = 0
+    while sent < count:
+        try:
+            # Limit each call so that large files on 32 bit systems don't
+            # overflow size_t
+            n = _sendfile(out_fd, in_fd, offset + sent, min(count - sent, 0x7ffff000))
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.EAGAIN:
+                # The socket is non-blocking because it has a timeout
+                _, writable, _ = select.select([], [out_fd], [], timeout)
+                if not writable:
+                    raise socket.timeout("timed out")
+                continue
+            if sent == 0 and e.errno in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                                         errno.EOPNOTSUPP):
+                raise SendfileUnsupported()
+            raise socket.error(e.errno, e.strerror)
+        if n == 0:
+            # End of file
+            break
+        sent += n
+    return sent
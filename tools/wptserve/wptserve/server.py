@@ -6,16 +6,16 @@ from SocketServer import ThreadingMixIn
 import ssl
 import sys
 import threading
-import time
 import traceback
 import types
 
 from six.moves.urllib.parse import urlsplit, urlunsplit
 
 from . import routes as default_routes
+from .eventloop import EventLoop, WorkerPool
 from .logger import get_logger
 from .request import Server, Request
-from .response import Response
+from .response import Delay, Response
 from .router import Router
 from .utils import HTTPException
 
@@ -110,9 +110,27 @@ class WebTestServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
     # Ensure that we don't hang on shutdown waiting for requests
     daemon_threads = True
 
+    # Set up SSL on each accepted connection rather than on the listening
+    # socket, so that the handshake doesn't happen when accepting
+    wrap_connections = False
+
+    # Number of threads handling connections, or None to start a thread for
+    # each connection
+    max_workers = None
+
+    # Time in seconds after which a keep-alive connection with no request
+    # is closed when using a fixed number of threads, so that idle
+    # connections can't hold on to all of them
+    idle_timeout = 5
+
+    # Time in seconds to wait for requests in progress to complete when
+    # shutting down the server
+    shutdown_timeout = 5
+
     def __init__(self, server_address, RequestHandlerClass, router, rewriter, bind_hostname,
                  config=None, use_ssl=False, key_file=None, certificate=None,
-                 encrypt_after_connect=False, latency=None, **kwargs):
+                 encrypt_after_connect=False, latency=None, max_workers=None,
+                 max_queued=None, reuse_port=False, **kwargs):
         """Server for HTTP(s) Requests
 
         :param server_address: tuple of (server_name, port)
@@ -146,7 +164,35 @@ class WebTestServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
                              server_address parameter, but not to the hostname.
         :param latency: Delay in ms to wait before seving each response, or
                         callable that returns a delay in ms
+
+        :param max_workers: Number of threads to handle connections on, or None
+                            to start a new thread for each connection.
+
+        :param max_queued: Maximum number of accepted connections waiting for
+                           a thread when max_workers is set, beyond which no
+                           more connections are accepted until a thread is
+                           free. Defaults to max_workers.
+
+        :param reuse_port: Boolean indicating whether to set SO_REUSEPORT on
+                           the listening socket, so that several processes
+                           can serve the same port.
         """
+        if reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+        self.reuse_port = reuse_port
+
+        if max_workers is not None:
+            self.max_workers = max_workers
+        self.max_queued = max_queued if max_queued is not None else self.max_workers
+        if self.max_workers:
+            # Do the SSL handshake on the worker thread, so that a slow
+            # client doesn't stop other connections being accepted
+            self.wrap_connections = True
+        self.workers = None
+        # Connections waiting for a request on a worker thread
+        self.idle_connections = set()
+        self._idle_lock = threading.Lock()
+
         self.router = router
         self.rewriter = rewriter
 
@@ -172,15 +218,97 @@ class WebTestServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
                              "ports": {"http": [self.server_address[1]]}}
 
 
+        self.use_ssl = use_ssl
         self.key_file = key_file
         self.certificate = certificate
         self.encrypt_after_connect = use_ssl and encrypt_after_connect
 
-        if use_ssl and not encrypt_after_connect:
-            self.socket = ssl.wrap_socket(self.socket,
-                                          keyfile=self.key_file,
-                                          certfile=self.certificate,
-                                          server_side=True)
+        if use_ssl and not encrypt_after_connect and not self.wrap_connections:
+            self.socket = self.wrap_socket(self.socket)
+
+    def wrap_socket(self, sock):
+        return ssl.wrap_socket(sock,
+                               keyfile=self.key_file,
+                               certfile=self.certificate,
+                               server_side=True)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        BaseHTTPServer.HTTPServer.server_bind(self)
+
+    @property
+    def pooled(self):
+        """Boolean indicating whether connections are handled on a fixed
+        size pool of threads"""
+        return bool(self.max_workers)
+
+    def create_workers(self):
+        return WorkerPool(self.max_workers, name="wptserve-worker",
+                          max_queued=self.max_queued)
+
+    def pool_stats(self):
+        """Get the usage of the pool of threads handling connections, for
+        choosing max_workers.
+
+        :returns: Dictionary as returned by WorkerPool.stats, or None if the
+                  server isn't running with a pool of threads"""
+        workers = self.workers
+        if workers is None:
+            return None
+        return workers.stats()
+
+    def serve_forever(self, poll_interval=0.5):
+        if not self.pooled:
+            return BaseHTTPServer.HTTPServer.serve_forever(self, poll_interval)
+        self.workers = self.create_workers()
+        try:
+            BaseHTTPServer.HTTPServer.serve_forever(self, poll_interval)
+        finally:
+            workers, self.workers = self.workers, None
+            with self._idle_lock:
+                idle_connections = list(self.idle_connections)
+            for connection in idle_connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            # Requests still in progress are abandoned after a while, as
+            # with the daemon threads used otherwise
+            workers.shutdown(timeout=self.shutdown_timeout,
+                             on_drop=self.drop_request)
+
+    def set_idle(self, connection, idle):
+        """Record whether a connection handled by a worker thread is waiting
+        for a request, in which case it is closed when the server is shut
+        down."""
+        with self._idle_lock:
+            if idle:
+                self.idle_connections.add(connection)
+            else:
+                self.idle_connections.discard(connection)
+
+    def process_request(self, request, client_address):
+        if self.workers is None:
+            return ThreadingMixIn.process_request(self, request, client_address)
+        # Blocks when max_queued connections are already waiting, leaving
+        # further connections in the listen backlog
+        self.workers.submit(self.process_request_pooled, request, client_address)
+
+    def drop_request(self, func, request, client_address):
+        """Close a connection that was still waiting for a worker thread
+        when the server shut down"""
+        self.shutdown_request(request)
+
+    def process_request_pooled(self, request, client_address):
+        try:
+            if self.use_ssl and not self.encrypt_after_connect:
+                request = self.wrap_socket(request)
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
 
     def handle_error(self, request, client_address):
         error = sys.exc_info()[1]
@@ -195,12 +323,188 @@ class WebTestServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
             self.logger.error(traceback.format_exc())
 
 
+class EventLoopConnection(object):
+    """A client connection to an EventLoopServer.
+
+    Requests are processed on the server's worker threads. Between requests
+    the connection waits for more data on the event loop, and delays in the
+    middle of a request are timers on the event loop, so that an idle or
+    paused connection doesn't occupy a thread."""
+
+    def __init__(self, server, sock, client_address):
+        self.server = server
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.client_address = client_address
+        self.handler = None
+        self.steps = None
+
+    def wait_readable(self):
+        # Runs on the event loop thread
+        self.server.idle[self.fd] = self
+        self.server.loop.add_reader(self.fd, self.on_readable)
+
+    def on_readable(self):
+        # Runs on the event loop thread
+        self.server.loop.remove_reader(self.fd)
+        del self.server.idle[self.fd]
+        self.server.workers.submit(self.run)
+
+    def resume(self):
+        # Runs on the event loop thread
+        self.server.workers.submit(self.run)
+
+    def setup(self):
+        if self.server.use_ssl and not self.server.encrypt_after_connect:
+            self.sock = self.server.wrap_socket(self.sock)
+        handler_cls = self.server.RequestHandlerClass
+        if isinstance(handler_cls, type):
+            handler = handler_cls.__new__(handler_cls)
+        else:
+            # Old-style class
+            handler = types.InstanceType(handler_cls)
+        # Equivalent to BaseRequestHandler.__init__, without handling the
+        # requests
+        handler.request = self.sock
+        handler.client_address = self.client_address
+        handler.server = self.server
+        handler.setup()
+        self.handler = handler
+
+    def has_buffered_input(self):
+        """Check whether the next request has already been read from the
+        socket, in which case waiting for the socket to be readable may
+        never return"""
+        rbuf = getattr(self.handler.rfile, "_rbuf", None)
+        if rbuf is not None and rbuf.tell() > 0:
+            return True
+        connection = self.handler.connection
+        return isinstance(connection, ssl.SSLSocket) and connection.pending() > 0
+
+    def run(self):
+        # Runs on a worker thread
+        try:
+            if self.handler is None:
+                self.setup()
+            while True:
+                if self.steps is None:
+                    self.steps = self.handler.iter_handle_one_request()
+                try:
+                    delay = next(self.steps)
+                except StopIteration:
+                    self.steps = None
+                else:
+                    self.server.loop.call_soon_threadsafe(
+                        lambda: self.server.loop.call_later(delay.seconds, self.resume))
+                    return
+
+                if self.handler.close_connection:
+                    self.close()
+                    return
+                if not self.has_buffered_input():
+                    break
+        except Exception:
+            self.server.handle_error(self.sock, self.client_address)
+            self.close()
+            return
+        self.server.loop.call_soon_threadsafe(self.wait_readable)
+
+    def close(self):
+        if self.handler is not None:
+            try:
+                self.handler.finish()
+            except Exception:
+                pass
+            self.sock = self.handler.connection
+        self.server.shutdown_request(self.sock)
+
+
+class EventLoopServer(WebTestServer):
+    """Server that waits for connections, and for requests on idle
+    keep-alive connections, on a single event loop thread, and processes
+    requests on a fixed size pool of worker threads.
+
+    Delays in responses caused by latency or the trickle pipe are timers on
+    the event loop rather than sleeping threads. Handlers that block a
+    thread themselves still occupy a worker, so max_workers should be large
+    enough to cover those.
+
+    Takes the same arguments as WebTestServer, except that max_queued is
+    ignored.
+    """
+    wrap_connections = True
+    max_workers = 32
+    # Idle connections wait on the event loop, not on a worker thread
+    idle_timeout = None
+
+    def __init__(self, *args, **kwargs):
+        WebTestServer.__init__(self, *args, **kwargs)
+        self.loop = None
+        # Connections waiting for a request, by file descriptor
+        self.idle = {}
+        self._shut_down = threading.Event()
+        self._shut_down.set()
+
+    def serve_forever(self, poll_interval=None):
+        self._shut_down.clear()
+        self.loop = EventLoop()
+        self.workers = WorkerPool(self.max_workers, name="wptserve-worker")
+        try:
+            self.socket.setblocking(False)
+            self.loop.add_reader(self.socket.fileno(), self.accept)
+            self.loop.run()
+        finally:
+            self.loop.remove_reader(self.socket.fileno())
+            for connection in list(self.idle.values()):
+                connection.close()
+            self.idle.clear()
+            # Requests still in progress are abandoned after a while, as
+            # with the daemon threads of the threaded server
+            workers, self.workers = self.workers, None
+            workers.shutdown(timeout=self.shutdown_timeout,
+                             on_drop=self.drop_request)
+            self.loop.close()
+            self._shut_down.set()
+
+    def drop_request(self, func):
+        # Tasks are the run method of a connection
+        func.__self__.close()
+
+    def accept(self):
+        # Runs on the event loop thread
+        while True:
+            try:
+                sock, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] == errno.ECONNABORTED:
+                    continue
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.logger.error("Error accepting connection: %s" % e)
+                return
+            sock.settimeout(None)
+            EventLoopConnection(self, sock, client_address).wait_readable()
+
+    def shutdown(self):
+        if self.loop is not None:
+            self.loop.stop()
+        self._shut_down.wait()
+
+
 class WebTestRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """RequestHandler for WebTestHttpd"""
 
     protocol_version = "HTTP/1.1"
 
     def handle_one_request(self):
+        for delay in self.iter_handle_one_request():
+            delay()
+
+    def iter_handle_one_request(self):
+        """Handle a single request, yielding a response.Delay each time
+        processing has to pause, e.g. for added latency or a trickle pipe.
+        The caller must wait for the delay before resuming the iteration,
+        which allows event-driven servers to do so without blocking a
+        thread."""
         response = None
         self.logger = get_logger()
         try:
@@ -245,7 +549,7 @@ class WebTestRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 else:
                     latency = self.server.latency
                 self.logger.warning("Latency enabled. Sleeping %i ms" % latency)
-                time.sleep(latency / 1000.)
+                yield Delay(latency / 1000.)
 
             if handler is None:
                 response.set_error(404)
@@ -268,7 +572,8 @@ class WebTestRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                                                     request.raw_input.length))
 
             if not response.writer.content_written:
-                response.write()
+                for delay in response.iter_write():
+                    yield delay
 
             # If we want to remove this in the future, a solution is needed for
             # scripts that produce a non-string iterable of content, since these
@@ -294,8 +599,19 @@ class WebTestRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.logger.error(err)
 
     def get_request_line(self):
+        idle_timeout = None
+        if self.server.workers is not None and self.server.idle_timeout is not None:
+            idle_timeout = self.server.idle_timeout
         try:
-            self.raw_requestline = self.rfile.readline(65537)
+            if idle_timeout is not None:
+                self.connection.settimeout(idle_timeout)
+                self.server.set_idle(self.connection, True)
+            try:
+                self.raw_requestline = self.rfile.readline(65537)
+            finally:
+                if idle_timeout is not None:
+                    self.server.set_idle(self.connection, False)
+                    self.connection.settimeout(None)
         except socket.error:
             self.close_connection = True
             return False
@@ -345,6 +661,13 @@ class WebTestHttpd(object):
     :param bind_hostname: Boolean indicating whether to bind server to hostname.
     :param latency: Delay in ms to wait before seving each response, or
                     callable that returns a delay in ms
+    :param max_workers: Number of threads to handle connections on, or None to
+                        use the default for server_cls, which for
+                        WebTestServer is a new thread for each connection
+    :param max_queued: Maximum number of accepted connections waiting for a
+                       thread when max_workers is set
+    :param reuse_port: Set SO_REUSEPORT on the listening socket, so that
+                       several processes can serve the same port
 
     HTTP server designed for testing scenarios.
 
@@ -381,7 +704,8 @@ class WebTestHttpd(object):
                  use_ssl=False, key_file=None, certificate=None, encrypt_after_connect=False,
                  router_cls=Router, doc_root=os.curdir, routes=None,
                  rewriter_cls=RequestRewriter, bind_hostname=True, rewrites=None,
-                 latency=None, config=None):
+                 latency=None, config=None, max_workers=None, max_queued=None,
+                 reuse_port=False):
 
         if routes is None:
             routes = default_routes.routes
@@ -413,7 +737,10 @@ class WebTestHttpd(object):
                                     key_file=key_file,
                                     certificate=certificate,
                                     encrypt_after_connect=encrypt_after_connect,
-                                    latency=latency)
+                                    latency=latency,
+                                    max_workers=max_workers,
+                                    max_queued=max_queued,
+                                    reuse_port=reuse_port)
             self.started = False
 
             _host, self.port = self.httpd.socket.getsockname()